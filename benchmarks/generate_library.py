@@ -0,0 +1,322 @@
+"""
+Generate a synthetic library for benchmarking, using the same schema as the
+application. Artist and tag popularity follow a Zipf-like distribution, so a
+few artists/tags own most of the recordings (like a real collection).
+
+Usage (from the repository root):
+
+    python -m benchmarks.generate_library --size 100k --output ./data/bench-100k.db
+"""
+
+from typing import Dict, List, Sequence, Tuple
+
+from argparse import ArgumentParser
+from datetime import datetime
+from itertools import accumulate
+from json import dumps
+from os import environ, path, remove
+from random import Random
+from time import perf_counter
+from uuid import UUID
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+BENCHMARK_USER = "bench"
+MODES = ("easy", "medium", "hard")
+
+GENRES = [
+    "rock",
+    "pop",
+    "electronic",
+    "hip hop",
+    "jazz",
+    "metal",
+    "indie",
+    "classical",
+    "folk",
+    "punk",
+    "soul",
+    "alternative rock",
+    "ambient",
+    "house",
+    "techno",
+    "blues",
+    "country",
+    "reggae",
+    "funk",
+    "r&b",
+    "post-rock",
+    "shoegaze",
+    "synthpop",
+    "hard rock",
+    "progressive rock",
+    "singer-songwriter",
+    "trip hop",
+    "drum and bass",
+    "dubstep",
+    "k-pop",
+    "j-pop",
+    "latin",
+    "bossa nova",
+    "soundtrack",
+    "experimental",
+    "noise",
+    "emo",
+    "grunge",
+    "disco",
+    "new wave",
+]
+
+# Zipf exponents. Higher means more skewed
+ARTIST_SKEW = 1.1
+TAG_SKEW = 1.2
+
+# As if a few syncs had fetched similar artists for the most common artists
+SIMILARITY_ARTISTS = 500
+SIMILAR_ARTISTS = 30
+
+INSERT_ARTIST_QUERY = """
+INSERT INTO artist (mbid, name, subsonic_name, subsonic_id) VALUES (?, ?, ?, ?)
+"""
+
+INSERT_RECORDING_QUERY = """
+INSERT INTO recording (
+    id, file_id, file_id_type, mtime, artist_name, release_name, recording_name,
+    recording_mbid, artist_mbid, release_mbid, duration, track_num, disc_num
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_METADATA_QUERY = """
+INSERT INTO recording_metadata (recording_id, popularity, last_updated)
+VALUES (?, ?, ?)
+"""
+
+INSERT_RECORDING_ARTIST_QUERY = """
+INSERT INTO recording_artist (recording_id, artist_id) VALUES (?, ?)
+"""
+
+INSERT_TAG_QUERY = """
+INSERT INTO tag (id, name) VALUES (?, ?)
+"""
+
+INSERT_RECORDING_TAG_QUERY = """
+INSERT INTO recording_tag (recording_id, tag_id, entity, last_updated)
+VALUES (?, ?, ?, ?)
+"""
+
+INSERT_RATING_QUERY = """
+INSERT INTO rating (recording_id, recording_type, username, rating)
+VALUES (?, ?, ?, ?)
+"""
+
+INSERT_SIMILARITY_QUERY = """
+INSERT OR IGNORE INTO artist_similarity (artist_mbid, similar_mbid, score)
+VALUES (?, ?, ?)
+"""
+
+INSERT_SIMILARITY_FETCH_QUERY = """
+INSERT INTO artist_similarity_fetch (artist_mbid, last_updated) VALUES (?, ?)
+"""
+
+INSERT_SESSION_QUERY = """
+INSERT INTO session (username, name, prompt, mode, seen, last_updated)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+def zipf_weights(count: int, skew: float) -> List[float]:
+    return list(accumulate(1 / (rank + 1) ** skew for rank in range(count)))
+
+
+def make_mbid(rng: Random) -> str:
+    return str(UUID(int=rng.getrandbits(128), version=4))
+
+
+def parse_size(size: str) -> int:
+    if size.lower() in SIZES:
+        return SIZES[size.lower()]
+
+    return int(size)
+
+
+def generate(db_file: str, recordings: int, seed: int) -> Dict[str, int]:
+    # The application reads the database path on import
+    environ["DATABASE_PATH"] = db_file
+
+    # Importing subsonic first patches the Troi database module
+    from subsonic.database import ArtistSubsonicDatabase
+    from subsonic.library import refresh_library_stats
+
+    from troi.content_resolver.model.database import (
+        WRITE_PRAGMAS,
+        checkpoint_db,
+        db,
+        setup_db,
+    )
+    from troi.content_resolver.model.recording import FileIdType
+
+    ArtistSubsonicDatabase().create()
+    setup_db(db_file, pragmas=WRITE_PRAGMAS)
+    db.connect(reuse_if_open=True)
+
+    rng = Random(seed)
+    now = datetime.now()
+    subsonic_type = FileIdType.SUBSONIC_ID.value
+
+    # Artists, most popular first
+    artist_count = max(50, recordings // 12)
+    artists: List[Tuple[str, str]] = [
+        (make_mbid(rng), f"Artist {idx}") for idx in range(artist_count)
+    ]
+    artist_weights = zipf_weights(artist_count, ARTIST_SKEW)
+
+    tag_names = GENRES + [f"tag {idx}" for idx in range(max(0, recordings // 250))]
+    tag_weights = zipf_weights(len(tag_names), TAG_SKEW)
+    tag_ids = list(range(1, len(tag_names) + 1))
+
+    # Every artist has a few "genres", so that tags correlate with artists
+    artist_tags: List[Sequence[int]] = [
+        rng.choices(tag_ids, cum_weights=tag_weights, k=3) for _ in range(artist_count)
+    ]
+
+    with db.atomic():
+        db.cursor().executemany(
+            INSERT_ARTIST_QUERY,
+            [
+                (mbid, name, name, f"ar-{idx}")
+                for idx, (mbid, name) in enumerate(artists)
+            ],
+        )
+        db.cursor().executemany(INSERT_TAG_QUERY, list(zip(tag_ids, tag_names)))
+
+        similarity_rows = []
+        for idx in range(min(artist_count, SIMILARITY_ARTISTS)):
+            similar = rng.choices(
+                range(artist_count), cum_weights=artist_weights, k=SIMILAR_ARTISTS
+            )
+            for rank, other in enumerate(similar):
+                if other != idx:
+                    similarity_rows.append(
+                        (artists[idx][0], artists[other][0], 1 - rank / SIMILAR_ARTISTS)
+                    )
+
+        db.cursor().executemany(INSERT_SIMILARITY_QUERY, similarity_rows)
+        db.cursor().executemany(
+            INSERT_SIMILARITY_FETCH_QUERY,
+            [
+                (mbid, now)
+                for mbid, _ in artists[: min(artist_count, SIMILARITY_ARTISTS)]
+            ],
+        )
+
+    recording_rows = []
+    metadata_rows = []
+    recording_artist_rows = []
+    recording_tag_rows = []
+    rating_rows = []
+    mbids: List[str] = []
+
+    owners = rng.choices(range(artist_count), cum_weights=artist_weights, k=recordings)
+
+    for idx, owner in enumerate(owners, 1):
+        mbid = make_mbid(rng)
+        artist_mbid, artist_name = artists[owner]
+        file_id = f"tr-{idx}"
+        mbids.append(mbid)
+
+        recording_rows.append(
+            (
+                idx,
+                file_id,
+                subsonic_type,
+                int(now.timestamp()),
+                artist_name,
+                f"Release {owner}-{idx // 12}",
+                f"Recording {idx}",
+                mbid,
+                artist_mbid,
+                make_mbid(rng),
+                rng.randint(90_000, 480_000),
+                idx % 12 + 1,
+                1,
+            )
+        )
+
+        # Most recordings are not popular
+        metadata_rows.append((idx, 100 * rng.betavariate(0.7, 2.5), now))
+
+        recording_artist_rows.append((idx, artist_mbid))
+        if rng.random() < 0.05:
+            featured = rng.randrange(artist_count)
+            if featured != owner:
+                recording_artist_rows.append((idx, artists[featured][0]))
+
+        tags = set(rng.sample(artist_tags[owner], rng.randint(1, 3)))
+        if rng.random() < 0.2:
+            tags.add(rng.choices(tag_ids, cum_weights=tag_weights)[0])
+
+        for tag_id in tags:
+            entity = rng.choice(("recording", "artist", "release-group"))
+            recording_tag_rows.append((idx, tag_id, entity, now))
+
+        if rng.random() < 0.03:
+            # About a fifth of rated songs are hated (1 star)
+            rating = 1 if rng.random() < 0.2 else rng.randint(2, 5)
+            rating_rows.append((file_id, subsonic_type, BENCHMARK_USER, rating))
+
+    with db.atomic():
+        cursor = db.cursor()
+        cursor.executemany(INSERT_RECORDING_QUERY, recording_rows)
+        cursor.executemany(INSERT_METADATA_QUERY, metadata_rows)
+        cursor.executemany(INSERT_RECORDING_ARTIST_QUERY, recording_artist_rows)
+        cursor.executemany(INSERT_RECORDING_TAG_QUERY, recording_tag_rows)
+        cursor.executemany(INSERT_RATING_QUERY, rating_rows)
+
+        # One session per mode, which has already gone through a few playlists
+        for mode in MODES:
+            seen = rng.sample(mbids, min(len(mbids), 200))
+            cursor.execute(
+                INSERT_SESSION_QUERY,
+                (
+                    BENCHMARK_USER,
+                    f"bench-{mode}",
+                    f"artist:({artists[0][1]})",
+                    mode,
+                    dumps(seen),
+                    now,
+                ),
+            )
+
+    refresh_library_stats()
+    checkpoint_db()
+    db.close_all()
+
+    return {
+        "artists": artist_count,
+        "recordings": recordings,
+        "recording_tags": len(recording_tag_rows),
+        "ratings": len(rating_rows),
+        "tags": len(tag_names),
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Generate a synthetic library for benchmarks")
+    parser.add_argument(
+        "--size",
+        default="10k",
+        help="number of recordings: 10k, 100k, 1m or an integer (default: 10k)",
+    )
+    parser.add_argument(
+        "--output", required=True, help="path of the database to create"
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    for suffix in ("", "-shm", "-wal"):
+        if path.exists(args.output + suffix):
+            remove(args.output + suffix)
+
+    start = perf_counter()
+    counts = generate(args.output, parse_size(args.size), args.seed)
+    print(f"Generated {args.output} in {perf_counter() - start:.1f}s: {counts}")
@@ -0,0 +1,512 @@
+"""
+Load test the app over HTTP, the way it is deployed: main.py under gunicorn
+(with gunicorn.conf.py), against a synthetic library (see generate_library).
+The Subsonic server is a local stand-in, and so are ListenBrainz/MusicBrainz
+(in the radio subprocesses, see standins/sitecustomize.py).
+
+Every virtual user logs in, and then sends a mix of requests (radio, session
+radio, tags, library pages, cover art, scan status, playlists) one after
+another, without waiting in between. The number of users is increased step
+by step, and each step reports throughput, p50/p99 latency per endpoint and
+error rates.
+
+Usage (from the repository root):
+
+    python -m benchmarks.load_test --database ./data/bench-10k.db --output load.json
+    python -m benchmarks.load_test --database ./data/bench-10k.db \\
+        --concurrency 1 8 32 --gunicorn-args "--workers 4"
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import sqlite3
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from json import dump, dumps, loads
+from multiprocessing import Process
+from os import environ, getcwd, path
+from random import Random
+from shutil import copyfile
+from socket import socket
+from subprocess import Popen, STDOUT
+from tempfile import TemporaryDirectory
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+from urllib.parse import parse_qs, urlsplit
+
+from requests import RequestException, Session
+
+from .generate_library import MODES
+from .run_radio import git_revision, percentile
+
+# Relative frequency of each kind of request
+TRAFFIC = {
+    "radio": 6,
+    "session_radio": 4,
+    "tags": 10,
+    "library": 10,
+    "cover": 40,
+    "scan_status": 15,
+    "playlists": 10,
+    "create_playlist": 5,
+}
+
+# Roughly a JPEG cover
+COVER = b"\xff\xd8\xff\xe0" + bytes(30_000)
+
+
+def free_port() -> int:
+    with socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class SubsonicHandler(BaseHTTPRequestHandler):
+    """
+    Just enough of the Subsonic API for the app's endpoints. Every request
+    takes server.latency seconds
+    """
+
+    protocol_version = "HTTP/1.1"
+    server: "SubsonicServer"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send(self, body: bytes, content_type="application/json") -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self) -> None:
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            query.update(parse_qs(self.rfile.read(length).decode()))
+
+        sleep(self.server.latency)
+
+        view = parts.path.rsplit("/", 1)[-1].removesuffix(".view")
+        if view == "getCoverArt":
+            return self.send(COVER, "image/jpeg")
+
+        response: Dict[str, Any] = {"status": "ok", "version": "1.16.1"}
+
+        if view == "getPlaylists":
+            response["playlists"] = {
+                "playlist": [
+                    {
+                        "id": str(id),
+                        "name": f"Playlist {id}",
+                        "songCount": songs,
+                        "duration": songs * 200,
+                    }
+                    for id, songs in list(self.server.playlists.items())[:50]
+                ]
+            }
+        elif view in ("createPlaylist", "updatePlaylist"):
+            songs = len(query.get("songId", query.get("songIdToAdd", [])))
+            with self.server.lock:
+                if view == "createPlaylist":
+                    id = int(query.get("playlistId", [0])[0]) or next(self.server.ids)
+                    self.server.playlists[id] = songs
+                    response["playlist"] = {"id": str(id)}
+                else:
+                    id = int(query["playlistId"][0])
+                    self.server.playlists[id] = self.server.playlists.get(id, 0) + songs
+        elif view == "getPlaylist":
+            id = int(query["id"][0])
+            response["playlist"] = {
+                "id": str(id),
+                "songCount": self.server.playlists.get(id, 0),
+            }
+
+        self.send(dumps({"subsonic-response": response}).encode())
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+
+class SubsonicServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, latency: float) -> None:
+        super().__init__(("127.0.0.1", port), SubsonicHandler)
+        self.latency = latency
+        self.lock = Lock()
+        self.ids = count(1)
+        self.playlists: Dict[int, int] = {}
+
+
+def serve_subsonic(port: int, latency: float) -> None:
+    SubsonicServer(port, latency).serve_forever()
+
+
+class Library:
+    """
+    What the virtual users ask for, from the generated library
+    """
+
+    def __init__(self, db_file: str) -> None:
+        with sqlite3.connect(f"file:{db_file}?mode=ro", uri=True) as conn:
+            self.artists = [
+                name
+                for (name,) in conn.execute(
+                    "SELECT name FROM artist_summary ORDER BY count DESC LIMIT 20"
+                )
+            ]
+            self.tags = [
+                name
+                for (name,) in conn.execute(
+                    "SELECT name FROM tag_summary ORDER BY count DESC LIMIT 10"
+                )
+            ]
+            recordings = conn.execute(
+                "SELECT file_id, recording_mbid FROM recording "
+                "ORDER BY random() LIMIT 5000"
+            ).fetchall()
+
+        self.file_ids = [file_id for file_id, _ in recordings]
+        self.mbids = [mbid for _, mbid in recordings]
+
+
+class VirtualUser:
+    def __init__(self, base_url: str, library: "Library", seed: str) -> None:
+        self.base_url = base_url
+        self.library = library
+        self.rng = Random(seed)
+        self.http = Session()
+        self.session_id: Optional[int] = None
+
+    def request(self, method: str, url: str, **kwargs) -> Tuple[int, bytes]:
+        response = self.http.request(
+            method, self.base_url + url, timeout=300, **kwargs
+        )
+        return response.status_code, response.content
+
+    def login(self) -> None:
+        status, _ = self.request(
+            "POST", "/api/login", json={"username": "bench", "password": "bench"}
+        )
+        if status != 200:
+            raise RuntimeError(f"Could not log in ({status})")
+
+    def radio(self) -> int:
+        if self.rng.random() < 0.5:
+            prompt = f"artist:({self.rng.choice(self.library.artists)})"
+        else:
+            prompt = f"tag:({self.rng.choice(self.library.tags)})"
+
+        mode = self.rng.choice(MODES)
+        body = {
+            "prompt": {"type": "prompt", "prompt": prompt, "mode": mode},
+            "quiet": True,
+        }
+        return self.request("POST", "/api/radio", json=body)[0]
+
+    def session_radio(self) -> int:
+        if self.session_id is None:
+            status, content = self.request(
+                "POST",
+                "/api/session",
+                json={
+                    "mbids": self.rng.sample(self.library.mbids, 10),
+                    "mode": self.rng.choice(MODES),
+                    "name": "load test",
+                    "prompt": f"artist:({self.rng.choice(self.library.artists)})",
+                },
+            )
+            if status != 200:
+                return status
+
+            self.session_id = loads(content)["id"]
+
+        status, _ = self.request(
+            "POST",
+            "/api/radio",
+            json={"prompt": {"type": "session", "id": self.session_id}, "quiet": True},
+        )
+        if status != 200:
+            # Exhausted (and deleted). Start a new one next time
+            self.session_id = None
+
+        return status
+
+    def tags(self) -> int:
+        return self.request("GET", "/api/tags")[0]
+
+    def library_page(self) -> int:
+        params = {"limit": 50, "offset": self.rng.randrange(0, 500, 50)}
+        if self.rng.random() < 0.5:
+            params["q"] = self.rng.choice(self.library.artists)[:4]
+
+        kind = self.rng.choice(("artists", "tags"))
+        return self.request("GET", f"/api/library/{kind}", params=params)[0]
+
+    def cover(self) -> int:
+        id = self.rng.choice(self.library.file_ids)
+        return self.request("GET", f"/api/proxy/{id}")[0]
+
+    def scan_status(self) -> int:
+        return self.request("GET", "/api/scanStatus")[0]
+
+    def playlists(self) -> int:
+        return self.request("GET", "/api/playlists")[0]
+
+    def create_playlist(self) -> int:
+        ids = self.rng.sample(self.library.file_ids, self.rng.choice((50, 100, 1000)))
+        body = {"ids": ids, "name": "load test"}
+        return self.request("POST", "/api/createPlaylist", json=body)[0]
+
+    def operation(self, name: str) -> Callable[[], int]:
+        return {
+            "radio": self.radio,
+            "session_radio": self.session_radio,
+            "tags": self.tags,
+            "library": self.library_page,
+            "cover": self.cover,
+            "scan_status": self.scan_status,
+            "playlists": self.playlists,
+            "create_playlist": self.create_playlist,
+        }[name]
+
+
+class LoadTest:
+    def __init__(
+        self,
+        db_file: str,
+        seed: int,
+        upstream_latency: float,
+        subsonic_latency: float,
+        gunicorn_args: str,
+    ) -> None:
+        self.source_db = db_file
+        self.seed = seed
+        self.upstream_latency = upstream_latency
+        self.subsonic_latency = subsonic_latency
+        self.gunicorn_args = gunicorn_args
+        self.library = Library(db_file)
+
+    def start(self, workdir: str) -> None:
+        # Sessions are written to, so use a copy of the library
+        self.db_file = path.join(workdir, "library.db")
+        copyfile(self.source_db, self.db_file)
+
+        subsonic_port = free_port()
+        self.subsonic = Process(
+            target=serve_subsonic,
+            args=(subsonic_port, self.subsonic_latency),
+            daemon=True,
+        )
+        self.subsonic.start()
+
+        app_port = free_port()
+        self.base_url = f"http://127.0.0.1:{app_port}"
+
+        root = getcwd()
+        env = {
+            **environ,
+            "BENCHMARK_STANDIN_DATABASE": self.db_file,
+            "BENCHMARK_SEED": str(self.seed),
+            "BENCHMARK_UPSTREAM_LATENCY": str(self.upstream_latency),
+            "CACHE_PATH": path.join(workdir, "session"),
+            "CACHE_TYPE": "filesystem",
+            "COVER_CACHE_PATH": path.join(workdir, "covers"),
+            "DATABASE_PATH": self.db_file,
+            "GUNICORN_CMD_ARGS": f"--bind 127.0.0.1:{app_port} {self.gunicorn_args}",
+            "MODE": "production",
+            "PROXY_IMAGES": "true",
+            "PYTHONPATH": path.join(root, "benchmarks", "standins") + ":" + root,
+            "SUBSONIC_PORT": str(subsonic_port),
+            "SUBSONIC_URL": "http://127.0.0.1",
+        }
+
+        self.log = open(path.join(workdir, "gunicorn.log"), "wb")
+        self.app = Popen(
+            ["python3", "main.py"], env=env, stdout=self.log, stderr=STDOUT
+        )
+
+        for _ in range(300):
+            if self.app.poll() is not None:
+                with open(self.log.name, errors="replace") as log:
+                    raise RuntimeError(f"The app exited:\n{log.read()[-4000:]}")
+            try:
+                Session().get(self.base_url + "/api/scanStatus", timeout=1)
+                return
+            except RequestException:
+                sleep(0.1)
+
+        raise RuntimeError("The app did not start")
+
+    def stop(self) -> None:
+        self.app.terminate()
+        self.app.wait(30)
+        self.log.close()
+        self.subsonic.terminate()
+
+    def run_step(self, concurrency: int, duration: float) -> Dict[str, Any]:
+        names = list(TRAFFIC)
+        weights = list(TRAFFIC.values())
+
+        results: Dict[str, List[Tuple[float, bool]]] = {name: [] for name in names}
+        lock = Lock()
+        stop = Event()
+
+        def user(idx: int) -> None:
+            virtual_user = VirtualUser(
+                self.base_url, self.library, f"{self.seed}:{concurrency}:{idx}"
+            )
+            virtual_user.login()
+
+            while not stop.is_set():
+                name = virtual_user.rng.choices(names, weights)[0]
+                start = perf_counter()
+                try:
+                    ok = virtual_user.operation(name)() < 400
+                except RequestException:
+                    ok = False
+
+                elapsed = perf_counter() - start
+                if not stop.is_set():
+                    with lock:
+                        results[name].append((elapsed, ok))
+
+        threads = [
+            Thread(target=user, args=(idx,), daemon=True) for idx in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+
+        sleep(duration)
+        stop.set()
+        # Requests still in flight at the end are not counted
+        for thread in threads:
+            thread.join(300)
+
+        total = sum(len(samples) for samples in results.values())
+        errors = sum(not ok for samples in results.values() for _, ok in samples)
+
+        endpoints = {}
+        for name, samples in results.items():
+            latencies = [elapsed for elapsed, _ in samples]
+            endpoints[name] = {
+                "requests": len(samples),
+                "errors": sum(not ok for _, ok in samples),
+                "p50": round(percentile(latencies, 0.5), 4),
+                "p99": round(percentile(latencies, 0.99), 4),
+            }
+
+        return {
+            "concurrency": concurrency,
+            "requests": total,
+            "throughput": round(total / duration, 2),
+            "error_rate": round(errors / total, 4) if total else 0,
+            "endpoints": endpoints,
+        }
+
+    def run(
+        self,
+        levels: List[int],
+        duration: float,
+        max_error_rate: float,
+    ) -> Dict[str, Any]:
+        steps = []
+
+        with TemporaryDirectory() as workdir:
+            self.start(workdir)
+            try:
+                for concurrency in levels:
+                    step = self.run_step(concurrency, duration)
+                    steps.append(step)
+                    print_step(step)
+
+                    if step["error_rate"] > max_error_rate:
+                        print(f"Stopping: error rate above {max_error_rate:.0%}")
+                        break
+            finally:
+                self.stop()
+
+        return {
+            "git": git_revision(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "database": self.source_db,
+            "duration": duration,
+            "gunicorn_args": self.gunicorn_args,
+            "subsonic_latency": self.subsonic_latency,
+            "upstream_latency": self.upstream_latency,
+            "steps": steps,
+        }
+
+
+def print_step(step: Dict[str, Any]) -> None:
+    print(
+        f"{step['concurrency']:4} users: {step['throughput']:8.2f} req/s, "
+        f"{step['error_rate']:.1%} errors",
+        flush=True,
+    )
+    for name, endpoint in step["endpoints"].items():
+        if endpoint["requests"]:
+            print(
+                f"    {name:16} {endpoint['requests']:6} requests  "
+                f"p50 {endpoint['p50']:8.3f}s  p99 {endpoint['p99']:8.3f}s  "
+                f"{endpoint['errors']} errors",
+                flush=True,
+            )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Load test the app under gunicorn")
+    parser.add_argument("--database", required=True, help="generated database")
+    parser.add_argument(
+        "--concurrency",
+        nargs="+",
+        type=int,
+        default=[1, 2, 4, 8, 16, 32],
+        help="number of virtual users of each step",
+    )
+    parser.add_argument("--duration", type=float, default=30, help="seconds per step")
+    parser.add_argument(
+        "--max-error-rate",
+        type=float,
+        default=0.05,
+        help="stop increasing the concurrency above this error rate",
+    )
+    parser.add_argument(
+        "--upstream-latency",
+        type=float,
+        default=0.2,
+        help="seconds each ListenBrainz/MusicBrainz request takes (default: 0.2)",
+    )
+    parser.add_argument(
+        "--subsonic-latency",
+        type=float,
+        default=0.02,
+        help="seconds each Subsonic request takes (default: 0.02)",
+    )
+    parser.add_argument(
+        "--gunicorn-args",
+        default="",
+        help="extra gunicorn arguments, such as --workers 4",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write results (JSON) to this file")
+    args = parser.parse_args()
+
+    load_test = LoadTest(
+        args.database,
+        args.seed,
+        args.upstream_latency,
+        args.subsonic_latency,
+        args.gunicorn_args,
+    )
+    results = load_test.run(args.concurrency, args.duration, args.max_error_rate)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            dump(results, file, indent=2)
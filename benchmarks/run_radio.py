@@ -0,0 +1,509 @@
+"""
+Benchmark radio generation against a synthetic library (see generate_library).
+Every prompt type (artist, tag, multi and session) is run in every mode, in process,
+with ListenBrainz/MusicBrainz replaced by deterministic local stand-ins. The
+stand-ins are seeded, as is Troi's randomness, so results can be compared
+between commits. The stand-ins answer immediately, unless --upstream-latency
+is given to simulate the time spent waiting on the network.
+
+Latency is measured without tracing. Peak memory per stage is measured in
+separate runs with tracemalloc enabled, since tracing slows everything down.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run_radio --database ./data/bench-100k.db --output new.json
+    python -m benchmarks.run_radio --database ./data/bench-100k.db --baseline old.json
+"""
+
+from typing import Any, Dict, List, Optional
+
+import sqlite3
+import tracemalloc
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from json import dump, dumps, load, loads
+from os import environ, path
+from platform import python_version
+from random import Random, seed
+from subprocess import run
+from threading import Lock
+from time import perf_counter, sleep
+from urllib.parse import parse_qs, urlsplit
+
+from .generate_library import BENCHMARK_USER, MODES
+
+# multi combines several terms, which are generated concurrently
+PROMPT_TYPES = ("artist", "tag", "multi", "session")
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Linearly interpolated percentile of values, for q in [0, 1]"""
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def git_revision() -> Dict[str, Any]:
+    try:
+        rev = run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(
+            run(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        )
+    except Exception:
+        return {"rev": None, "dirty": None}
+
+    return {"rev": rev, "dirty": dirty}
+
+
+class FakeResponse:
+    def __init__(self, data: Any, status_code: int = 200) -> None:
+        self.status_code = status_code
+        self.headers: Dict[str, str] = {"Content-Type": "application/json"}
+        self.text = dumps(data)
+
+    def json(self) -> Any:
+        return loads(self.text)
+
+
+class StandInServices:
+    """
+    Answers the ListenBrainz/MusicBrainz requests made while generating a
+    radio, using the benchmark database itself. A separate connection is used,
+    so that these lookups do not show up in the application's queries.
+    Requests may come from several threads, and each one waits latency seconds
+    """
+
+    SIMILAR_ARTISTS = 100
+    SIMILAR_TAGS = 20
+
+    def __init__(self, db_file: str, seed: int, latency: float = 0.0) -> None:
+        self.conn = sqlite3.connect(
+            f"file:{db_file}?mode=ro", uri=True, check_same_thread=False
+        )
+        self.lock = Lock()
+        self.seed = seed
+        self.latency = latency
+
+        self.artists = self.conn.execute(
+            "SELECT mbid, name FROM artist ORDER BY rowid"
+        ).fetchall()
+        self.artist_by_name = {name.lower(): mbid for mbid, name in self.artists}
+        self.artist_by_mbid = {mbid: name for mbid, name in self.artists}
+        self.tags = [
+            name for (name,) in self.conn.execute("SELECT name FROM tag ORDER BY id")
+        ]
+
+    def _rng(self, key: str) -> Random:
+        return Random(f"{self.seed}:{key}")
+
+    def handle(self, method: str, url: str, json: Any = None) -> FakeResponse:
+        if self.latency:
+            sleep(self.latency)
+
+        with self.lock:
+            return self._handle(method, url, json)
+
+    def _handle(self, method: str, url: str, json: Any) -> FakeResponse:
+        parts = urlsplit(url)
+
+        if parts.hostname == "musicbrainz.org" and parts.path == "/ws/2/artist":
+            query = parse_qs(parts.query).get("query", [""])[0]
+            mbid = self.artist_by_name.get(query.lower())
+            if mbid is None:
+                return FakeResponse({"artists": []})
+
+            return FakeResponse(
+                {"artists": [{"id": mbid, "name": self.artist_by_mbid[mbid]}]}
+            )
+
+        if parts.hostname == "musicbrainz.org" and parts.path.startswith(
+            "/ws/2/artist/"
+        ):
+            mbid = parts.path.rsplit("/", 1)[-1]
+            if mbid not in self.artist_by_mbid:
+                return FakeResponse({}, 404)
+
+            return FakeResponse({"id": mbid, "name": self.artist_by_mbid[mbid]})
+
+        if parts.path == "/similar-artists/json":
+            return FakeResponse(self.similar_artists(json[0]["artist_mbids"][0]))
+
+        if parts.path == "/tag-similarity/json":
+            return FakeResponse(self.similar_tags(json[0]["tag"]))
+
+        if parts.path == "/1/metadata/recording":
+            return FakeResponse(self.recording_metadata(json["recording_mbids"]))
+
+        raise RuntimeError(f"No stand-in for {method} {url}")
+
+    def similar_artists(self, artist_mbid: str) -> List[Dict[str, Any]]:
+        # Real results include plenty of artists that are not in the library
+        rng = self._rng(artist_mbid)
+        local = rng.sample(self.artists, min(len(self.artists), self.SIMILAR_ARTISTS))
+
+        results = []
+        for rank, (mbid, name) in enumerate(local):
+            if rng.random() < 0.5:
+                mbid = str(rng.getrandbits(128))
+            results.append(
+                {"artist_mbid": mbid, "name": name, "score": 1000 - rank * 5}
+            )
+
+        return results
+
+    def similar_tags(self, tag: str) -> List[Dict[str, Any]]:
+        rng = self._rng(tag)
+        others = [other for other in self.tags if other != tag]
+        return [
+            {"similar_tag": other, "count": 1000 - rank}
+            for rank, other in enumerate(
+                rng.sample(others, min(len(others), self.SIMILAR_TAGS))
+            )
+        ]
+
+    def recording_metadata(self, mbids: List[str]) -> Dict[str, Any]:
+        output: Dict[str, Any] = {}
+
+        for start in range(0, len(mbids), 500):
+            batch = mbids[start : start + 500]
+            rows = self.conn.execute(
+                f"""
+SELECT recording_mbid, recording_name, artist_mbid, artist_name, release_mbid,
+       release_name, duration
+FROM recording
+WHERE recording_mbid IN ({",".join("?" * len(batch))})""",
+                batch,
+            ).fetchall()
+
+            for mbid, name, artist_mbid, artist, release_mbid, release, length in rows:
+                output[mbid] = {
+                    "artist": {
+                        "name": artist,
+                        "artist_credit_id": 1,
+                        "artists": [
+                            {
+                                "artist_mbid": artist_mbid,
+                                "name": artist,
+                                "join_phrase": "",
+                            }
+                        ],
+                    },
+                    "recording": {"name": name, "length": length},
+                    "release": {
+                        "mbid": release_mbid,
+                        "name": release,
+                        "release_group_mbid": release_mbid,
+                        "caa_id": None,
+                        "caa_release_mbid": None,
+                    },
+                    "tag": {"artist": [], "recording": [], "release_group": []},
+                }
+
+        return output
+
+    def install(self) -> None:
+        import requests
+
+        def request(self_or_method, *args, **kwargs):
+            # Session.request(self, method, url) or requests.request(method, url)
+            if isinstance(self_or_method, requests.Session):
+                method, url = args[0], args[1]
+            else:
+                method, url = self_or_method, args[0]
+
+            return self.handle(method.upper(), url, kwargs.get("json"))
+
+        requests.Session.request = request
+        requests.request = request
+        requests.get = lambda url, **kwargs: request("GET", url, **kwargs)
+        requests.post = lambda url, **kwargs: request("POST", url, **kwargs)
+
+
+class Benchmark:
+    def __init__(
+        self,
+        db_file: str,
+        iterations: int,
+        warmup: int,
+        seed: int,
+        upstream_latency: float = 0.0,
+    ):
+        self.db_file = db_file
+        self.iterations = iterations
+        self.warmup = warmup
+        self.seed = seed
+        self.upstream_latency = upstream_latency
+
+        # The application reads these on import
+        environ["DATABASE_PATH"] = db_file
+        environ.setdefault("SUBSONIC_URL", "http://localhost")
+        environ.setdefault("SUBSONIC_PORT", "4533")
+
+        self.services = StandInServices(db_file, seed, upstream_latency)
+        self.services.install()
+
+        start = perf_counter()
+        import get_radio
+
+        self.import_seconds = perf_counter() - start
+        self.get_radio = get_radio
+
+        from subsonic.database import ArtistSubsonicDatabase
+        from troi.content_resolver.model.database import db, setup_db
+
+        # Migrate databases generated by older versions, like the app does on startup
+        database = ArtistSubsonicDatabase()
+        database.create()
+        database.close()
+
+        setup_db(db_file)
+        db.connect()
+
+        from subsonic.library import ArtistSummary, TagSummary
+        from subsonic.session import Session
+
+        self.Session = Session
+        self.sessions = {
+            session.mode: session
+            for session in Session.select().where(Session.username == BENCHMARK_USER)
+        }
+
+        # Seed the most common artists and tag, which are the worst cases
+        self.artist, self.second_artist = [
+            artist.name
+            for artist in ArtistSummary.select()
+            .order_by(ArtistSummary.count.desc())
+            .limit(2)
+        ]
+        self.tag = TagSummary.select().order_by(TagSummary.count.desc()).get().name
+
+    def request(self, prompt_type: str, mode: str) -> Dict[str, Any]:
+        if prompt_type == "session":
+            session = self.sessions[mode]
+            # Sessions are updated (or deleted) by every run, so restore them
+            self.Session.insert(session.__data__).on_conflict_replace().execute()
+            prompt: Dict[str, Any] = {"type": "session", "id": session.id}
+        else:
+            if prompt_type == "artist":
+                text = f"artist:({self.artist})"
+            elif prompt_type == "multi":
+                text = (
+                    f"artist:({self.artist}) artist:({self.second_artist})"
+                    f" tag:({self.tag})"
+                )
+            else:
+                text = f"tag:({self.tag})"
+
+            prompt = {"type": "prompt", "prompt": text, "mode": mode}
+
+        return {
+            "credentials": {"u": BENCHMARK_USER, "p": "bench"},
+            "excluded_mbids": None,
+            "prompt": prompt,
+            "quiet": True,
+        }
+
+    def run_once(self, prompt_type: str, mode: str, iteration: int):
+        from subsonic.patched.exclude import excluded_mbids
+        from subsonic.patched.timing import reset_stages
+        from subsonic.schema import CreateRadioWithCredentials, convert
+
+        json = convert(self.request(prompt_type, mode), CreateRadioWithCredentials)
+
+        excluded_mbids.clear()
+        reset_stages()
+        seed(f"{self.seed}:{prompt_type}:{mode}:{iteration}")
+
+        start = perf_counter()
+        try:
+            results = self.get_radio.create_radio(json)
+        except Exception as e:
+            return perf_counter() - start, None, str(e)
+
+        return perf_counter() - start, results, None
+
+    def run_case(
+        self, prompt_type: str, mode: str, memory_iterations: int
+    ) -> Dict[str, Any]:
+        latencies: List[float] = []
+        stage_seconds: Dict[str, List[float]] = {}
+        stage_calls: Dict[str, int] = {}
+        stage_peak: Dict[str, int] = {}
+        recordings: List[int] = []
+        errors: List[str] = []
+
+        for iteration in range(self.warmup):
+            self.run_once(prompt_type, mode, -1 - iteration)
+
+        for iteration in range(self.iterations):
+            elapsed, results, error = self.run_once(prompt_type, mode, iteration)
+            if results is None:
+                errors.append(error)
+                continue
+
+            latencies.append(elapsed)
+            recordings.append(len(results.recordings))
+            for item in results.stages:
+                stage_seconds.setdefault(item["name"], []).append(item["seconds"])
+                stage_calls[item["name"]] = item["calls"]
+
+        tracemalloc.start()
+        try:
+            for iteration in range(memory_iterations):
+                _, results, _ = self.run_once(prompt_type, mode, iteration)
+                if results is None:
+                    continue
+
+                for item in results.stages:
+                    stage_peak[item["name"]] = max(
+                        stage_peak.get(item["name"], 0), item["peak_kib"]
+                    )
+        finally:
+            tracemalloc.stop()
+
+        return {
+            "runs": len(latencies),
+            "errors": errors,
+            "recordings": min(recordings) if recordings else 0,
+            "latency": {
+                "p50": round(percentile(latencies, 0.5), 4),
+                "p95": round(percentile(latencies, 0.95), 4),
+            },
+            "stages": {
+                name: {
+                    "calls": stage_calls[name],
+                    "p50": round(percentile(values, 0.5), 4),
+                    "p95": round(percentile(values, 0.95), 4),
+                    "peak_kib": stage_peak.get(name),
+                }
+                for name, values in sorted(
+                    stage_seconds.items(), key=lambda item: -percentile(item[1], 0.5)
+                )
+            },
+        }
+
+    def run(
+        self, prompt_types: List[str], modes: List[str], memory_iterations: int
+    ) -> Dict[str, Any]:
+        cases: Dict[str, Any] = {}
+        for prompt_type in prompt_types:
+            for mode in modes:
+                name = f"{prompt_type}/{mode}"
+                cases[name] = self.run_case(prompt_type, mode, memory_iterations)
+                latency = cases[name]["latency"]
+                errors = len(cases[name]["errors"])
+                print(
+                    f"{name:16} p50 {latency['p50']:8.3f}s  p95 {latency['p95']:8.3f}s"
+                    f"  ({cases[name]['runs']} runs, {errors} errors)",
+                    flush=True,
+                )
+
+        with sqlite3.connect(f"file:{self.db_file}?mode=ro", uri=True) as conn:
+            (recording_count,) = conn.execute(
+                "SELECT COUNT(*) FROM recording"
+            ).fetchone()
+
+        return {
+            "git": git_revision(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "database": {
+                "path": self.db_file,
+                "recordings": recording_count,
+                "size_mb": round(path.getsize(self.db_file) / 1024 / 1024, 1),
+            },
+            "iterations": self.iterations,
+            "seed": self.seed,
+            "upstream_latency": self.upstream_latency,
+            "import_seconds": round(self.import_seconds, 4),
+            "cases": cases,
+        }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> None:
+    def change(old: Optional[float], new: float) -> str:
+        if not old:
+            return "     n/a"
+        return f"{(new - old) / old * 100:+7.1f}%"
+
+    rev = (baseline.get("git") or {}).get("rev") or "baseline"
+    print(f"\nCompared to {rev[:12]}:")
+
+    if baseline["database"]["recordings"] != current["database"]["recordings"]:
+        print(
+            "Warning: the baseline used a different library "
+            f"({baseline['database']['recordings']} recordings)"
+        )
+
+    for name, case in current["cases"].items():
+        old = baseline["cases"].get(name)
+        if old is None:
+            continue
+
+        print(
+            f"{name:16} p50 {change(old['latency']['p50'], case['latency']['p50'])}"
+            f"  p95 {change(old['latency']['p95'], case['latency']['p95'])}"
+        )
+
+        for stage_name, stage in case["stages"].items():
+            old_stage = old["stages"].get(stage_name)
+            if old_stage is None:
+                continue
+
+            print(
+                f"    {stage_name:44} p50 {change(old_stage['p50'], stage['p50'])}"
+            )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark radio generation")
+    parser.add_argument("--database", required=True, help="generated database")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument(
+        "--memory-iterations",
+        type=int,
+        default=1,
+        help="additional runs with tracemalloc, to measure peak memory",
+    )
+    parser.add_argument(
+        "--prompts", nargs="+", choices=PROMPT_TYPES, default=list(PROMPT_TYPES)
+    )
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--upstream-latency",
+        type=float,
+        default=0.0,
+        help="seconds each ListenBrainz/MusicBrainz request takes (default: 0)",
+    )
+    parser.add_argument("--output", help="write results (JSON) to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare to")
+    args = parser.parse_args()
+
+    benchmark = Benchmark(
+        args.database, args.iterations, args.warmup, args.seed, args.upstream_latency
+    )
+    results = benchmark.run(args.prompts, args.modes, args.memory_iterations)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(load(file), results)
@@ -0,0 +1,16 @@
+"""
+Replace ListenBrainz/MusicBrainz with the benchmark stand-ins in every Python
+process started with this directory on PYTHONPATH (such as the get_radio.py
+subprocesses of the app), if BENCHMARK_STANDIN_DATABASE is set. See load_test.
+"""
+
+from os import environ
+
+if environ.get("BENCHMARK_STANDIN_DATABASE"):
+    from benchmarks.run_radio import StandInServices
+
+    StandInServices(
+        environ["BENCHMARK_STANDIN_DATABASE"],
+        int(environ.get("BENCHMARK_SEED", 42)),
+        float(environ.get("BENCHMARK_UPSTREAM_LATENCY", 0)),
+    ).install()
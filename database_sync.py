@@ -1,15 +1,29 @@
 from typing import Dict, List, Set, Tuple
 
 from datetime import datetime
+from time import time
 from json import loads
 from os import environ
 
 from subsonic.artist import Artist as DBArtist, RecordingArtist
 from subsonic.custom_connection import CustomConnection
 from subsonic.database import ArtistSubsonicDatabase
-
+from subsonic.fingerprint import song_fingerprint
+from subsonic.library import refresh_library_stats
+from subsonic.metrics import SYNC_RUNS, SYNC_SONGS, instrument_requests
+from subsonic.read_snapshot import publish_read_snapshot
+from subsonic.similarity import artists_to_refresh, store_similar_artists
+from subsonic.upstream import install_upstream_client
+
+from requests import RequestException
 from troi import Artist, ArtistCredit, Recording, Release
+from troi.content_resolver.artist_search import LocalRecordingSearchByArtistService
 from troi.content_resolver.database import db
+from troi.content_resolver.model.database import (
+    WRITE_PRAGMAS,
+    checkpoint_db,
+    setup_db,
+)
 from troi.content_resolver.metadata_lookup import MetadataLookup, RecordingRow
 from troi.musicbrainz.recording_lookup import RecordingLookupElement
 from troi.content_resolver.model.recording import Recording as DBRecording, FileIdType
@@ -20,6 +34,7 @@ RatingId = Tuple[str, int | None]
 
 
 CREDENTIALS = loads(environ["SUBSONIC_CREDENTIALS"])
+SIMILAR_ARTISTS_SYNC_LIMIT = int(environ.get("SIMILAR_ARTISTS_SYNC_LIMIT", 100))
 
 
 DELETE_RATING_QUERY = """
@@ -33,6 +48,23 @@ ON CONFLICT(recording_id, recording_type, username)
 DO UPDATE SET rating=excluded.rating;
 """
 
+SET_FINGERPRINT_QUERY = """
+UPDATE recording SET fingerprint = ? WHERE id = ?
+"""
+
+# Songs whose MBID did not change are updated from Subsonic alone. The names
+# are only taken from Subsonic if ListenBrainz did not have them
+UPDATE_SONG_QUERY = """
+UPDATE recording
+SET track_num = ?,
+    disc_num = ?,
+    release_name = CASE WHEN release_mbid IS NULL THEN ? ELSE release_name END,
+    artist_name = CASE WHEN artist_mbid IS NULL THEN ? ELSE artist_name END,
+    mtime = ?,
+    fingerprint = ?
+WHERE file_id = ? AND file_id_type = ?
+"""
+
 
 class ProcessLocalSubsonicDatabase(ArtistSubsonicDatabase):
     LOOKUP_BATCH_SIZE = 1000
@@ -51,6 +83,7 @@ class ProcessLocalSubsonicDatabase(ArtistSubsonicDatabase):
         )
         self.existing_mbid_subsonic_id_to_id: Dict[Tuple[str, str], int] = {}
         self.existing_subsonic_id_to_mbid: Dict[str, str] = {}
+        self.existing_subsonic_id_to_fingerprint: Dict[str, int | None] = {}
         self.existing_subsonic_id_to_rating: Dict[str, int | None] = {}
         self.seen_existing_ids: Set[str] = set()
 
@@ -79,7 +112,8 @@ class ProcessLocalSubsonicDatabase(ArtistSubsonicDatabase):
         that this function will check for existing (subsonic id, recording mbid)
         pairs, and for recordings retrieved these will not be fetched again.
         This should significantly improve successive scans from the metadata
-        lookup perspective.
+        lookup perspective. If any other stored field of such a song changed
+        (per its fingerprint), the row is updated from Subsonic alone.
         """
         conn = CustomConnection(credentials=CREDENTIALS)
         if not conn:
@@ -140,6 +174,7 @@ class ProcessLocalSubsonicDatabase(ArtistSubsonicDatabase):
 
             songs: "List[dict]" = results["searchResult3"]["song"]
             rating_update: List[RatingId] = []
+            songs_to_update: List[dict] = []
 
             for song in songs:
                 mbid = song.get("musicBrainzId")
@@ -151,12 +186,22 @@ class ProcessLocalSubsonicDatabase(ArtistSubsonicDatabase):
                     # this happens either if the song doesn't exist, or (for some reason)
                     # the MusicBrainz ID changed
                     songs_to_resolve.append(song)
+                    SYNC_SONGS.labels("resolved").inc()
                 else:
                     # fallthrough case; the MBID does exist. Because there may
                     # be duplicate tracks with the same MBID, mark it as being seen
                     # but DO NOT clear out the dict yet
                     self.seen_existing_ids.add(id)
 
+                    if (
+                        song_fingerprint(song)
+                        != self.existing_subsonic_id_to_fingerprint.get(id)
+                    ):
+                        songs_to_update.append(song)
+                        SYNC_SONGS.labels("updated").inc()
+                    else:
+                        SYNC_SONGS.labels("unchanged").inc()
+
                 if id in self.existing_subsonic_id_to_mbid:
                     rating = song.get("userRating")
                     existing_rating = self.existing_subsonic_id_to_rating.get(id)
@@ -182,6 +227,9 @@ class ProcessLocalSubsonicDatabase(ArtistSubsonicDatabase):
                                 ),
                             )
 
+            if songs_to_update:
+                self.update_songs(songs_to_update)
+
             song_count = len(songs)
             offset += song_count
 
@@ -202,6 +250,59 @@ class ProcessLocalSubsonicDatabase(ArtistSubsonicDatabase):
             songs_to_resolve = songs_to_resolve[self.LOOKUP_BATCH_SIZE :]
 
         self.cleanup()
+        refresh_library_stats()
+        self.refresh_similar_artists()
+        checkpoint_db()
+
+        # Radios only see the changes from here on, all at once
+        publish_read_snapshot()
+
+    def update_songs(self, songs: List[dict]) -> None:
+        """
+        Update existing recordings from their Subsonic song, without looking
+        them up again
+        """
+        mtime = int(time())
+
+        with db.atomic():
+            db.cursor().executemany(
+                UPDATE_SONG_QUERY,
+                [
+                    (
+                        song.get("track", 1),
+                        song.get("discNumber", 1),
+                        song.get("album"),
+                        song.get("artist"),
+                        mtime,
+                        song_fingerprint(song),
+                        song["id"],
+                        FileIdType.SUBSONIC_ID.value,
+                    )
+                    for song in songs
+                ],
+            )
+
+    def refresh_similar_artists(self) -> None:
+        """
+        Fetch the similar artists of the most common library artists that do
+        not have them (or have outdated ones). This is bounded per sync, so
+        the similarity graph used by radios fills in over a few syncs
+        """
+        search = LocalRecordingSearchByArtistService()
+
+        for mbid in artists_to_refresh(SIMILAR_ARTISTS_SYNC_LIMIT):
+            try:
+                similar_artists = search.get_similar_artists(mbid)
+            except (RequestException, RuntimeError) as e:
+                # Most likely rate limited. The rest will be fetched next time
+                print(e)
+                break
+
+            store_similar_artists(mbid, similar_artists)
+
+    def open(self):
+        setup_db(self.db_file, pragmas=WRITE_PRAGMAS)
+        db.connect()
 
     def fetch_existing_data(self):
         """
@@ -210,7 +311,7 @@ class ProcessLocalSubsonicDatabase(ArtistSubsonicDatabase):
         """
 
         query = """
-SELECT id, file_id, recording_mbid, rating
+SELECT id, file_id, recording_mbid, fingerprint, rating
 FROM recording
 LEFT JOIN rating
 ON rating.recording_id = recording.id
@@ -218,8 +319,9 @@ WHERE username IS NULL or username == ?
         """
 
         cursor = db.execute_sql(query, params=[CREDENTIALS["u"]])
-        for id, file_id, mbid, rating in cursor.fetchall():
+        for id, file_id, mbid, fingerprint, rating in cursor.fetchall():
             self.existing_subsonic_id_to_mbid[file_id] = mbid
+            self.existing_subsonic_id_to_fingerprint[file_id] = fingerprint
             if rating is not None:
                 self.existing_subsonic_id_to_rating[file_id] = rating
             self.existing_mbid_subsonic_id_to_id[(file_id, mbid)] = id
@@ -403,6 +505,11 @@ WHERE username IS NULL or username == ?
                                 ),
                             )
 
+                    db.execute_sql(
+                        SET_FINGERPRINT_QUERY,
+                        params=(song_fingerprint(song), recording_id),
+                    )
+
                     metadata_lookup_rows.append(
                         RecordingRow(recording_id, recording.mbid, recording_id)
                     )
@@ -416,6 +523,8 @@ WHERE username IS NULL or username == ?
             if item not in self.seen_existing_ids
         ]
 
+        SYNC_SONGS.labels("deleted").inc(len(missing_ids))
+
         # Delete ids that were not found. Do this in chunks of 500
         with db.atomic():
             for chunk in range(0, len(missing_ids), 500):
@@ -457,6 +566,16 @@ if __name__ == "__main__":
 
     full = len(argv) > 1 and argv[1] == "--full"
 
+    instrument_requests()
+    install_upstream_client()
+
     lookup = ProcessLocalSubsonicDatabase(full)
     lookup.open()
-    lookup.run_sync()
+
+    try:
+        lookup.run_sync()
+    except BaseException:
+        SYNC_RUNS.labels(str(full).lower(), "error").inc()
+        raise
+
+    SYNC_RUNS.labels(str(full).lower(), "ok").inc()
@@ -1,167 +1,241 @@
-from typing import Dict, List, NotRequired, Optional, TypedDict
+from typing import Dict, Optional
 
-from os import environ
+from os import environ, getpid, makedirs, path
 
-from json import loads, dumps
+from time import perf_counter, strftime
 from subsonic.patched.monkeypatch import monkeypatch
 
 # Monkeypatch. This overrides fuzzy index to always use MBID (or lookup MBID).
 # This allows for importing Troi without scikit-learn/numpy
 monkeypatch("troi.content_resolver.fuzzy_index", "subsonic/patched/fuzzy_index.py")
 
-from subsonic.patched.exclude import excluded_mbids
+from subsonic.patched.blend import blend_candidates
+from subsonic.patched.exclude import excluded_mbids, excluded_recording_ids
 from subsonic.patched.patch import *
+from subsonic.patched.timing import get_stages, stage
 
-from peewee import DoesNotExist
-from troi import Artist, ArtistCredit, Playlist, Recording, Release
+from peewee import OperationalError
 from troi.content_resolver.database import db
 from troi.content_resolver.lb_radio import ListenBrainzRadioLocal
 from troi.content_resolver.model.database import setup_db
 
-from subsonic.custom_connection import CustomConnection
-from subsonic.schema import CreateRadioWithCredentials, PromptType
-from subsonic.session import Session
+from subsonic.metrics import instrument_requests
+from subsonic.radio import (
+    RADIO_SESSION_POOL,
+    RadioInfo,
+    format_radio,
+    load_session,
+    sample_pool,
+    take_prefetched,
+    update_session,
+)
+from subsonic.read_snapshot import READ_SNAPSHOT
+from subsonic.recording_ids import decode_recording_ids
+from subsonic.upstream import install_upstream_client
+from subsonic.schema import CreateRadioWithCredentials, SessionRadio, decode, encode
+from subsonic.session import (
+    Session,
+    library_version,
+    prefetch_key,
+    store_pool,
+    store_prefetch,
+)
 
 
 DATABASE_PATH = environ["DATABASE_PATH"]
-PROXY_IMAGES = environ.get("PROXY_IMAGES", "").lower() == "true"
-
-
-class MbzData(TypedDict):
-    mbid: str
-    name: str
-
-
-class RecordingData(TypedDict):
-    artists: NotRequired[List[MbzData]]
-    durationMs: int
-    id: str
-    mbid: str
-    release: NotRequired[MbzData]
-    title: str
-    url: str
-    year: int
-
-
-class RadioInfo(TypedDict):
-    name: str
-    recordings: List[RecordingData]
-    session: NotRequired[Optional[int]]
+PROFILE_PATH = environ.get("PROFILE_PATH")
+PROFILE_THRESHOLD_SEC = float(environ.get("PROFILE_THRESHOLD_SEC", 0))
 
 
 def get_radio(
     mode: str, prompt: str, credentials: Dict[str, str], quiet=False
 ) -> Optional[RadioInfo]:
     r = ListenBrainzRadioLocal(quiet)
-    data = r.generate(mode, prompt, 0.8)
 
-    try:
-        _ = data.playlists[0].recordings[0]
-    except (KeyError, IndexError, AttributeError):
-        return None
+    with stage("ListenBrainzRadioLocal.generate"):
+        data = r.generate(mode, prompt, 0.8)
 
-    playlist: "Playlist" = data.playlists[0]
-    recordings: List["Recording"] = playlist.recordings
+    with stage("output"):
+        return format_radio(data, credentials)
 
-    output_json: "List[RecordingData]" = []
 
-    if PROXY_IMAGES:
+def find_session(username: str, id: int) -> Session:
+    session = load_session(username, id)
+    if session is None:
+        raise Exception(f"No session with id {id}")
 
-        def get_url(id: str):
-            return f"./api/proxy/{id}"
+    return session
 
-    else:
-        conn = CustomConnection(credentials=credentials)
-
-        def get_url(id: str):
-            req = conn._getRequest("getCoverArt.view", {"id": id, "size": 100})
-            return f"{req.full_url}?{req.data.decode()}"
-
-    for recording in recordings:
-        subsonic_id = recording.musicbrainz["subsonic_id"]
 
-        recording_json = RecordingData(
-            durationMs=recording.duration,
-            id=subsonic_id,
-            mbid=recording.mbid,
-            title=recording.name,
-            url=get_url(subsonic_id),
-            year=recording.year,
-        )
+def generate_radio(
+    json: "CreateRadioWithCredentials", mode: str, text: str
+) -> Optional[RadioInfo]:
+    """
+    Generate a radio (with the exclusions already applied), profiling it
+    if requested
+    """
+    profiler = None
+    if json.profile and PROFILE_PATH:
+        from cProfile import Profile
+
+        profiler = Profile()
+        profiler.enable()
+
+    start = perf_counter()
+    results = get_radio(mode, text, json.credentials, json.quiet or False)
+    elapsed = perf_counter() - start
 
-        if recording.artist_credit:
-            credits: "ArtistCredit" = recording.artist_credit
-            artists: "List[Artist]" = credits.artists
+    if profiler is not None:
+        profiler.disable()
 
-            recording_json["artists"] = [
-                MbzData(mbid=artist.mbid, name=artist.name) for artist in artists
-            ]
+        # Only keep profiles of slow requests
+        if elapsed >= PROFILE_THRESHOLD_SEC:
+            makedirs(PROFILE_PATH, exist_ok=True)
+            profile_file = f"radio-{strftime('%Y%m%d-%H%M%S')}-{getpid()}.prof"
+            profiler.dump_stats(path.join(PROFILE_PATH, profile_file))
 
-        if recording.release:
-            release: "Release" = recording.release
-            recording_json["release"] = MbzData(mbid=release.mbid, name=release.name)
+            if results is not None:
+                results.profile = profile_file
 
-        output_json.append(recording_json)
+    return results
 
-    return {
-        "name": playlist.name,
-        "recordings": output_json,
-    }
 
+def session_radio(
+    json: "CreateRadioWithCredentials", session: Session
+) -> Optional[RadioInfo]:
+    """
+    Make the next batch of a session, from its pool if possible. Otherwise,
+    the radio is generated and its candidates become the new pool
+    """
+    if not RADIO_SESSION_POOL:
+        return generate_radio(json, session.mode, session.prompt)
 
-if __name__ == "__main__":
-    from sys import stdin
+    batch = sample_pool(
+        session, json.excluded_mbids, json.credentials, list(excluded_recording_ids)
+    )
+    if batch is not None:
+        return batch.radio
 
-    data = loads(stdin.readline())
-    json: "CreateRadioWithCredentials" = CreateRadioWithCredentials.Schema().load(data)
+    # Taken before generating, so that a sync in the meantime invalidates it
+    version = library_version()
+    blend_candidates.clear()
 
-    prompt = json.prompt
+    results = generate_radio(json, session.mode, session.prompt)
 
-    setup_db(DATABASE_PATH)
-    db.connect()
+    if results is not None and blend_candidates:
+        candidates = blend_candidates[-1]
 
-    if prompt.type == PromptType.SESSION:
         try:
-            session = (
-                Session.select(Session.mode, Session.prompt, Session.seen)
-                .where(
-                    Session.username == json.credentials["u"],
-                    Session.id == prompt.id,
+            with stage("SessionPool.store"):
+                store_pool(
+                    session.id,
+                    version,
+                    results.name,
+                    candidates.weights,
+                    candidates.sources,
                 )
-                .get()
-            )
+        except OperationalError as e:
+            # Most likely, a sync is writing. The next batch makes a new pool
+            print(e)
+
+    return results
 
-            mode = session.mode
-            text = session.prompt
-            if session.seen:
-                excluded_mbids.update(session.seen)
-        except DoesNotExist:
-            raise Exception(f"No session with id {prompt.id}")
+
+def create_radio(json: "CreateRadioWithCredentials") -> RadioInfo:
+    """
+    Create a radio for a request, including session handling. The database
+    must already be connected. Raises an exception if no playlist was made
+    """
+    prompt = json.prompt
+    session: Optional[Session] = None
+    results: Optional[RadioInfo] = None
+
+    if isinstance(prompt, SessionRadio):
+        session = find_session(json.credentials["u"], prompt.id)
+
+        mode = session.mode
+        text = session.prompt
+        if session.seen:
+            excluded_mbids.update(session.seen)
     else:
         mode = prompt.mode.value
         text = prompt.prompt
 
     if json.excluded_mbids:
         excluded_mbids.update(json.excluded_mbids)
+    if json.excluded_ids:
+        excluded_recording_ids.update(decode_recording_ids(json.excluded_ids))
+
+    if session is not None:
+        # The next batch may have been generated right after the last one
+        with stage("SessionPrefetch.take"):
+            results = take_prefetched(
+                session, json.excluded_mbids, json.excluded_ids
+            )
 
-    results = get_radio(mode, text, json.credentials, json.quiet or False)
+    if results is None:
+        if session is not None:
+            results = session_radio(json, session)
+        else:
+            results = generate_radio(json, mode, text)
 
     if results is None:
-        if prompt.type == PromptType.SESSION:
-            Session.delete_by_id(prompt.id)
+        if session is not None:
+            Session.delete_by_id(session.id)
             raise Exception("This session has exhausted all available songs")
 
         raise Exception("Could not find any tracks to create a playlist")
 
-    if prompt.type == PromptType.SESSION:
-        if len(results["recordings"]) < 50:
-            Session.delete_by_id(prompt.id).execute()
-            results["session"] = None
-        else:
-            seen_ids = [r["mbid"] for r in results["recordings"]]
-            Session.update(seen=Session.seen.set(session.seen + seen_ids)).where(
-                Session.id == prompt.id
-            ).execute()
-            results["session"] = prompt.id
+    if session is not None:
+        update_session(session, results)
+
+    results.stages = get_stages()
+    return results
+
+
+def prefetch_radio(json: "CreateRadioWithCredentials") -> None:
+    """
+    Generate the next batch of a session radio, and store it for the next
+    request of the session. The session itself is left as is (besides its
+    pool)
+    """
+    prompt = json.prompt
+    if not isinstance(prompt, SessionRadio):
+        return
+
+    session = find_session(json.credentials["u"], prompt.id)
+    if session.seen:
+        excluded_mbids.update(session.seen)
+    if json.excluded_mbids:
+        excluded_mbids.update(json.excluded_mbids)
+    if json.excluded_ids:
+        excluded_recording_ids.update(decode_recording_ids(json.excluded_ids))
+
+    # The key is taken before generating, so that anything changing in the
+    # meantime invalidates the batch
+    key = prefetch_key(session, json.excluded_mbids, json.excluded_ids)
+    results = session_radio(json, session)
+
+    if results is not None:
+        store_prefetch(session.id, key, encode(results))
+
+
+if __name__ == "__main__":
+    from sys import stdin, stdout
+
+    instrument_requests()
+    install_upstream_client()
+
+    json = decode(CreateRadioWithCredentials, stdin.buffer.readline())
+
+    setup_db(DATABASE_PATH, read_snapshot=READ_SNAPSHOT)
+    db.connect()
+
+    if json.prefetch:
+        prefetch_radio(json)
+    else:
+        results = create_radio(json)
 
-    print(dumps(results), end="")
+        # Anything printed by Troi comes first, the result is the last line
+        stdout.flush()
+        stdout.buffer.write(encode(results))
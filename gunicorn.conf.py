@@ -1,7 +1,28 @@
+from os import environ
+
 bind = "0.0.0.0:5000"
-workers = 2
+
+# Almost every request waits on something else (the radio subprocess, the
+# Subsonic server or SQLite), so each worker serves many requests at once from
+# a pool of threads. The default sync worker class serves one at a time.
+worker_class = environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(environ.get("GUNICORN_WORKERS", 2))
+threads = int(environ.get("GUNICORN_THREADS", 32))
+# With threads, the worker is only restarted when it stops responding
+# altogether. A sync worker is restarted when a single request (such as a slow
+# radio) takes longer than this
+timeout = int(environ.get("GUNICORN_TIMEOUT", 120))
 
 errorlog = "-"
 loglevel = "info"
 accesslog = "-"
 preload_app = True
+
+
+def child_exit(server, worker):
+    from subsonic.metrics import METRICS_ENABLED
+
+    if METRICS_ENABLED:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
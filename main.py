@@ -2,29 +2,61 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from os import environ
+from os import cpu_count, environ
+from threading import BoundedSemaphore
 
+from subsonic.cover_art import COVER_MAX_AGE_SEC, CoverArtCache
 from subsonic.database import ArtistSubsonicDatabase
-from subsonic.process import MetadataHandler
+from subsonic.metrics import reset_metrics
+from subsonic.process import MetadataHandler, SessionPrefetcher
 
 DEBUG = environ.get("MODE", "production") == "debug"
+PROXY_IMAGES = environ.get("PROXY_IMAGES", "").lower() == "true"
+RADIO_MAX_PROCESSES = int(environ.get("RADIO_MAX_PROCESSES", cpu_count() or 1))
+RADIO_SESSION_PREFETCH = environ.get("RADIO_SESSION_PREFETCH", "true").lower() == "true"
 
 
 def create_app():
-    from json import loads
     from subprocess import run
-
-    from flask import Flask, Response, render_template, session
+    from time import perf_counter
+
+    from flask import (
+        Flask,
+        Response,
+        render_template,
+        request,
+        send_file,
+        session,
+    )
     from flask_session import Session
-    from marshmallow import ValidationError
 
-    from subsonic.api import create_session, delete_session, get_metadata, get_sessions
-    from subsonic.custom_connection import CustomConnection
+    from subsonic import cache
+    from subsonic.api import (
+        create_session,
+        delete_session,
+        get_artists,
+        get_metadata,
+        get_sessions,
+        get_tags,
+    )
+    from subsonic.custom_connection import CustomConnection, PlaylistUpdateError
+    from subsonic.library import get_library_state
+    from subsonic.metrics import (
+        CONTENT_TYPE_LATEST,
+        RADIO_REQUEST_SECONDS,
+        RADIO_SUBPROCESS_SECONDS,
+        render_metrics,
+    )
     from subsonic.middleware import (
+        admin_required,
         get_database,
         login_or_credentials_required,
+        metrics_token_required,
+        validate_query,
         validate_schema,
     )
+    from subsonic.radio import RADIO_SESSION_POOL, continue_session
+    from subsonic.slow_query import summarize_slow_queries
     import subsonic.schema as s
 
     app = Flask(
@@ -32,21 +64,17 @@ def create_app():
     )
     global CACHE_PATH, SESSION_CACHELIB, SESSION_REDIS, SESSION_TYPE
 
-    CACHE_TYPE = environ.get("CACHE_TYPE", "filesystem")
     PERMANENT_SESSION_LIFETIME = int(environ.get("SESSION_DURATION_SEC", 86400))
 
-    if CACHE_TYPE == "filesystem":
+    if cache.CACHE_TYPE == "filesystem":
         from cachelib.file import FileSystemCache
 
-        CACHE_PATH = environ.get("CACHE_PATH", "./session")
+        CACHE_PATH = cache.CACHE_PATH
 
         SESSION_TYPE = "cachelib"
         SESSION_CACHELIB = FileSystemCache(CACHE_PATH)
     else:
-        from redis import Redis
-
-        REDIS_URL = environ.get("REDIS_URL", "http://localhost:6379")
-        SESSION_REDIS = Redis.from_url(REDIS_URL)
+        SESSION_REDIS = cache.create_redis()
 
     SESSION_COOKIE_SAMESITE = "Strict"
 
@@ -106,54 +134,184 @@ def create_app():
     def sessions(credentials):
         return get_sessions(credentials["u"])
 
+    def library_response(build) -> Response:
+        state = get_library_state()
+        etag = state.etag if state else "empty"
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(s.encode(build()), mimetype="application/json")
+
+        response.set_etag(etag)
+        # Always revalidate, the library can change with any scan
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
     @app.get("/api/tags")
     @login_or_credentials_required
     @get_database
     def tags(_):
-        return get_metadata()
+        return library_response(get_metadata)
+
+    @app.get("/api/library/artists")
+    @login_or_credentials_required
+    @validate_query(s.LibraryQuery)
+    @get_database
+    def library_artists(_, query: "s.LibraryQuery"):
+        return library_response(lambda: get_artists(query))
+
+    @app.get("/api/library/tags")
+    @login_or_credentials_required
+    @validate_query(s.LibraryQuery)
+    @get_database
+    def library_tags(_, query: "s.LibraryQuery"):
+        return library_response(lambda: get_tags(query))
 
     @app.post("/api/radio")
     @login_or_credentials_required
     @validate_schema(s.CreateRadio)
     def radio(credentials, json: "s.CreateRadio"):
-        data = s.CreateRadioWithCredentials.Schema().dumps(
-            {
-                "credentials": credentials,
-                "excluded_mbids": json.excluded_mbids,
-                "prompt": json.prompt,
-                "quiet": json.quiet or False,
-            }
-        )
+        start = perf_counter()
+        if isinstance(json.prompt, s.SessionRadio):
+            labels = ("session", s.PromptType.SESSION.value)
+        else:
+            labels = (json.prompt.mode.value, s.PromptType.PROMPT.value)
+
+        try:
+            if RADIO_SESSION_POOL and isinstance(json.prompt, s.SessionRadio):
+                batch = continue_session_radio(credentials, json)
+                if batch is not None:
+                    # Rebuild the pool in the background, before it is needed
+                    if batch.low:
+                        prefetch_session(credentials, json)
+
+                    return radio_response(credentials, "", s.encode(batch.radio))
+
+            return create_radio(credentials, json)
+        finally:
+            RADIO_REQUEST_SECONDS.labels(*labels).observe(perf_counter() - start)
 
-        output = run(
-            ["python3", "get_radio.py"],
-            capture_output=True,
-            input=data,
-            text=True,
+    @get_database
+    def continue_session_radio(credentials, json: "s.CreateRadio"):
+        """
+        Serve the next batch of a session from this worker if it is ready
+        (prefetched or in the pool), without starting a radio process
+        """
+        try:
+            return continue_session(
+                s.CreateRadioWithCredentials(
+                    credentials=credentials,
+                    excluded_mbids=json.excluded_mbids,
+                    excluded_ids=json.excluded_ids,
+                    prompt=json.prompt,
+                )
+            )
+        except Exception as e:
+            # The radio process tries again, and reports any error
+            print(e)
+            return None
+
+    def create_radio(credentials, json: "s.CreateRadio"):
+        data = s.encode(
+            s.CreateRadioWithCredentials(
+                credentials=credentials,
+                excluded_mbids=json.excluded_mbids,
+                excluded_ids=json.excluded_ids,
+                profile=json.profile or False,
+                prompt=json.prompt,
+                quiet=json.quiet or False,
+            )
         )
 
+        start = perf_counter()
+        # Each radio is a separate process, so bound how many a worker runs at
+        # once. Other requests are still served by the remaining threads
+        with radio_slots:
+            output = run(
+                ["python3", "get_radio.py"],
+                capture_output=True,
+                input=data,
+                env={**environ, "METRICS_SLOT": "radio"},
+            )
+        RADIO_SUBPROCESS_SECONDS.labels(
+            "ok" if output.returncode == 0 else "error"
+        ).observe(perf_counter() - start)
+
+        log = output.stderr.decode(errors="replace")
+
         if output.returncode != 0:
-            print(output.stderr)
+            print(log)
             return {"error": "could not find recordings to make a playlist"}, 400
         else:
-            data = loads(output.stdout.split("\n")[-1])
+            # The playlist is passed through as is, without decoding it
+            data = output.stdout.rsplit(b"\n", 1)[-1].strip()
 
-            if not data:
-                print(output.stderr)
+            if data in (b"", b"null"):
+                print(log)
                 return {"error": "could not find recordings to make a playlist"}, 400
 
-            return {"log": output.stderr, "playlist": data}
+            # With the pool, the next batch is sampled from the pool instead
+            if not RADIO_SESSION_POOL and isinstance(json.prompt, s.SessionRadio):
+                prefetch_session(credentials, json)
+
+            return radio_response(credentials, log, data)
+
+    def prefetch_session(credentials, json: "s.CreateRadio"):
+        if RADIO_SESSION_PREFETCH:
+            prefetcher.submit(
+                json.prompt.id,
+                s.encode(
+                    s.CreateRadioWithCredentials(
+                        credentials=credentials,
+                        excluded_mbids=json.excluded_mbids,
+                        excluded_ids=json.excluded_ids,
+                        prefetch=True,
+                        prompt=json.prompt,
+                        quiet=True,
+                    )
+                ),
+            )
+
+    def radio_response(credentials, log: str, data: bytes):
+        if PROXY_IMAGES:
+            ids = s.decode_radio_ids(data)
+            cover_cache.prefetch(
+                credentials, [recording.id for recording in ids.recordings]
+            )
+
+        # The playlist is passed through as is, without decoding it
+        return Response(
+            b'{"log":' + s.encode(log) + b',"playlist":' + data + b"}",
+            mimetype="application/json",
+        )
 
     @app.get("/api/proxy/<id>")
     @login_or_credentials_required
     def proxy(credentials, id) -> "Response":
-        conn = CustomConnection(credentials=credentials)
-        resp = conn.getCoverArt(id, 150)
-        return Response(
-            resp,
-            resp.status,
-            content_type=resp.getheader("content-type"),
-        )
+        try:
+            cover = cover_cache.open_cover(credentials, id)
+            try:
+                response = send_file(
+                    cover.file,
+                    mimetype=cover.mimetype,
+                    etag=cover.etag,
+                    last_modified=cover.last_modified,
+                    max_age=COVER_MAX_AGE_SEC,
+                )
+            except BaseException:
+                # Otherwise, the response closes it once sent
+                cover.file.close()
+                raise
+        except BaseException as e:
+            print(e)
+            return {"error": "Could not fetch cover art"}, 404
+
+        # Cover art is only served to authenticated users
+        response.cache_control.public = False
+        response.cache_control.private = True
+        return response
 
     @app.post("/api/createPlaylist")
     @login_or_credentials_required
@@ -164,9 +322,20 @@ def create_app():
         if (json.name is None) == (json.id is None):
             return {"error": "You must provide EITHER playlist name OR id"}, 400
 
-        resp = conn.createPlaylist(name=json.name, playlistId=json.id, songIds=json.ids)
+        try:
+            playlist_id = conn.createPlaylistInBatches(
+                json.ids, name=json.name, playlistId=json.id
+            )
+        except PlaylistUpdateError as e:
+            print(e)
+            return {
+                "error": str(e),
+                "id": e.playlist_id,
+                "added": e.added,
+                "total": e.total,
+            }, 502
 
-        return {"id": resp["playlist"]["id"]}
+        return {"id": playlist_id, "added": len(json.ids)}
 
     @app.post("/api/session")
     @login_or_credentials_required
@@ -187,6 +356,26 @@ def create_app():
             print(e)
             return {"error": "Could not"}, 400
 
+    @app.get("/api/admin/slowQueries")
+    @login_or_credentials_required
+    @admin_required
+    @validate_query(s.SlowQueryQuery)
+    def slow_queries(_, query: "s.SlowQueryQuery"):
+        stats = summarize_slow_queries(query.sort, query.limit)
+        if stats is None:
+            return {"error": "the slow query log is not enabled"}, 404
+
+        return Response(s.encode(stats), mimetype="application/json")
+
+    @app.get("/metrics")
+    @metrics_token_required
+    def metrics():
+        output = render_metrics()
+        if output is None:
+            return {"error": "metrics are not enabled"}, 404
+
+        return Response(output, content_type=CONTENT_TYPE_LATEST)
+
     @app.delete("/api/logout")
     @login_or_credentials_required
     def logout(_):
@@ -209,19 +398,23 @@ def create_app():
         response.headers["Permissions-Policy"] = "browsing-topics=()"
         return response
 
-    @app.errorhandler(ValidationError)
-    def handle_validation_error(e: "ValidationError"):
-        messages = [f"{field}: {error}" for field, error in e.messages.items()]
-
-        return {"error": "\n".join(messages)}, 400
+    @app.errorhandler(s.DecodeError)
+    def handle_validation_error(e: "s.DecodeError"):
+        return {"error": s.format_error(e)}, 400
 
     return app
 
 
+reset_metrics()
+
 handler = MetadataHandler()
+cover_cache = CoverArtCache()
+radio_slots = BoundedSemaphore(RADIO_MAX_PROCESSES)
+prefetcher = SessionPrefetcher()
 
 database = ArtistSubsonicDatabase()
 database.create()
+database.close()
 del database
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from os import environ
+
+from subsonic.database import ArtistSubsonicDatabase
+from subsonic.read_snapshot import publish_read_snapshot
+from subsonic.snapshot import SnapshotError, export_snapshot, import_snapshot
+
+from troi.content_resolver.database import db
+from troi.content_resolver.model.database import (
+    WRITE_PRAGMAS,
+    checkpoint_db,
+    setup_db,
+)
+
+DATABASE_PATH = environ["DATABASE_PATH"]
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from sys import exit
+    from time import perf_counter
+
+    parser = ArgumentParser(
+        description="Export or import a snapshot of the resolved library, so "
+        "that a new instance does not have to resolve everything again"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Write a snapshot")
+    export_parser.add_argument("file")
+
+    import_parser = commands.add_parser(
+        "import",
+        help="Load a snapshot. Run an (incremental) sync afterwards to pick up "
+        "any changes since it was made",
+    )
+    import_parser.add_argument("file")
+    import_parser.add_argument(
+        "--replace",
+        action="store_true",
+        help="Replace the existing library (by default, it must be empty)",
+    )
+
+    args = parser.parse_args()
+
+    # Create any missing tables/columns first
+    database = ArtistSubsonicDatabase()
+    database.create()
+    database.close()
+
+    setup_db(DATABASE_PATH, pragmas=WRITE_PRAGMAS)
+    db.connect()
+
+    start = perf_counter()
+    try:
+        if args.command == "export":
+            header = export_snapshot(args.file)
+        else:
+            header = import_snapshot(args.file, args.replace)
+            checkpoint_db()
+            publish_read_snapshot()
+    except SnapshotError as e:
+        print(e)
+        exit(1)
+
+    for table in header.tables:
+        print(f"{table.name}: {table.rows} rows")
+    print(f"{args.command.capitalize()}ed in {perf_counter() - start:.1f}s")
@@ -1,78 +1,123 @@
-from typing import List, Optional, TypedDict
+from typing import List, Optional
 
 from datetime import datetime
 
+from msgspec import Struct
 from troi.content_resolver.database import db
 
+from .library import ArtistSummary, TagSummary, get_library_state, search_summary
 from .schema import *
 from .session import Session
 
 
-class ArtistMetadata(TypedDict):
-    count: int
-    mbid: str
+class ArtistMetadata(Struct):
     name: str
-    subsonic_id: Optional[str]
+    mbid: str
     subsonic_name: Optional[str]
+    subsonic_id: Optional[str]
+    count: int
 
 
-class TagMetadata(TypedDict):
-    count: int
+class TagMetadata(Struct):
     name: str
+    count: int
 
 
-class Metadata(TypedDict):
+class Metadata(Struct):
     artists: List[ArtistMetadata]
     resolved_recordings: int
     tags: List[TagMetadata]
 
 
+class ArtistPage(Struct):
+    artists: List[ArtistMetadata]
+    total: int
+    limit: int
+    offset: int
+
+
+class TagPage(Struct):
+    tags: List[TagMetadata]
+    total: int
+    limit: int
+    offset: int
+
+
 def get_metadata() -> Metadata:
+    """
+    Get the library statistics. These are materialized at the end of each
+    sync (see refresh_library_stats), so this is just a read of the summaries
+    """
     with db.atomic():
-        query = """
-SELECT name, mbid, subsonic_name, subsonic_id, COUNT(recording_artist.recording_id)
-FROM artist
-JOIN recording_artist
-ON recording_artist.artist_id = artist.mbid
-GROUP BY recording_artist.artist_id"""
-        artists: List[ArtistMetadata] = []
-        cursor = db.execute_sql(query)
-        for name, mbid, subsonic_name, subsonic_id, count in cursor.fetchall():
-            artists.append(
-                {
-                    "name": name,
-                    "mbid": mbid,
-                    "subsonic_name": subsonic_name,
-                    "subsonic_id": subsonic_id,
-                    "count": count,
-                }
-            )
-
-        query = """
-SELECT tag.name, COUNT(tag.id) AS cnt
-FROM tag
-JOIN recording_tag
-ON recording_tag.tag_id = tag.id
-JOIN recording
-ON recording_tag.recording_id = recording.id
-GROUP BY tag.name
-ORDER BY cnt DESC"""
-
-        cursor = db.execute_sql(query)
-
-        tags: List[TagMetadata] = []
-        for rec in cursor.fetchall():
-            tags.append({"name": rec[0], "count": rec[1]})
-
-        resolved_recordings = db.execute_sql(
-            "SELECT COUNT(*) from recording"
-        ).fetchone()[0]
-
-    return {
-        "artists": artists,
-        "resolved_recordings": resolved_recordings,
-        "tags": tags,
-    }
+        artists = [
+            ArtistMetadata(*row)
+            for row in ArtistSummary.select(
+                ArtistSummary.name,
+                ArtistSummary.mbid,
+                ArtistSummary.subsonic_name,
+                ArtistSummary.subsonic_id,
+                ArtistSummary.count,
+            ).tuples()
+        ]
+
+        tags = [
+            TagMetadata(*row)
+            for row in TagSummary.select(TagSummary.name, TagSummary.count)
+            .order_by(TagSummary.count.desc())
+            .tuples()
+        ]
+
+        state = get_library_state()
+
+    return Metadata(
+        artists=artists,
+        resolved_recordings=state.resolved_recordings if state else 0,
+        tags=tags,
+    )
+
+
+def get_artists(query: "LibraryQuery") -> ArtistPage:
+    """
+    Get a page of the library artists, optionally filtered by name
+    """
+    rows, total = search_summary(
+        "artist_summary",
+        query.q,
+        query.match,
+        query.sort,
+        query.order,
+        query.limit,
+        query.offset,
+    )
+
+    return ArtistPage(
+        artists=[ArtistMetadata(*row) for row in rows],
+        total=total,
+        limit=query.limit,
+        offset=query.offset,
+    )
+
+
+def get_tags(query: "LibraryQuery") -> TagPage:
+    """
+    Get a page of the library tags, optionally filtered by name
+    """
+    rows, total = search_summary(
+        "tag_summary",
+        query.q,
+        query.match,
+        query.sort,
+        query.order,
+        query.limit,
+        query.offset,
+    )
+
+    return TagPage(
+        tags=[TagMetadata(*row) for row in rows],
+        total=total,
+        limit=query.limit,
+        offset=query.offset,
+    )
 
 
 ### Session related Routes
@@ -1,8 +1,18 @@
+from typing import Dict, Iterable, List, Optional
+
+from unicodedata import combining, normalize
+
 from peewee import *
 from troi.content_resolver.model.database import db
 from troi.content_resolver.model.recording import Recording
 
-__all__ = ["Artist", "RecordingArtist"]
+__all__ = [
+    "Artist",
+    "RecordingArtist",
+    "find_artist_by_mbid",
+    "find_artist_by_name",
+    "find_recording_artists",
+]
 
 
 class Artist(Model):
@@ -37,3 +47,78 @@ class RecordingArtist(Model):
 
     def __repr__(self) -> str:
         return f"<RecordingArtist('{self.recording}', '{self.artist}')"
+
+
+# Candidates from the name index, most recordings first. These are names that
+# start with the words, which also includes longer names
+FIND_ARTIST_QUERY = """
+SELECT artist.mbid, artist.name, artist.subsonic_name
+FROM artist_fts
+JOIN artist ON artist.rowid = artist_fts.rowid
+LEFT JOIN artist_summary ON artist_summary.mbid = artist.mbid
+WHERE artist_fts MATCH ?
+ORDER BY IFNULL(artist_summary.count, 0) DESC
+"""
+
+
+def normalize_name(name: str) -> str:
+    """
+    Case and accent insensitive form of a name, the same way as artist_fts
+    """
+    decomposed = normalize("NFKD", name.casefold())
+    return " ".join(
+        "".join(char for char in decomposed if not combining(char)).split()
+    )
+
+
+def find_artist_by_name(name: str) -> Optional[tuple[str, str]]:
+    """
+    Find a library artist whose name (or Subsonic name) is name, ignoring
+    case and accents. Returns (name, mbid), or None if there is no such artist
+    """
+    normalized = normalize_name(name)
+    if not any(char.isalnum() for char in normalized):
+        # Nothing for the index to match on
+        return None
+
+    phrase = '^"%s"' % name.replace('"', '""')
+    rows = db.execute_sql(FIND_ARTIST_QUERY, params=(phrase,)).fetchall()
+
+    for mbid, artist_name, subsonic_name in rows:
+        if normalize_name(artist_name) == normalized or (
+            subsonic_name and normalize_name(subsonic_name) == normalized
+        ):
+            return artist_name, mbid
+
+    return None
+
+
+def find_artist_by_mbid(mbid: str) -> Optional[tuple[str, str]]:
+    artist = (
+        Artist.select(Artist.name, Artist.mbid).where(Artist.mbid == mbid).first()
+    )
+    if artist is None:
+        return None
+
+    return artist.name, artist.mbid
+
+
+def find_recording_artists(
+    recording_ids: Iterable[int],
+) -> Dict[int, List[tuple[str, str]]]:
+    """
+    The (mbid, name) of the artists of each recording, in credit order
+    """
+    artists: Dict[int, List[tuple[str, str]]] = {}
+
+    query = (
+        RecordingArtist.select(RecordingArtist.recording, Artist.mbid, Artist.name)
+        .join(Artist)
+        .where(RecordingArtist.recording.in_(list(recording_ids)))
+        .order_by(RecordingArtist.id)
+        .tuples()
+    )
+    for recording_id, mbid, name in query:
+        artists.setdefault(recording_id, []).append((mbid, name))
+
+    return artists
@@ -0,0 +1,39 @@
+from os import environ
+
+from cachelib import BaseCache
+
+CACHE_TYPE = environ.get("CACHE_TYPE", "filesystem")
+CACHE_PATH = environ.get("CACHE_PATH", "./session")
+REDIS_URL = environ.get("REDIS_URL", "http://localhost:6379")
+
+__all__ = ["CACHE_PATH", "CACHE_TYPE", "create_cache", "create_redis"]
+
+
+def create_redis() -> "Redis":
+    from redis import Redis
+
+    return Redis.from_url(REDIS_URL)
+
+
+def create_cache(namespace: str, default_timeout: int = 300) -> "BaseCache":
+    """
+    Create a cache that is shared between all workers, using the same
+    backend as the session storage. Entries are kept separate from the
+    sessions by namespace
+    """
+    if CACHE_TYPE == "filesystem":
+        from cachelib.file import FileSystemCache
+
+        # Keep this out of the session directory, so that pruning one
+        # cache never touches the files of the other
+        return FileSystemCache(
+            f"{CACHE_PATH.rstrip('/')}_{namespace}", default_timeout=default_timeout
+        )
+    else:
+        from cachelib.redis import RedisCache
+
+        return RedisCache(
+            create_redis(),
+            default_timeout=default_timeout,
+            key_prefix=f"{namespace}:",
+        )
@@ -0,0 +1,272 @@
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from os import environ, fstat, makedirs, path, remove, replace, scandir, stat, utime
+from shutil import copyfileobj
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import time
+
+from .custom_connection import CustomConnection
+
+COVER_CACHE_PATH = environ.get("COVER_CACHE_PATH", "./data/covers")
+COVER_CACHE_SIZE_MB = int(environ.get("COVER_CACHE_SIZE_MB", 256))
+COVER_CACHE_TTL_SEC = int(environ.get("COVER_CACHE_TTL_SEC", 7 * 86400))
+COVER_MAX_AGE_SEC = int(environ.get("COVER_MAX_AGE_SEC", 86400))
+
+__all__ = ["COVER_MAX_AGE_SEC", "CoverArt", "CoverArtCache", "CoverArtError"]
+
+
+# (magic bytes, offset, mimetype)
+IMAGE_SIGNATURES: List[Tuple[bytes, int, str]] = [
+    (b"\xff\xd8\xff", 0, "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", 0, "image/png"),
+    (b"GIF8", 0, "image/gif"),
+    (b"WEBP", 8, "image/webp"),
+]
+
+
+class CoverArtError(Exception):
+    pass
+
+
+class CoverArt(NamedTuple):
+    file: BinaryIO
+    mimetype: str
+    etag: str
+    last_modified: float
+
+
+class CoverArtCache:
+    """
+    A bounded, on-disk LRU cache of resized cover art. Files are written once
+    and never modified, so their mtime is the time they were fetched (used for
+    expiry and the ETag). The atime is bumped on every hit, and eviction
+    removes the least recently used files first.
+
+    The cache directory is shared, so every worker can serve covers fetched by
+    any other worker.
+    """
+
+    __slots__ = (
+        "executor",
+        "fetching",
+        "lock",
+        "max_bytes",
+        "path",
+        "size",
+        "total_bytes",
+        "ttl",
+    )
+
+    # Only bump the access time at most this often
+    TOUCH_INTERVAL_SEC = 60
+    # When evicting, go down to this fraction of the maximum size
+    EVICT_RATIO = 0.9
+
+    def __init__(
+        self,
+        cache_path: str = COVER_CACHE_PATH,
+        max_bytes: int = COVER_CACHE_SIZE_MB * 1024 * 1024,
+        ttl: int = COVER_CACHE_TTL_SEC,
+        size: int = 150,
+    ) -> None:
+        self.executor = ThreadPoolExecutor(2)
+        # A lock per cover being fetched, so that requests for the same cover
+        # wait for one fetch instead of each fetching it
+        self.fetching: Dict[str, Lock] = {}
+        self.lock = Lock()
+        self.max_bytes = max_bytes
+        self.path = cache_path
+        self.size = size
+        self.total_bytes: Optional[int] = None
+        self.ttl = ttl
+
+    def _file_path(self, id: str) -> str:
+        key = sha1(f"{id}:{self.size}".encode("utf-8")).hexdigest()
+        return path.join(self.path, key[:2], key)
+
+    def get(self, credentials: Dict[str, str], id: str) -> str:
+        """
+        Get the path to the cached cover art for id, fetching it from the
+        Subsonic server if it is missing or expired
+        """
+        file_path = self._file_path(id)
+
+        try:
+            info = stat(file_path)
+        except FileNotFoundError:
+            info = None
+
+        now = time()
+        if info is not None and now - info.st_mtime < self.ttl:
+            if now - info.st_atime > self.TOUCH_INTERVAL_SEC:
+                try:
+                    utime(file_path, (now, info.st_mtime))
+                except FileNotFoundError:
+                    # Evicted by another worker. It is still fine to try and serve it
+                    pass
+
+            return file_path
+
+        self._fetch_once(credentials, id, file_path)
+        return file_path
+
+    def open_cover(self, credentials: Dict[str, str], id: str) -> CoverArt:
+        """
+        Open the cached cover art for id (see get). The file is only opened
+        once, so it is still served if another worker evicts it meanwhile
+        """
+        file_path = self.get(credentials, id)
+
+        try:
+            file = open(file_path, "rb")
+        except FileNotFoundError:
+            # Evicted by another worker right after it was looked up
+            self._fetch_once(credentials, id, file_path)
+            file = open(file_path, "rb")
+
+        info = fstat(file.fileno())
+        return CoverArt(
+            file=file,
+            mimetype=self.mimetype(file),
+            etag=f"{path.basename(file_path)}-{int(info.st_mtime)}",
+            last_modified=info.st_mtime,
+        )
+
+    def _fetch_once(
+        self, credentials: Dict[str, str], id: str, file_path: str
+    ) -> None:
+        """
+        Fetch a cover, unless another request of this process did while this
+        one waited for it
+        """
+        with self.lock:
+            fetch_lock = self.fetching.get(file_path)
+            if fetch_lock is None:
+                fetch_lock = self.fetching[file_path] = Lock()
+
+        with fetch_lock:
+            try:
+                try:
+                    fresh = time() - stat(file_path).st_mtime < self.ttl
+                except FileNotFoundError:
+                    fresh = False
+
+                if not fresh:
+                    self._fetch(credentials, id, file_path)
+            finally:
+                with self.lock:
+                    if self.fetching.get(file_path) is fetch_lock:
+                        del self.fetching[file_path]
+
+    def _fetch(self, credentials: Dict[str, str], id: str, file_path: str) -> None:
+        conn = CustomConnection(credentials=credentials)
+        resp = conn.getCoverArt(id, self.size)
+
+        # libsonic only rejects JSON/HTML error bodies, so anything else that
+        # is not an image (such as a proxy error page) must not be cached
+        content_type = resp.info().get("Content-Type", "")
+        if resp.getcode() != 200 or not content_type.startswith("image/"):
+            resp.close()
+            raise CoverArtError(
+                f"Cover art {id} is not an image ({resp.getcode()}, {content_type})"
+            )
+
+        makedirs(path.dirname(file_path), exist_ok=True)
+
+        # Write to a temporary file first, so that no reader sees a partial
+        # image. The name is unique across threads and workers, and starts
+        # with a dot so that eviction skips it
+        try:
+            with NamedTemporaryFile(
+                dir=path.dirname(file_path), prefix=".", suffix=".tmp", delete=False
+            ) as file:
+                tmp_path = file.name
+                copyfileobj(resp, file)
+                written = file.tell()
+        finally:
+            resp.close()
+
+        try:
+            replace(tmp_path, file_path)
+        except BaseException:
+            remove(tmp_path)
+            raise
+
+        self._account(written)
+
+    def _account(self, written: int) -> None:
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += written
+
+            if self.total_bytes is None or self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """
+        Scan the cache directory and remove the least recently used files
+        until the cache is under the limit. The directory is shared between
+        workers, so the size is always recomputed from disk here
+        """
+        entries: List[Tuple[float, int, str]] = []
+        total = 0
+
+        for shard in scandir(self.path):
+            if not shard.is_dir():
+                continue
+
+            for entry in scandir(shard.path):
+                if entry.name.startswith("."):
+                    continue
+
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                entries.append((info.st_atime, info.st_size, entry.path))
+                total += info.st_size
+
+        if total > self.max_bytes:
+            entries.sort()
+            target = self.max_bytes * self.EVICT_RATIO
+
+            for _, size, file_path in entries:
+                if total <= target:
+                    break
+
+                try:
+                    remove(file_path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+        self.total_bytes = total
+
+    def prefetch(self, credentials: Dict[str, str], ids: Iterable[str]) -> None:
+        """
+        Fetch cover art for ids in the background, skipping anything that
+        is already cached
+        """
+        for id in ids:
+            self.executor.submit(self._prefetch_one, credentials, id)
+
+    def _prefetch_one(self, credentials: Dict[str, str], id: str) -> None:
+        try:
+            self.get(credentials, id)
+        except BaseException as e:
+            print(f"Failed to prefetch cover art {id}: {e}")
+
+    @staticmethod
+    def mimetype(file: BinaryIO) -> str:
+        header = file.read(12)
+        file.seek(0)
+
+        for signature, offset, mimetype in IMAGE_SIGNATURES:
+            if header[offset : offset + len(signature)] == signature:
+                return mimetype
+
+        return "application/octet-stream"
@@ -0,0 +1,100 @@
+from typing import Dict, Optional, Union
+
+from hashlib import sha256
+from hmac import new as hmac_new
+from os import environ, link, makedirs, path, remove
+from secrets import token_bytes
+from tempfile import NamedTemporaryFile
+
+from .cache import create_cache
+
+CREDENTIAL_CACHE_TTL_SEC = int(environ.get("CREDENTIAL_CACHE_TTL_SEC", 300))
+CREDENTIAL_CACHE_FAILURE_TTL_SEC = int(
+    environ.get("CREDENTIAL_CACHE_FAILURE_TTL_SEC", 10)
+)
+CREDENTIAL_SECRET_PATH = environ.get(
+    "CREDENTIAL_SECRET_PATH", "./data/credential.secret"
+)
+
+__all__ = ["CredentialCache"]
+
+
+def _load_secret() -> bytes:
+    """
+    The key for hashing credentials: SECRET_KEY if set, or else a random
+    secret created once in CREDENTIAL_SECRET_PATH, shared by all processes
+    """
+    secret = environ.get("SECRET_KEY")
+    if secret:
+        return secret.encode("utf-8")
+
+    directory = path.dirname(CREDENTIAL_SECRET_PATH) or "."
+    makedirs(directory, exist_ok=True)
+
+    if not path.exists(CREDENTIAL_SECRET_PATH):
+        # Linking a complete file fails if another process was first, so
+        # every process ends up reading the same secret
+        with NamedTemporaryFile(dir=directory, delete=False) as file:
+            file.write(token_bytes(32))
+
+        try:
+            link(file.name, CREDENTIAL_SECRET_PATH)
+        except FileExistsError:
+            pass
+        finally:
+            remove(file.name)
+
+    with open(CREDENTIAL_SECRET_PATH, "rb") as file:
+        return file.read()
+
+
+class CredentialCache:
+    """
+    A short-lived cache of credentials that were checked against the
+    Subsonic server. Successful checks are stored as True, and rejected
+    credentials as the error message from the server.
+
+    Only an HMAC of the credentials is used as the key, never the credentials.
+    The secret keeps plain passwords (u/p) from being brute forced offline
+    from the keys, which are stored in the shared cache
+    """
+
+    __slots__ = ("cache", "secret")
+
+    def __init__(self) -> None:
+        self.cache = create_cache("credentials")
+        self.secret = _load_secret()
+
+    def _key(self, credentials: Dict[str, str]) -> str:
+        digest = hmac_new(self.secret, digestmod=sha256)
+        for key in sorted(credentials):
+            digest.update(f"{key}\0{credentials[key]}\0".encode("utf-8"))
+
+        return digest.hexdigest()
+
+    def get(self, credentials: Dict[str, str]) -> Optional[Union[bool, str]]:
+        """
+        Returns True if the credentials were recently verified, the error
+        message if they were recently rejected, and None if unknown
+        """
+        return self.cache.get(self._key(credentials))
+
+    def set_verified(self, credentials: Dict[str, str]) -> None:
+        self.cache.set(self._key(credentials), True, CREDENTIAL_CACHE_TTL_SEC)
+
+    def set_rejected(self, credentials: Dict[str, str], error: str) -> None:
+        self.cache.set(
+            self._key(credentials), error, CREDENTIAL_CACHE_FAILURE_TTL_SEC
+        )
+
+    def get_admin(self, credentials: Dict[str, str]) -> Optional[bool]:
+        """
+        Whether the user of these credentials was recently found to be a
+        Subsonic admin, or None if unknown
+        """
+        return self.cache.get(f"admin:{self._key(credentials)}")
+
+    def set_admin(self, credentials: Dict[str, str], admin: bool) -> None:
+        self.cache.set(
+            f"admin:{self._key(credentials)}", admin, CREDENTIAL_CACHE_TTL_SEC
+        )
@@ -1,9 +1,19 @@
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Union
 
 from hashlib import md5
-from os import environ
+from os import environ, getpid
+from threading import Lock
+from time import sleep
+from urllib.error import HTTPError
+from urllib.request import Request
 
 from libsonic import Connection
+from msgspec import json
+from urllib3 import BaseHTTPResponse, PoolManager, Retry, Timeout, disable_warnings
+from urllib3.exceptions import HTTPError as TransportError, InsecureRequestWarning
+from urllib3.util import make_headers
+
+from .metrics import time_subsonic_request
 
 SUBSONIC_BASE_URL = environ["SUBSONIC_URL"]
 SUBSONIC_PORT = environ["SUBSONIC_PORT"]
@@ -11,7 +21,146 @@ SUBSONIC_PATH = environ.get("SUBSONIC_PATH", "/rest")
 ENABLE_SELF_SIGNED = environ.get("SUBSONIC_SELF_SIGNED", False)
 LEGACY_AUTH = environ.get("SUBSONIC_LEGACY", False)
 
-__all__ = ["CustomConnection"]
+SUBSONIC_POOL_SIZE = int(environ.get("SUBSONIC_POOL_SIZE", 10))
+SUBSONIC_CONNECT_TIMEOUT_SEC = float(environ.get("SUBSONIC_CONNECT_TIMEOUT_SEC", 5))
+SUBSONIC_READ_TIMEOUT_SEC = float(environ.get("SUBSONIC_READ_TIMEOUT_SEC", 60))
+
+SUBSONIC_PLAYLIST_BATCH_SIZE = int(environ.get("SUBSONIC_PLAYLIST_BATCH_SIZE", 250))
+SUBSONIC_PLAYLIST_RETRIES = int(environ.get("SUBSONIC_PLAYLIST_RETRIES", 2))
+
+__all__ = ["CustomConnection", "PlaylistUpdateError"]
+
+
+class PlaylistUpdateError(Exception):
+    """
+    A playlist was only partially written. playlist_id is None if the
+    playlist could not be created at all
+    """
+
+    def __init__(
+        self, playlist_id: Optional[str], added: int, total: int, cause: Exception
+    ) -> None:
+        super().__init__(
+            f"Added {added} of {total} songs to playlist {playlist_id}: {cause}"
+            if playlist_id
+            else f"Could not create playlist: {cause}"
+        )
+        self.playlist_id = playlist_id
+        self.added = added
+        self.total = total
+
+
+def _is_retryable(error: Exception) -> bool:
+    # Timeouts, dropped connections and server errors. Anything else (such
+    # as a Subsonic error response) will fail the same way again
+    if isinstance(error, HTTPError):
+        return error.code >= 500
+
+    return isinstance(error, TransportError)
+
+
+class PooledResponse:
+    """
+    The parts of a urllib response that libsonic (and the cover art cache)
+    use. The connection goes back to the pool once the body is fully read
+    """
+
+    __slots__ = ("_response",)
+
+    def __init__(self, response: "BaseHTTPResponse") -> None:
+        self._response = response
+
+    @property
+    def msg(self) -> str:
+        return self._response.reason or ""
+
+    @property
+    def status(self) -> int:
+        return self._response.status
+
+    def getcode(self) -> int:
+        return self._response.status
+
+    def info(self):
+        return self._response.headers
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        data = self._response.read(amt)
+        if amt is None or not data:
+            self._response.release_conn()
+        return data
+
+    def close(self) -> None:
+        if self._response.connection is not None:
+            # The body was not fully read, so the connection can not be reused
+            self._response.close()
+            self._response.release_conn()
+
+
+class PooledOpener:
+    """
+    A replacement for the urllib opener used by libsonic. Requests go through
+    a keep-alive connection pool, which is shared by every connection in this
+    process (and per server, as urllib3 pools per host)
+    """
+
+    _lock = Lock()
+    _pid: Optional[int] = None
+    _pool: Optional["PoolManager"] = None
+
+    HEADERS = make_headers(accept_encoding=True, keep_alive=True)
+
+    # Only retry when the request was never sent; most Subsonic calls are POST
+    RETRIES = Retry(connect=2, read=0, redirect=3, status=0, other=0)
+    TIMEOUT = Timeout(
+        connect=SUBSONIC_CONNECT_TIMEOUT_SEC, read=SUBSONIC_READ_TIMEOUT_SEC
+    )
+
+    @classmethod
+    def pool(cls) -> "PoolManager":
+        # Sockets must not be shared with forked processes (gunicorn workers)
+        pid = getpid()
+        if cls._pid != pid:
+            with cls._lock:
+                if cls._pid != pid:
+                    if ENABLE_SELF_SIGNED:
+                        cert_reqs = "CERT_NONE"
+                        disable_warnings(InsecureRequestWarning)
+                    else:
+                        cert_reqs = "CERT_REQUIRED"
+
+                    cls._pool = PoolManager(
+                        maxsize=SUBSONIC_POOL_SIZE,
+                        cert_reqs=cert_reqs,
+                        retries=cls.RETRIES,
+                        timeout=cls.TIMEOUT,
+                    )
+                    cls._pid = pid
+
+        return cls._pool
+
+    def open(self, req: "Request") -> PooledResponse:
+        headers = {**self.HEADERS, **dict(req.header_items())}
+        if req.data is not None:
+            headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+
+        response = self.pool().request(
+            req.get_method(),
+            req.full_url,
+            body=req.data,
+            headers=headers,
+            preload_content=False,
+        )
+
+        if response.status >= 400:
+            # Same as urllib, which libsonic expects
+            response.drain_conn()
+            response.release_conn()
+            raise HTTPError(
+                req.full_url, response.status, response.reason, response.headers, None
+            )
+
+        return PooledResponse(response)
 
 
 class CustomConnection(Connection):
@@ -62,3 +211,100 @@ class CustomConnection(Connection):
             "c": self._appName,
             **self._credentials,
         }
+
+    def _getOpener(self, username, passwd):
+        return PooledOpener()
+
+    def _doInfoReq(self, req):
+        with time_subsonic_request(req.full_url):
+            res = self._opener.open(req)
+            return json.decode(res.read())["subsonic-response"]
+
+    def _doBinReq(self, req):
+        with time_subsonic_request(req.full_url):
+            return super()._doBinReq(req)
+
+    def _retryPlaylistWrite(
+        self,
+        playlistId: str,
+        write,
+        added: Optional[int] = None,
+        batch_size: int = 0,
+    ) -> None:
+        """
+        Write one batch to a playlist. When appending (added is the number
+        of songs before), a write that failed may still have been applied
+        (e.g. a read timeout), so the playlist is checked before trying
+        again, to avoid adding the same songs twice
+        """
+        for attempt in range(SUBSONIC_PLAYLIST_RETRIES + 1):
+            try:
+                write()
+                return
+            except Exception as e:
+                if attempt == SUBSONIC_PLAYLIST_RETRIES or not _is_retryable(e):
+                    raise
+
+                sleep(0.5 * (attempt + 1))
+                if added is None:
+                    continue
+
+                count = self.getPlaylist(playlistId)["playlist"].get("songCount", 0)
+                if count == added + batch_size:
+                    return
+                if count != added:
+                    raise RuntimeError(
+                        f"playlist has {count} songs after a failed update, "
+                        f"expected {added}"
+                    ) from e
+
+    def createPlaylistInBatches(
+        self,
+        songIds: List[Union[str, int]],
+        name: Optional[str] = None,
+        playlistId: Optional[str] = None,
+    ) -> str:
+        """
+        Create a playlist (name), or replace the songs of one (playlistId),
+        without putting every song id in a single request. The first batch
+        is sent with createPlaylist, and the rest are appended in batches.
+        Returns the playlist id, or raises PlaylistUpdateError with how many
+        songs were added
+        """
+        size = SUBSONIC_PLAYLIST_BATCH_SIZE
+        first = songIds[:size]
+
+        if playlistId is None:
+            # Creating is not idempotent, so this is not retried
+            try:
+                playlistId = self.createPlaylist(name=name, songIds=first)[
+                    "playlist"
+                ]["id"]
+            except Exception as e:
+                raise PlaylistUpdateError(None, 0, len(songIds), e) from e
+        else:
+            try:
+                # Replacing the songs can simply be repeated
+                self._retryPlaylistWrite(
+                    playlistId,
+                    lambda: self.createPlaylist(playlistId=playlistId, songIds=first),
+                )
+            except Exception as e:
+                raise PlaylistUpdateError(playlistId, 0, len(songIds), e) from e
+
+        added = len(first)
+        for start in range(size, len(songIds), size):
+            batch = songIds[start : start + size]
+            try:
+                self._retryPlaylistWrite(
+                    playlistId,
+                    lambda: self.updatePlaylist(playlistId, songIdsToAdd=batch),
+                    added,
+                    len(batch),
+                )
+            except Exception as e:
+                raise PlaylistUpdateError(playlistId, added, len(songIds), e) from e
+
+            added += len(batch)
+
+        return playlistId
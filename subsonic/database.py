@@ -4,8 +4,19 @@ from troi.content_resolver.database import db
 from troi.content_resolver.subsonic import SubsonicDatabase
 
 from .artist import Artist, RecordingArtist
+from .fingerprint import create_fingerprint_column
+from .library import (
+    ArtistSummary,
+    LibraryState,
+    TagSummary,
+    create_library_indexes,
+    get_library_state,
+    refresh_library_stats,
+)
 from .rating import create_rating_table
-from .session import Session
+from .read_snapshot import ensure_read_snapshot
+from .session import Session, SessionPool, SessionPoolRecording, SessionPrefetch
+from .similarity import ArtistSimilarity, SimilarityFetch
 
 DATABASE_PATH = environ["DATABASE_PATH"]
 
@@ -20,5 +31,33 @@ class ArtistSubsonicDatabase(SubsonicDatabase):
     def create(self):
         super().create()
         # Additional tables we want to keep track of resolved artists
-        db.create_tables((Artist, RecordingArtist, Session))
+        db.create_tables(
+            (
+                Artist,
+                RecordingArtist,
+                Session,
+                SessionPrefetch,
+                SessionPool,
+                SessionPoolRecording,
+                ArtistSummary,
+                TagSummary,
+                LibraryState,
+                ArtistSimilarity,
+                SimilarityFetch,
+            )
+        )
         create_rating_table(db)
+        create_fingerprint_column(db)
+        create_library_indexes()
+
+        # Existing libraries from before the summary tables were added
+        if get_library_state() is None:
+            refresh_library_stats()
+
+        # After any migration, so that readers see the new schema
+        ensure_read_snapshot()
+
+    def close(self):
+        # Close pooled connections too, not just return them to the pool.
+        # Otherwise, they could be inherited by forked workers
+        db.close_all()
@@ -0,0 +1,44 @@
+from typing import Optional
+
+from hashlib import blake2b
+
+__all__ = ["create_fingerprint_column", "song_fingerprint"]
+
+# The Subsonic song fields that an incremental sync can update in the recording
+# table (directly, or as a fallback when ListenBrainz does not have them). The
+# title and duration of a recording come from ListenBrainz (a fallback duration
+# cannot be told apart from it), so they are only refreshed by a full sync
+FINGERPRINT_FIELDS = ("album", "artist", "track", "discNumber")
+
+FINGERPRINT_COLUMN_QUERY = """
+SELECT 1 FROM pragma_table_info('recording') WHERE name = 'fingerprint'
+"""
+
+ADD_FINGERPRINT_COLUMN_QUERY = """
+ALTER TABLE recording ADD COLUMN fingerprint INTEGER
+"""
+
+
+def song_fingerprint(song: dict) -> int:
+    """
+    A 64-bit hash of the stored fields of a Subsonic song, to tell whether
+    any of them changed since the last sync. Fits in a SQLite INTEGER
+    """
+    digest = blake2b(digest_size=8)
+    for field in FINGERPRINT_FIELDS:
+        value: Optional[object] = song.get(field)
+        digest.update(b"" if value is None else str(value).encode("utf-8"))
+        digest.update(b"\x1f")
+
+    return int.from_bytes(digest.digest(), "big", signed=True)
+
+
+def create_fingerprint_column(db):
+    """
+    The recording table belongs to troi, so the column is added separately
+    (and to existing databases). Existing rows have no fingerprint, and are
+    refreshed by the next sync
+    """
+    with db.atomic():
+        if db.execute_sql(FINGERPRINT_COLUMN_QUERY).fetchone() is None:
+            db.execute_sql(ADD_FINGERPRINT_COLUMN_QUERY)
@@ -0,0 +1,234 @@
+from typing import List, Optional
+
+from datetime import datetime
+
+from peewee import *
+from troi.content_resolver.model.database import db
+
+__all__ = [
+    "ArtistSummary",
+    "LibraryState",
+    "TagSummary",
+    "create_library_indexes",
+    "get_library_state",
+    "refresh_library_stats",
+    "search_summary",
+]
+
+
+class LibraryState(Model):
+    """
+    A single row describing the library as of the last sync. The version is
+    incremented every time the library statistics are refreshed
+    """
+
+    class Meta:
+        database = db
+        table_name = "library_state"
+
+    id = IntegerField(primary_key=True)
+    version = IntegerField(null=False, default=0)
+    resolved_recordings = IntegerField(null=False, default=0)
+    last_updated = DateTimeField(null=False)
+
+    @property
+    def etag(self) -> str:
+        return f"{self.version}-{int(self.last_updated.timestamp())}"
+
+    def __repr__(self) -> str:
+        return f"<LibraryState({self.version}, {self.resolved_recordings})>"
+
+
+class ArtistSummary(Model):
+    """
+    Materialized number of recordings per artist
+    """
+
+    class Meta:
+        database = db
+        table_name = "artist_summary"
+
+    mbid = TextField(primary_key=True)
+    name = TextField(null=False)
+    subsonic_name = TextField(null=True)
+    subsonic_id = TextField(null=True)
+    count = IntegerField(null=False)
+
+    def __repr__(self) -> str:
+        return f"<ArtistSummary('{self.mbid}', '{self.name}', {self.count})>"
+
+
+class TagSummary(Model):
+    """
+    Materialized number of recordings per tag
+    """
+
+    class Meta:
+        database = db
+        table_name = "tag_summary"
+
+    name = TextField(primary_key=True)
+    count = IntegerField(null=False)
+
+    def __repr__(self) -> str:
+        return f"<TagSummary('{self.name}', {self.count})>"
+
+
+REFRESH_ARTIST_SUMMARY_QUERY = """
+INSERT INTO artist_summary (mbid, name, subsonic_name, subsonic_id, count)
+SELECT mbid, name, subsonic_name, subsonic_id, COUNT(recording_artist.recording_id)
+FROM artist
+JOIN recording_artist
+ON recording_artist.artist_id = artist.mbid
+GROUP BY recording_artist.artist_id"""
+
+REFRESH_TAG_SUMMARY_QUERY = """
+INSERT INTO tag_summary (name, count)
+SELECT tag.name, COUNT(tag.id) AS cnt
+FROM tag
+JOIN recording_tag
+ON recording_tag.tag_id = tag.id
+JOIN recording
+ON recording_tag.recording_id = recording.id
+GROUP BY tag.name
+ORDER BY cnt DESC"""
+
+BUMP_LIBRARY_VERSION_QUERY = """
+INSERT INTO library_state (id, version, resolved_recordings, last_updated)
+VALUES (1, 1, (SELECT COUNT(*) FROM recording), ?)
+ON CONFLICT(id) DO UPDATE SET
+    version = version + 1,
+    resolved_recordings = excluded.resolved_recordings,
+    last_updated = excluded.last_updated
+"""
+
+
+# Prefix search and sorting use the (case insensitive) name and count indexes.
+# Substring search uses trigram indexes of the names. Artist names in prompts
+# are resolved with a word index, ignoring case and accents
+CREATE_LIBRARY_INDEXES = [
+    """
+CREATE INDEX IF NOT EXISTS artist_summary_name
+ON artist_summary (name COLLATE NOCASE)""",
+    "CREATE INDEX IF NOT EXISTS artist_summary_count ON artist_summary (count)",
+    """
+CREATE INDEX IF NOT EXISTS tag_summary_name
+ON tag_summary (name COLLATE NOCASE)""",
+    "CREATE INDEX IF NOT EXISTS tag_summary_count ON tag_summary (count)",
+    """
+CREATE VIRTUAL TABLE IF NOT EXISTS artist_summary_fts
+USING fts5(name, content='artist_summary', tokenize='trigram')""",
+    """
+CREATE VIRTUAL TABLE IF NOT EXISTS tag_summary_fts
+USING fts5(name, content='tag_summary', tokenize='trigram')""",
+    """
+CREATE VIRTUAL TABLE IF NOT EXISTS artist_fts
+USING fts5(
+    name, subsonic_name, content='artist', tokenize='unicode61 remove_diacritics 2'
+)""",
+]
+
+# These only index their content table when rebuilt
+FTS_TABLES = ("artist_summary_fts", "tag_summary_fts", "artist_fts")
+
+REBUILD_FTS_QUERY = "INSERT INTO {table} ({table}) VALUES ('rebuild')"
+
+SUMMARY_COLUMNS = {
+    "artist_summary": "name, mbid, subsonic_name, subsonic_id, count",
+    "tag_summary": "name, count",
+}
+
+# Trigram search needs at least three characters
+MIN_TRIGRAM_LENGTH = 3
+
+
+FTS_EXISTS_QUERY = """
+SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({})
+""".format(", ".join(f"'{table}'" for table in FTS_TABLES))
+
+
+def create_library_indexes() -> None:
+    with db.atomic():
+        existing = {name for (name,) in db.execute_sql(FTS_EXISTS_QUERY).fetchall()}
+
+        for query in CREATE_LIBRARY_INDEXES:
+            db.execute_sql(query)
+
+        # Libraries from before the search indexes were added
+        for table in FTS_TABLES:
+            if table not in existing:
+                db.execute_sql(REBUILD_FTS_QUERY.format(table=table))
+
+
+def refresh_library_stats() -> None:
+    """
+    Recompute the artist/tag summaries and bump the library version.
+    This should be called whenever a sync finishes
+    """
+    with db.atomic():
+        ArtistSummary.delete().execute()
+        db.execute_sql(REFRESH_ARTIST_SUMMARY_QUERY)
+
+        TagSummary.delete().execute()
+        db.execute_sql(REFRESH_TAG_SUMMARY_QUERY)
+
+        for table in FTS_TABLES:
+            db.execute_sql(REBUILD_FTS_QUERY.format(table=table))
+
+        db.execute_sql(BUMP_LIBRARY_VERSION_QUERY, params=(datetime.now(),))
+
+
+def get_library_state() -> Optional[LibraryState]:
+    return LibraryState.get_or_none(LibraryState.id == 1)
+
+
+def search_summary(
+    table: str,
+    q: Optional[str],
+    match: str,
+    sort: str,
+    order: str,
+    limit: int,
+    offset: int,
+) -> tuple[List[tuple], int]:
+    """
+    Get a page of artist_summary or tag_summary rows, optionally filtered by
+    a case insensitive prefix or substring of the name. Returns the rows
+    (in SUMMARY_COLUMNS order) and the total number of matching rows
+    """
+    conditions: List[str] = []
+    params: List[str] = []
+
+    if q:
+        if match == "prefix":
+            conditions.append("name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE")
+            params += [q, q + "\U0010ffff"]
+        elif len(q) >= MIN_TRIGRAM_LENGTH:
+            conditions.append(
+                f"rowid IN (SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH ?)"
+            )
+            params.append('"%s"' % q.replace('"', '""'))
+        else:
+            conditions.append("instr(lower(name), lower(?)) > 0")
+            params.append(q)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    column = "name COLLATE NOCASE" if sort == "name" else "count"
+    direction = "DESC" if order == "desc" else "ASC"
+
+    # Ties are broken by rowid, which every index includes
+    rows = db.execute_sql(
+        f"""
+SELECT {SUMMARY_COLUMNS[table]}
+FROM {table}
+{where}
+ORDER BY {column} {direction}, rowid {direction}
+LIMIT ? OFFSET ?""",
+        params=[*params, limit, offset],
+    ).fetchall()
+
+    (total,) = db.execute_sql(
+        f"SELECT COUNT(*) FROM {table} {where}", params=params
+    ).fetchone()
+
+    return rows, total
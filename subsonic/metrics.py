@@ -0,0 +1,207 @@
+from typing import Callable, Dict, Optional
+
+from contextlib import contextmanager
+from fcntl import LOCK_EX, LOCK_NB, flock
+from itertools import count
+from os import environ, getpid, makedirs, path, remove, scandir
+from re import compile
+from time import perf_counter
+from urllib.parse import urlsplit
+
+METRICS_PATH = environ.get("METRICS_PATH")
+METRICS_ENABLED = bool(METRICS_PATH)
+# /metrics is only served to requests with this bearer token
+METRICS_TOKEN = environ.get("METRICS_TOKEN")
+
+# Metrics are aggregated across processes through files in METRICS_PATH.
+# This has to be configured before prometheus_client is imported. Child
+# processes inherit the environment, so they write to the same directory
+if METRICS_ENABLED:
+    environ["PROMETHEUS_MULTIPROC_DIR"] = METRICS_PATH
+    makedirs(METRICS_PATH, exist_ok=True)
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    values,
+)
+
+__all__ = [
+    "CONTENT_TYPE_LATEST",
+    "METRICS_ENABLED",
+    "METRICS_TOKEN",
+    "RADIO_REQUEST_SECONDS",
+    "RADIO_SUBPROCESS_SECONDS",
+    "SQLITE_QUERY_SECONDS",
+    "SUBSONIC_REQUEST_SECONDS",
+    "SYNC_RUNS",
+    "SYNC_SONGS",
+    "UPSTREAM_REQUEST_SECONDS",
+    "instrument_requests",
+    "render_metrics",
+    "reset_metrics",
+    "time_subsonic_request",
+]
+
+
+def _slot_identifier(prefix: str) -> Callable[[], str]:
+    """
+    By default, every process writes its own metric files. The radio and
+    sync subprocesses are short lived, so this would leave an ever growing
+    number of files. Instead, each of these processes locks a numbered slot,
+    and a later process reuses the files of a slot once it is free again
+    (the values carry over, which is what counters and histograms need)
+    """
+    state: Dict[str, object] = {"pid": None, "id": None, "file": None}
+
+    def identifier() -> str:
+        pid = getpid()
+        if state["pid"] != pid:
+            for slot in count():
+                lock_file = open(path.join(METRICS_PATH, f"{prefix}_{slot}.lock"), "a")
+                try:
+                    flock(lock_file, LOCK_EX | LOCK_NB)
+                except BlockingIOError:
+                    lock_file.close()
+                    continue
+
+                # Keep the file open (and locked) until this process exits
+                state.update(pid=pid, id=f"{prefix}_{slot}", file=lock_file)
+                break
+
+        return state["id"]
+
+    return identifier
+
+
+METRICS_SLOT = environ.get("METRICS_SLOT")
+
+if METRICS_ENABLED and METRICS_SLOT:
+    values.ValueClass = values.MultiProcessValue(_slot_identifier(METRICS_SLOT))
+
+
+RADIO_REQUEST_SECONDS = Histogram(
+    "radio_request_seconds",
+    "Latency of /api/radio requests",
+    ["mode", "prompt_type"],
+    buckets=(0.5, 1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120),
+)
+RADIO_SUBPROCESS_SECONDS = Histogram(
+    "radio_subprocess_seconds",
+    "Duration of the get_radio subprocess",
+    ["status"],
+    buckets=(0.5, 1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120),
+)
+SUBSONIC_REQUEST_SECONDS = Histogram(
+    "subsonic_request_seconds",
+    "Latency of requests to the Subsonic server",
+    ["endpoint"],
+)
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    "upstream_request_seconds",
+    "Latency of requests to ListenBrainz/MusicBrainz",
+    ["service", "endpoint", "status"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32),
+)
+SQLITE_QUERY_SECONDS = Histogram(
+    "sqlite_query_seconds",
+    "Execution time of SQLite statements",
+    ["statement"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+SYNC_RUNS = Counter(
+    "sync_runs",
+    "Number of library syncs",
+    ["full", "result"],
+)
+SYNC_SONGS = Counter(
+    "sync_songs",
+    "Number of songs processed by the library sync",
+    ["action"],
+)
+
+
+@contextmanager
+def time_subsonic_request(url: str):
+    endpoint = path.basename(urlsplit(url).path).removesuffix(".view")
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        SUBSONIC_REQUEST_SECONDS.labels(endpoint).observe(perf_counter() - start)
+
+
+MBID_REGEX = compile(
+    r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"
+)
+
+UPSTREAM_SERVICES = {
+    "api.listenbrainz.org": "listenbrainz",
+    "labs.api.listenbrainz.org": "listenbrainz-labs",
+    "musicbrainz.org": "musicbrainz",
+}
+
+
+def instrument_requests() -> None:
+    """
+    Time every request to ListenBrainz/MusicBrainz made through requests.
+    This covers both Troi's own lookups and our patched elements
+    """
+    from requests import Session
+
+    if getattr(Session.send, "_instrumented", False):
+        return
+
+    send = Session.send
+
+    def timed_send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        service = UPSTREAM_SERVICES.get(parts.hostname)
+        if service is None:
+            return send(self, request, **kwargs)
+
+        status = "error"
+        start = perf_counter()
+        try:
+            response = send(self, request, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            # Collapse MBIDs in the path (MusicBrainz lookups) to keep the label small
+            endpoint = MBID_REGEX.sub("{mbid}", parts.path)
+            UPSTREAM_REQUEST_SECONDS.labels(service, endpoint, status).observe(
+                perf_counter() - start
+            )
+
+    timed_send._instrumented = True
+    Session.send = timed_send
+
+
+def reset_metrics() -> None:
+    """
+    Remove metric files left over from a previous run. This must only be
+    called once, before any worker is started
+    """
+    if not METRICS_ENABLED:
+        return
+
+    for entry in scandir(METRICS_PATH):
+        if entry.name.endswith(".db"):
+            remove(entry.path)
+
+
+def render_metrics() -> Optional[bytes]:
+    """
+    Render the metrics of every process in the Prometheus text format
+    """
+    if not METRICS_ENABLED:
+        return None
+
+    from prometheus_client.multiprocess import MultiProcessCollector
+
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    return generate_latest(registry)
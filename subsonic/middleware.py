@@ -1,24 +1,51 @@
+from typing import Type
+
 from functools import wraps
+from hmac import compare_digest
+from threading import Lock
 
 from flask import request, session
+from libsonic.errors import SonicError
 from troi.content_resolver.database import db
 from troi.content_resolver.model.database import setup_db
 
 
+from .credential_cache import CredentialCache
 from .custom_connection import CustomConnection
 from .database import DATABASE_PATH
+from .metrics import METRICS_TOKEN
+from .read_snapshot import READ_SNAPSHOT
 from .schema import *
 
+# The standard query parameters of Subsonic clients: credentials, the API
+# version, the client name and the response format
+SUBSONIC_PARAMS = {"u", "t", "s", "p", "v", "c", "f"}
+
+credential_cache = CredentialCache()
+database_lock = Lock()
+
 
 def get_database(func):
     @wraps(func)
     def database_wrapper(*args, **kwargs):
+        # The database is only initialized once per process. Closing returns
+        # the connection to the pool, so later requests reuse it. A worker
+        # forked after ArtistSubsonicDatabase.create() inherits a database
+        # set up without the read snapshot, so that counts as uninitialized
+        if db.deferred or db.read_snapshot is not READ_SNAPSHOT:
+            with database_lock:
+                if db.deferred or db.read_snapshot is not READ_SNAPSHOT:
+                    setup_db(DATABASE_PATH, read_snapshot=READ_SNAPSHOT)
+
+        # The connection state is per thread, so concurrent requests each get
+        # their own pooled connection. Only the outermost wrapper on a thread
+        # returns it, in case a wrapped function calls another one
+        opened = db.connect(reuse_if_open=True)
         try:
-            setup_db(DATABASE_PATH)
-            db.connect()
             return func(*args, **kwargs)
         finally:
-            db.close()
+            if opened:
+                db.close()
 
     return database_wrapper
 
@@ -45,25 +72,116 @@ def login_or_credentials_required(func):
                 return {"error": "not authenticated"}, 401
             credentials = {"u": user, "p": password}
 
-        conn = CustomConnection(credentials=credentials)
-        try:
-            ok = conn.ping()
-            if ok:
-                return func(*args, **kwargs, credentials=credentials)
-        except BaseException as e:
-            print(e)
-            return {"error": str(e)}, 401
+        verified = credential_cache.get(credentials)
+
+        if verified is None:
+            conn = CustomConnection(credentials=credentials)
+            try:
+                verified = conn.ping()
+            except SonicError as e:
+                # The server rejected these credentials. Remember that for a
+                # short while, so repeated attempts do not reach the server
+                credential_cache.set_rejected(credentials, str(e))
+                return {"error": str(e)}, 401
+            except BaseException as e:
+                print(e)
+                return {"error": str(e)}, 401
+
+            # A failed ping is an unreachable server, not a verdict on the
+            # credentials, so only successes are cached
+            if verified:
+                credential_cache.set_verified(credentials)
+        elif verified is not True:
+            return {"error": verified}, 401
+
+        if verified:
+            return func(credentials, *args, **kwargs)
 
         return {"error": "not authenticated"}, 401
 
     return is_authorized
 
 
-def validate_schema(schema: "base_schema"):
+def admin_required(func):
+    """
+    Only let Subsonic admins through. This goes after
+    login_or_credentials_required, which passes the credentials
+    """
+
+    @wraps(func)
+    def is_admin(credentials, *args, **kwargs):
+        admin = credential_cache.get_admin(credentials)
+
+        if admin is None:
+            conn = CustomConnection(credentials=credentials)
+            try:
+                user = conn.getUser(credentials["u"])["user"]
+            except BaseException as e:
+                print(e)
+                return {"error": str(e)}, 403
+
+            admin = bool(user.get("adminRole"))
+            credential_cache.set_admin(credentials, admin)
+
+        if not admin:
+            return {"error": "admin only"}, 403
+
+        return func(credentials, *args, **kwargs)
+
+    return is_admin
+
+
+def metrics_token_required(func):
+    """
+    Only let requests with the METRICS_TOKEN bearer token through. Nothing
+    is, if it is not set
+    """
+
+    @wraps(func)
+    def has_token(*args, **kwargs):
+        if not METRICS_TOKEN:
+            return {"error": "METRICS_TOKEN is not set"}, 403
+
+        authorization = request.headers.get("Authorization", "")
+        if not compare_digest(
+            authorization.encode("utf-8"), f"Bearer {METRICS_TOKEN}".encode("utf-8")
+        ):
+            return {"error": "not authenticated"}, 401
+
+        return func(*args, **kwargs)
+
+    return has_token
+
+
+def validate_query(schema: "Type[base_schema]"):
     def decorator(func):
         @wraps(func)
         def validate(*args, **kwargs):
-            json = schema.Schema().load(request.json)
+            # Credentials (and the other Subsonic parameters that come with
+            # them) are not part of the query schema
+            params = {
+                key: value
+                for key, value in request.args.items()
+                if key not in SUBSONIC_PARAMS
+            }
+
+            # Query string values are all strings, so allow "10" for an int
+            query = convert(params, schema, strict=False)
+            return func(*args, **kwargs, query=query)
+
+        return validate
+
+    return decorator
+
+
+def validate_schema(schema: "Type[base_schema]"):
+    def decorator(func):
+        @wraps(func)
+        def validate(*args, **kwargs):
+            if not request.is_json:
+                return {"error": "expected a JSON body"}, 415
+
+            json = decode(schema, request.get_data())
             return func(*args, **kwargs, json=json)
 
         return validate
@@ -1,12 +1,24 @@
 from collections import defaultdict
 
+from peewee import OperationalError
 from troi.content_resolver import artist_search
 from troi.content_resolver.model.database import db
 from troi.content_resolver.model.recording import FileIdType
 from troi.content_resolver.utils import select_recordings_on_popularity
 
+from subsonic.similarity import (
+    SimilarityGraph,
+    get_cached_similar_artists,
+    store_similar_artists,
+)
+
+from .exclude import exclusion_clause
+from .timing import stage
+
 __all__ = ["MultivaluedLocalRecordingSearchByArtistService"]
 
+similarity_graph = SimilarityGraph()
+
 
 class MultivaluedLocalRecordingSearchByArtistService(
     artist_search.LocalRecordingSearchByArtistService
@@ -16,8 +28,29 @@ class MultivaluedLocalRecordingSearchByArtistService(
     1. Actually respect max_similar_artists (and when 0, don't fetch at all)
     2. Add the artist being searched to the list of artist mbids
     3. Use multivalued join (singe we have those)
+    4. Skip excluded recordings in the query itself
+    5. Store similar artists, and (for medium/hard) also use artists that are
+       similar to similar artists, from what is stored
     """
 
+    # How many hops from the seed artist to go in the similarity graph
+    MAX_HOPS = {"easy": 1, "medium": 2, "hard": 3}
+    MAX_EXPANDED_ARTISTS = 100
+
+    def get_similar_artists(self, artist_mbid):
+        similar_artists = get_cached_similar_artists(artist_mbid)
+        if similar_artists is not None:
+            return similar_artists
+
+        similar_artists = super().get_similar_artists(artist_mbid)
+        try:
+            store_similar_artists(artist_mbid, similar_artists)
+        except OperationalError as e:
+            # Most likely, a sync is writing. This is only a cache
+            print(e)
+
+        return similar_artists
+
     def search(
         self,
         mode,
@@ -44,7 +77,8 @@ class MultivaluedLocalRecordingSearchByArtistService(
         """
 
         if max_similar_artists > 0:
-            similar_artists = self.get_similar_artists(artist_mbid)
+            with stage("ArtistSearch.similar_artists"):
+                similar_artists = self.get_similar_artists(artist_mbid)
         else:
             similar_artists = []
 
@@ -58,16 +92,37 @@ class MultivaluedLocalRecordingSearchByArtistService(
                      JOIN recording_artist
                        ON recording_artist.recording_id = recording.id
                     WHERE artist_id in (%s)
+                      AND %s
                  ORDER BY artist_id
                         , pop"""
 
         artist_mbids = [artist["artist_mbid"] for artist in similar_artists]
+
+        hops = self.MAX_HOPS.get(mode, 1)
+        if max_similar_artists > 0 and hops > 1:
+            with stage("ArtistSearch.expand"):
+                known = set(artist_mbids)
+                known.add(artist_mbid)
+                artist_mbids += [
+                    mbid
+                    for mbid, _ in similarity_graph.expand(
+                        artist_mbid, hops, self.MAX_EXPANDED_ARTISTS
+                    )
+                    if mbid not in known
+                ]
+
         artist_mbids.append(artist_mbid)
         placeholders = ",".join(("?",) * len(artist_mbids))
-        cursor = db.execute_sql(query % placeholders, params=artist_mbids)
+
+        with stage("ArtistSearch.query"):
+            cursor = db.execute_sql(
+                query % (placeholders, exclusion_clause("recording_mbid")),
+                params=artist_mbids,
+            )
+            rows = cursor.fetchall()
 
         artists = defaultdict(list)
-        for popularity, recording_mbid, artist_mbid, file_id in cursor.fetchall():
+        for popularity, recording_mbid, artist_mbid, file_id in rows:
             artists[artist_mbid].append(
                 {
                     "popularity": popularity,
@@ -1,20 +1,156 @@
-from typing import Dict, List
+from typing import Dict, Iterator, List, NamedTuple, Optional
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
 from random import randint
 
-from troi import Recording
+from troi import Element, Recording
+from troi.content_resolver.model.database import db
 from troi.patches.lb_radio_classes.blend import WeighAndBlendRecordingsElement
 
-__all__ = ["WeightAndBlendAllowExcessArtistsToHitTarget"]
+from .timing import stage
+
+__all__ = [
+    "BlendCandidates",
+    "WeightAndBlendAllowExcessArtistsToHitTarget",
+    "blend_candidates",
+]
+
+# The maximum number of prompt terms (sources) generated at the same time
+# for one radio. 1 generates them one after another
+RADIO_MAX_PARALLEL_SOURCES = int(environ.get("RADIO_MAX_PARALLEL_SOURCES", 4))
+
+
+class BlendCandidates(NamedTuple):
+    weights: List[int]
+    # The recording MBIDs of each source, in order
+    sources: List[List[str]]
+
+
+blend_candidates: List[BlendCandidates] = []
+"""
+The candidates of every blend generated by this process, before blending.
+Session radios keep them as their pool
+"""
+
+
+class _SourcePatch:
+    """
+    The patch as seen by a source generated in its own thread. Everything is
+    shared with the patch, except the lists that elements append their
+    description and user feedback to, so that these can be merged back in
+    the order of the sources rather than the order the threads finish in
+    """
+
+    def __init__(self, patch) -> None:
+        self.patch = patch
+        self.local_storage = dict(patch.local_storage)
+
+        if "data_cache" in self.local_storage:
+            self.local_storage["data_cache"] = dict(
+                self.local_storage["data_cache"], **{"element-descriptions": []}
+            )
+        if "user_feedback" in self.local_storage:
+            self.local_storage["user_feedback"] = []
+
+    def __getattr__(self, name):
+        return getattr(self.patch, name)
+
+    def merge(self) -> None:
+        shared = self.patch.local_storage
+
+        if "data_cache" in shared:
+            shared["data_cache"]["element-descriptions"].extend(
+                self.local_storage["data_cache"]["element-descriptions"]
+            )
+        if "user_feedback" in shared:
+            shared["user_feedback"].extend(self.local_storage["user_feedback"])
+
+
+def _elements(element: "Element") -> Iterator["Element"]:
+    yield element
+    for source in element.sources:
+        yield from _elements(source)
+
+
+def _generate_in_thread(source: "Element", quiet) -> Optional[List["Recording"]]:
+    try:
+        return source.generate(quiet)
+    finally:
+        # Return the connection of this thread to the pool
+        if not db.is_closed():
+            db.close()
 
 
 class WeightAndBlendAllowExcessArtistsToHitTarget(WeighAndBlendRecordingsElement):
-    """This is a patched blend that allows duplicate artists"""
+    """
+    This is a patched blend that allows duplicate artists. It also generates
+    its sources (one per prompt term) concurrently, since each of them is
+    mostly waiting on ListenBrainz lookups
+    """
 
     MAX_DEPTH = 15
 
+    def generate_sources(self, quiet) -> List[Optional[List["Recording"]]]:
+        workers = min(RADIO_MAX_PARALLEL_SOURCES, len(self.sources))
+        if workers < 2:
+            return [source.generate(quiet) for source in self.sources]
+
+        patches = [_SourcePatch(source.patch) for source in self.sources]
+        for source, patch in zip(self.sources, patches):
+            for element in _elements(source):
+                element.set_patch_object(patch)
+
+        try:
+            with ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="radio-source"
+            ) as executor:
+                futures = [
+                    executor.submit(_generate_in_thread, source, quiet)
+                    for source in self.sources
+                ]
+
+                # Keep the order of the sources, which matches the weights
+                results = []
+                for future, patch in zip(futures, patches):
+                    results.append(future.result())
+                    patch.merge()
+
+                return results
+        finally:
+            for source, patch in zip(self.sources, patches):
+                for element in _elements(source):
+                    element.set_patch_object(patch.patch)
+
+    def generate(self, quiet):
+        with stage(type(self).__name__):
+            # Sources running in other threads record their own stages, so
+            # this is the time spent waiting on them
+            with stage("Blend.sources"):
+                source_lists = self.generate_sources(quiet)
+
+            # The rest (checking the outputs of the sources, reading and
+            # logging) is Troi's, which generates each source itself
+            for source, result in zip(self.sources, source_lists):
+                source.generate = lambda quiet, result=result: result
+
+            try:
+                return super().generate(quiet)
+            finally:
+                for source in self.sources:
+                    del source.generate
+
     def read(self, entities: List[List["Recording"]], depth=0):
+        if depth == 0:
+            # Reading consumes the lists (and weights)
+            blend_candidates.append(
+                BlendCandidates(
+                    list(self.weights),
+                    [[rec.mbid for rec in result] for result in entities],
+                )
+            )
+
         total_available = sum([len(e) for e in entities])
 
         # prepare the weights
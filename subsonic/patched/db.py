@@ -1,13 +1,204 @@
-from playhouse.sqlite_ext import SqliteExtDatabase
+from os import environ
+from time import perf_counter
 
+from playhouse.pool import PooledSqliteExtDatabase
+
+from subsonic.metrics import SQLITE_QUERY_SECONDS
+from subsonic.slow_query import (
+    SLOW_QUERY_ENABLED,
+    SLOW_QUERY_THRESHOLD_SEC,
+    record_slow_query,
+)
+
+SQLITE_BUSY_TIMEOUT_MS = int(environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_CACHE_SIZE_MB = int(environ.get("SQLITE_CACHE_SIZE_MB", 32))
+SQLITE_MMAP_SIZE_MB = int(environ.get("SQLITE_MMAP_SIZE_MB", 256))
+SQLITE_POOL_SIZE = int(environ.get("SQLITE_POOL_SIZE", 8))
+
+# Pragmas for the web workers and radio generation. These are mostly reads,
+# with the occasional small write (sessions)
 PRAGMAS = (
     ("foreign_keys", 1),
     ("journal_mode", "WAL"),
+    ("busy_timeout", SQLITE_BUSY_TIMEOUT_MS),
+    # Negative cache size is in KiB, rather than pages
+    ("cache_size", -SQLITE_CACHE_SIZE_MB * 1024),
+    ("mmap_size", SQLITE_MMAP_SIZE_MB * 1024 * 1024),
+    ("synchronous", "NORMAL"),
+    ("temp_store", "MEMORY"),
 )
 
-db = SqliteExtDatabase(None, pragmas=PRAGMAS)
+# Pragmas for the library sync, which does large batches of writes.
+# Auto checkpoints are made much less frequent, and the sync checkpoints
+# explicitly once it is done (see checkpoint_db)
+WRITE_PRAGMAS = (
+    ("foreign_keys", 1),
+    ("journal_mode", "WAL"),
+    ("busy_timeout", SQLITE_BUSY_TIMEOUT_MS * 6),
+    ("cache_size", -SQLITE_CACHE_SIZE_MB * 4 * 1024),
+    ("mmap_size", SQLITE_MMAP_SIZE_MB * 1024 * 1024),
+    ("synchronous", "NORMAL"),
+    ("temp_store", "MEMORY"),
+    ("wal_autocheckpoint", 10000),
+)
+
+
+class InstrumentedSqliteDatabase(PooledSqliteExtDatabase):
+    """
+    A pooled SQLite database which records the execution time of every statement,
+    and logs slow statements with their query plan (if SLOW_QUERY_LOG is set)
+    """
+
+    # Set by setup_db for readers (see subsonic.read_snapshot)
+    read_snapshot = None
+
+    def _initialize_connection(self, conn):
+        super()._initialize_connection(conn)
+
+        # Every time a connection is taken from the pool, so that it moves to
+        # the latest snapshot between requests
+        if self.read_snapshot is not None:
+            self.read_snapshot.attach(conn)
+
+    def execute_sql(self, sql, params=None, commit=None):
+        start = perf_counter()
+        try:
+            cursor = super().execute_sql(sql, params, commit)
+        except BaseException:
+            _record_statement(self.connection, sql, params, perf_counter() - start)
+            raise
+
+        # Statements without rows are done. Otherwise, SQLite only ran up to
+        # the first row, so the time spent fetching the rest is added too
+        if cursor.description is None:
+            _record_statement(self.connection, sql, params, perf_counter() - start)
+            return cursor
+
+        return TimedCursor(cursor, sql, params, perf_counter() - start)
+
+
+def _record_statement(get_connection, sql: str, params, duration: float) -> None:
+    """
+    get_connection returns the connection the statement ran on, and is only
+    called for slow statements (to explain them). It is None when the
+    connection must not be used, and slow statements are then logged without
+    a plan (unless one is known already)
+    """
+    statement = sql.lstrip().split(None, 1)[0].upper()
+    SQLITE_QUERY_SECONDS.labels(statement).observe(duration)
+
+    if SLOW_QUERY_ENABLED and duration >= SLOW_QUERY_THRESHOLD_SEC:
+        connection = get_connection() if get_connection is not None else None
+        record_slow_query(connection, sql, params, duration)
+
+
+class TimedCursor:
+    """
+    A cursor which adds the time spent fetching rows to the execution time of
+    its statement, and records the total once every row was fetched or the
+    cursor is closed. A cursor discarded before that is recorded when it is
+    garbage collected, but without explaining it: that may happen on another
+    thread, or once the connection went back to the pool or was closed
+    """
+
+    __slots__ = "cursor", "duration", "params", "recorded", "sql"
 
+    def __init__(self, cursor, sql: str, params, duration: float) -> None:
+        self.cursor = cursor
+        self.duration = duration
+        self.params = params
+        self.recorded = False
+        self.sql = sql
 
-def setup_db(db_file):
+    def _finish(self, explain: bool = True) -> None:
+        if not self.recorded:
+            self.recorded = True
+            _record_statement(
+                (lambda: self.cursor.connection) if explain else None,
+                self.sql,
+                self.params,
+                self.duration,
+            )
+
+    def fetchone(self):
+        start = perf_counter()
+        row = self.cursor.fetchone()
+        self.duration += perf_counter() - start
+
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        start = perf_counter()
+        rows = self.cursor.fetchmany(self.cursor.arraysize if size is None else size)
+        self.duration += perf_counter() - start
+
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = perf_counter()
+        rows = self.cursor.fetchall()
+        self.duration += perf_counter() - start
+
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self) -> None:
+        self._finish()
+        self.cursor.close()
+
+    def __del__(self) -> None:
+        try:
+            self._finish(explain=False)
+        except Exception:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+# Connections are returned to the pool on close, so each worker (and thread)
+# reuses an open connection with its page cache instead of reopening the file.
+# A connection is only used by one thread at a time, but a released connection
+# may be picked up by another thread, hence check_same_thread
+db = InstrumentedSqliteDatabase(
+    None,
+    pragmas=PRAGMAS,
+    max_connections=SQLITE_POOL_SIZE,
+    stale_timeout=300,
+    timeout=10,
+    check_same_thread=False,
+    # For read snapshots, which are attached with URI parameters. Plain paths
+    # are still opened as is
+    uri=True,
+)
+
+
+def setup_db(db_file, pragmas=None, read_snapshot=None):
     global db
-    db.init(db_file)
+
+    # Pooled connections belong to the previous file/pragmas
+    if not db.deferred:
+        db.close_all()
+
+    db.init(db_file, pragmas=pragmas)
+    db.read_snapshot = read_snapshot
+
+
+def checkpoint_db():
+    """
+    Fold the WAL back into the database, and truncate it
+    """
+    db.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
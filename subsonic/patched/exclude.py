@@ -1,6 +1,159 @@
-from typing import Set, Union
+from typing import List, Set, Union
+
+from troi.content_resolver.model.database import db
+
+__all__ = [
+    "excluded_mbids",
+    "excluded_recording_ids",
+    "exclusion_clause",
+    "filter_excluded",
+]
 
 excluded_mbids: Set[Union[str, int]] = set()
 """
 A global set used to store ids to exclude from search
 """
+
+excluded_recording_ids: Set[int] = set()
+"""
+A global set of local recording ids (recording.id) to exclude from search
+"""
+
+CREATE_EXCLUDED_TABLE = """
+CREATE TEMP TABLE IF NOT EXISTS excluded_recording (
+    recording_mbid TEXT NOT NULL PRIMARY KEY
+) WITHOUT ROWID
+"""
+
+CREATE_EXCLUDED_ID_TABLE = """
+CREATE TEMP TABLE IF NOT EXISTS excluded_recording_id (
+    id INTEGER NOT NULL PRIMARY KEY
+)
+"""
+
+# The set each temporary table was filled from, as a digest
+CREATE_DIGEST_TABLE = """
+CREATE TEMP TABLE IF NOT EXISTS excluded_digest (
+    name TEXT NOT NULL PRIMARY KEY,
+    digest INTEGER NOT NULL
+)
+"""
+
+SELECT_DIGEST_QUERY = "SELECT digest FROM temp.excluded_digest WHERE name = ?"
+
+STORE_DIGEST_QUERY = """
+INSERT OR REPLACE INTO temp.excluded_digest (name, digest) VALUES (?, ?)
+"""
+
+INSERT_EXCLUDED_QUERY = """
+INSERT OR IGNORE INTO temp.excluded_recording (recording_mbid) VALUES (?)
+"""
+
+INSERT_EXCLUDED_ID_QUERY = """
+INSERT OR IGNORE INTO temp.excluded_recording_id (id) VALUES (?)
+"""
+
+EXCLUDED_BY_ID_QUERY = """
+SELECT recording_mbid
+FROM recording
+WHERE id IN (SELECT id FROM temp.excluded_recording_id)
+AND recording_mbid IN (%s)
+"""
+
+BATCH_SIZE = 500
+
+
+def _set_digest(values: Set) -> int:
+    # Order independent, so equal sets match however they were built
+    return hash(frozenset(values))
+
+
+def _is_current(table: str, digest: int) -> bool:
+    """
+    Whether a temporary table holds the set with this digest, recording the
+    digest if not (the caller refills the table)
+    """
+    row = db.execute_sql(SELECT_DIGEST_QUERY, params=(table,)).fetchone()
+    if row is not None and row[0] == digest:
+        return True
+
+    db.execute_sql(STORE_DIGEST_QUERY, params=(table, digest))
+    return False
+
+
+def _load_excluded_table() -> None:
+    """
+    Mirror excluded_mbids and excluded_recording_ids into temporary tables on
+    the current connection. Temporary tables are per connection, and pooled
+    connections outlive a radio, so this is checked on every use and only
+    refilled when the contents are a different set
+    """
+    db.execute_sql(CREATE_EXCLUDED_TABLE)
+    db.execute_sql(CREATE_EXCLUDED_ID_TABLE)
+    db.execute_sql(CREATE_DIGEST_TABLE)
+
+    with db.atomic():
+        if not _is_current("excluded_recording", _set_digest(excluded_mbids)):
+            db.execute_sql("DELETE FROM temp.excluded_recording")
+            db.cursor().executemany(
+                INSERT_EXCLUDED_QUERY, ((mbid,) for mbid in excluded_mbids)
+            )
+
+        if not _is_current(
+            "excluded_recording_id", _set_digest(excluded_recording_ids)
+        ):
+            db.execute_sql("DELETE FROM temp.excluded_recording_id")
+            db.cursor().executemany(
+                INSERT_EXCLUDED_ID_QUERY, ((id,) for id in excluded_recording_ids)
+            )
+
+
+def exclusion_clause(column: str, id_column: str = "recording.id") -> str:
+    """
+    Return a SQL condition which removes excluded recordings, where column
+    is the recording mbid column of the query (and id_column the recording
+    id). This allows candidate queries to only return recordings that are
+    eligible, instead of filtering them after the fact
+    """
+    conditions: List[str] = []
+
+    if excluded_mbids or excluded_recording_ids:
+        _load_excluded_table()
+
+    if excluded_mbids:
+        conditions.append(
+            f"{column} NOT IN (SELECT recording_mbid FROM temp.excluded_recording)"
+        )
+    if excluded_recording_ids:
+        conditions.append(
+            f"{id_column} NOT IN (SELECT id FROM temp.excluded_recording_id)"
+        )
+
+    return " AND ".join(conditions) or "1"
+
+
+def filter_excluded(recordings: list) -> list:
+    """
+    Remove excluded recordings from candidates that did not come from the
+    local database (so were not filtered by exclusion_clause)
+    """
+    if excluded_mbids:
+        recordings = [rec for rec in recordings if rec.mbid not in excluded_mbids]
+
+    if excluded_recording_ids and recordings:
+        _load_excluded_table()
+
+        excluded: Set[str] = set()
+        for start in range(0, len(recordings), BATCH_SIZE):
+            mbids = [rec.mbid for rec in recordings[start : start + BATCH_SIZE]]
+            params = ", ".join(["?"] * len(mbids))
+            excluded.update(
+                mbid
+                for (mbid,) in db.execute_sql(
+                    EXCLUDED_BY_ID_QUERY % params, params=mbids
+                )
+            )
+
+        recordings = [rec for rec in recordings if rec.mbid not in excluded]
+
+    return recordings
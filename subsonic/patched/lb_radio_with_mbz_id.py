@@ -1,35 +1,49 @@
-from time import sleep
-
+from peewee import OperationalError
 from requests import Session
+from urllib.parse import quote
 from uuid import UUID
 
 from troi.patches import lb_radio
 
+from subsonic.artist import find_artist_by_mbid, find_artist_by_name
+
+from .timing import stage
+
 session = Session()
 session.headers.update({'User-Agent': 'Troi Subsonic Generator/1'})
 
 class LBRadioNamedLookup(lb_radio.LBRadioPatch):
+    def create(self, inputs):
+        """ Parse the prompt and build the pipeline (this includes artist lookups) """
+
+        with stage("LBRadioPatch.create"):
+            return super().create(inputs)
+
     def lookup_artist(self, artist_name):
-        """ Fetch artist names for validation purposes """
+        """ Fetch artist names for validation purposes. Library artists are found locally """
 
         if isinstance(artist_name, UUID):
             return self.lookup_artist_from_mbid(artist_name)
 
-        err_msg = f"Artist {artist_name} could not be looked up. Please use exact spelling."
+        try:
+            local = find_artist_by_name(artist_name)
+        except OperationalError as e:
+            # e.g. a library from before the name index. MusicBrainz still works
+            print(e)
+            local = None
 
-        while True:
-            r = session.get( f"https://musicbrainz.org/ws/2/artist?query={quote(artist_name)}&fmt=json")
-            if r.status_code == 404:
-                raise RuntimeError(err_msg)
+        if local is not None:
+            return local
 
-            if r.status_code == 429:
-                sleep(2)
-                continue
+        err_msg = f"Artist {artist_name} could not be looked up. Please use exact spelling."
 
-            if r.status_code != 200:
-                raise RuntimeError( f"Could not resolve artist name {artist_name}. Error {r.status_code} {r.text}")
+        # Rate limits and failures are retried by the shared upstream client
+        r = session.get( f"https://musicbrainz.org/ws/2/artist?query={quote(artist_name)}&fmt=json")
+        if r.status_code == 404:
+            raise RuntimeError(err_msg)
 
-            break
+        if r.status_code != 200:
+            raise RuntimeError( f"Could not resolve artist name {artist_name}. Error {r.status_code} {r.text}")
 
         data = r.json()
         try:
@@ -46,18 +60,15 @@ class LBRadioNamedLookup(lb_radio.LBRadioPatch):
     def lookup_artist_from_mbid(self, artist_mbid):
         """ Fetch artist names for validation purposes """
 
-        while True:
-            r = session.get(f"https://musicbrainz.org/ws/2/artist/%s?fmt=json" % str(artist_mbid))
-            if r.status_code == 404:
-                raise RuntimeError(f"Could not resolve artist mbid {artist_mbid}. Error {r.status_code} {r.text}")
-
-            if r.status_code in (429, 503):
-                sleep(2)
-                continue
+        local = find_artist_by_mbid(str(artist_mbid))
+        if local is not None:
+            return local[0], artist_mbid
 
-            if r.status_code != 200:
-                raise RuntimeError(f"Could not resolve artist name {artist_mbid}. Error {r.status_code} {r.text}")
+        r = session.get(f"https://musicbrainz.org/ws/2/artist/%s?fmt=json" % str(artist_mbid))
+        if r.status_code == 404:
+            raise RuntimeError(f"Could not resolve artist mbid {artist_mbid}. Error {r.status_code} {r.text}")
 
-            break
+        if r.status_code != 200:
+            raise RuntimeError(f"Could not resolve artist name {artist_mbid}. Error {r.status_code} {r.text}")
 
         return r.json()["name"], artist_mbid
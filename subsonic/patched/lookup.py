@@ -1,6 +1,6 @@
 from troi.musicbrainz.recording_lookup import Playlist, RecordingLookupElement
 
-from .exclude import excluded_mbids
+from .exclude import filter_excluded
 
 __all__ = ["BatchedLookupWithExclude"]
 
@@ -14,8 +14,9 @@ class BatchedLookupWithExclude(RecordingLookupElement):
         else:
             recordings = inputs[0]
 
-        if excluded_mbids:
-            recordings = [rec for rec in recordings if rec.mbid not in excluded_mbids]
+        # Local candidates are already filtered in SQL. This catches
+        # recordings from sources that do not go through the local database
+        recordings = filter_excluded(recordings)
 
         if len(recordings) > self.BATCH_SIZE:
             output = []
@@ -1,5 +1,5 @@
-from troi.content_resolver import artist_search
-from troi import filters, playlist
+from troi.content_resolver import artist_search, tag_search
+from troi import Element, filters, playlist
 from troi.musicbrainz import recording_lookup as rl
 from troi.patches import lb_radio as lbr
 from troi.patches.lb_radio_classes import blend
@@ -9,14 +9,22 @@ from .blend import WeightAndBlendAllowExcessArtistsToHitTarget
 from .hated_filter import HatedSubsonicRecordingsFilterElement
 from .lookup import BatchedLookupWithExclude
 from .playlist import PlaylistElement
+from .tag_search import LocalRecordingSearchByTagServiceWithExclude
 from .lb_radio_with_mbz_id import LBRadioNamedLookup
+from .timing import timed_generate
 
 artist_search.LocalRecordingSearchByArtistService = (
     MultivaluedLocalRecordingSearchByArtistService
 )
+tag_search.LocalRecordingSearchByTagService = (
+    LocalRecordingSearchByTagServiceWithExclude
+)
 blend.WeighAndBlendRecordingsElement = WeightAndBlendAllowExcessArtistsToHitTarget
 filters.HatedRecordingsFilterElement = HatedSubsonicRecordingsFilterElement
 playlist.PlaylistElement = PlaylistElement
 rl.RecordingLookupElement = BatchedLookupWithExclude
 lbr.LBRadioPatch = LBRadioNamedLookup
 lbr.WeighAndBlendRecordingsElement = WeightAndBlendAllowExcessArtistsToHitTarget
+
+# Time every element of the pipeline
+Element.generate = timed_generate
@@ -0,0 +1,40 @@
+from troi.content_resolver import tag_search
+
+from .exclude import exclusion_clause
+from .timing import stage
+
+__all__ = ["LocalRecordingSearchByTagServiceWithExclude"]
+
+
+class LocalRecordingSearchByTagServiceWithExclude(
+    tag_search.LocalRecordingSearchByTagService
+):
+    """
+    A patched TagSearch service which skips excluded recordings in the
+    query, rather than after popularity selection.
+    """
+
+    @staticmethod
+    def _with_exclusion(pop_clause: str) -> str:
+        condition = exclusion_clause("recording_mbid")
+
+        if pop_clause:
+            return f"{pop_clause} AND {condition}"
+
+        return f"WHERE {condition}"
+
+    def search(self, tags, operator, pop_begin, pop_end, num_recordings):
+        with stage("TagSearch.search"):
+            return super().search(tags, operator, pop_begin, pop_end, num_recordings)
+
+    def or_search(self, tags, min_popularity=None, max_popularity=None):
+        query, params, pop_clause = super().or_search(
+            tags, min_popularity, max_popularity
+        )
+        return query, params, self._with_exclusion(pop_clause)
+
+    def and_search(self, tags, min_popularity=None, max_popularity=None):
+        query, params, pop_clause = super().and_search(
+            tags, min_popularity, max_popularity
+        )
+        return query, params, self._with_exclusion(pop_clause)
@@ -0,0 +1,113 @@
+from typing import Dict, List, NotRequired, TypedDict
+
+import tracemalloc
+
+from contextlib import contextmanager
+from threading import Lock, local
+from time import perf_counter
+
+from troi import Element
+
+__all__ = ["StageTiming", "get_stages", "reset_stages", "stage", "timed_generate"]
+
+
+class StageTiming(TypedDict):
+    name: str
+    calls: int
+    seconds: float
+    peak_kib: NotRequired[int]
+
+
+_local = local()
+_lock = Lock()
+# name -> [seconds, calls, peak memory]
+_stages: Dict[str, List[float]] = {}
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block of code as the stage name. Stages may be nested; the time
+    spent in a nested stage is only counted towards the innermost one, so
+    the sum of all stages is the total time spent.
+
+    If tracemalloc is tracing, this also records the peak memory allocated
+    during the stage (including nested stages)
+    """
+    stack: List[List[float]] = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            # Keep the peak of the enclosing stage before resetting it
+            stack[-1][2] = max(stack[-1][2], peak)
+        tracemalloc.reset_peak()
+    else:
+        current = 0
+
+    # Time spent in nested stages, memory at start, peak memory
+    frame = [0.0, current, current]
+    stack.append(frame)
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        stack.pop()
+        if stack:
+            stack[-1][0] += elapsed
+
+        peak = 0
+        if tracing:
+            frame[2] = max(frame[2], tracemalloc.get_traced_memory()[1])
+            peak = frame[2] - frame[1]
+            if stack:
+                stack[-1][2] = max(stack[-1][2], frame[2])
+
+        with _lock:
+            totals = _stages.setdefault(name, [0.0, 0, 0])
+            totals[0] += elapsed - frame[0]
+            totals[1] += 1
+            totals[2] = max(totals[2], peak)
+
+
+_generate = Element.generate
+
+
+def timed_generate(self: "Element", quiet):
+    """
+    A replacement for Element.generate, which times every pipeline element
+    (excluding the time spent generating its sources)
+    """
+    with stage(type(self).__name__):
+        return _generate(self, quiet)
+
+
+def get_stages() -> List[StageTiming]:
+    """
+    Get the time spent in each stage, slowest first
+    """
+    tracing = tracemalloc.is_tracing()
+    stages: List[StageTiming] = []
+
+    with _lock:
+        for name, (seconds, calls, peak) in _stages.items():
+            timing = StageTiming(
+                name=name, calls=int(calls), seconds=round(seconds, 4)
+            )
+            if tracing:
+                timing["peak_kib"] = int(peak) // 1024
+
+            stages.append(timing)
+
+    stages.sort(key=lambda item: item["seconds"], reverse=True)
+    return stages
+
+
+def reset_stages() -> None:
+    with _lock:
+        _stages.clear()
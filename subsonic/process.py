@@ -5,7 +5,8 @@ from concurrent.futures import ThreadPoolExecutor
 from json import dumps
 from multiprocessing import Array
 from os import environ
-from subprocess import PIPE, Popen
+from subprocess import PIPE, Popen, run
+from threading import Lock
 
 
 class ScanState(TypedDict):
@@ -14,10 +15,17 @@ class ScanState(TypedDict):
 
 
 class MetadataHandler:
+    """
+    Runs the library sync in the background, one at a time. The handler is
+    created before the workers are forked, and the scan state lives in shared
+    memory, so every worker (and every request thread) sees the same scan,
+    and only one can be started across all of them
+    """
+
     __slots__ = "executor", "scanStatus"
 
     def __init__(self) -> None:
-        self.executor = ThreadPoolExecutor(1)
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="metadata-sync")
         self.scanStatus: SynchronizedArray[int] = Array("L", [0, 0])
 
         super().__init__()
@@ -31,11 +39,22 @@ class MetadataHandler:
             if self.scanStatus[1]:
                 return False
 
-            self.executor.submit(self.scan, full, credentials)
             self.scanStatus[0] = 0
             self.scanStatus[1] = 1
 
-            return True
+        try:
+            self.executor.submit(self.scan, full, credentials)
+        except RuntimeError:
+            # The worker is shutting down
+            self._set_state(0, False)
+            raise
+
+        return True
+
+    def _set_state(self, fetched: int, scanning: bool) -> None:
+        with self.scanStatus.get_lock():
+            self.scanStatus[0] = fetched
+            self.scanStatus[1] = int(scanning)
 
     def scan(self, is_full: bool, credentials: Dict[str, str]) -> None:
         args = ["python3", "database_sync.py"]
@@ -44,21 +63,77 @@ class MetadataHandler:
 
         env = environ.copy()
         env["SUBSONIC_CREDENTIALS"] = dumps(credentials)
-        process = Popen(args, stdout=PIPE, stderr=PIPE, env=env)
+        env["METRICS_SLOT"] = "sync"
 
-        self.scanStatus[0] = 0
-        self.scanStatus[1] = 1
+        # Always clear the scanning flag, even if the sync could not be started
+        # or failed. Otherwise, no worker could ever start another one
+        fetched = 0
+        try:
+            process = Popen(args, stdout=PIPE, stderr=PIPE, env=env)
 
-        while True:
-            line = process.stdout.readline()
+            while True:
+                line = process.stdout.readline()
 
-            if not line:
-                break
+                if not line:
+                    break
 
-            self.scanStatus[0] = int(line)
+                try:
+                    fetched = int(line)
+                except ValueError:
+                    continue
 
-        errors = process.stderr.readlines()
+                self.scanStatus[0] = fetched
 
-        if errors:
-            print("\n".join([error.decode() for error in errors]))
-        self.scanStatus[1] = False
+            errors = process.stderr.readlines()
+            process.wait()
+
+            if errors:
+                print("\n".join([error.decode() for error in errors]))
+        except OSError as e:
+            print(e)
+        finally:
+            self._set_state(fetched, False)
+
+
+class SessionPrefetcher:
+    """
+    Generates the next batch of session radios in the background (see
+    prefetch_radio in get_radio.py), one at a time per worker. If a session
+    is queued again before its turn, only the latest request is used
+    """
+
+    __slots__ = "executor", "lock", "pending"
+
+    def __init__(self) -> None:
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="session-prefetch")
+        self.lock = Lock()
+        self.pending: Dict[int, bytes] = {}
+
+    def submit(self, session_id: int, data: bytes) -> None:
+        """
+        Queue a prefetch. data is the encoded CreateRadioWithCredentials
+        """
+        with self.lock:
+            queued = session_id in self.pending
+            self.pending[session_id] = data
+
+        if not queued:
+            self.executor.submit(self.prefetch, session_id)
+
+    def prefetch(self, session_id: int) -> None:
+        with self.lock:
+            data = self.pending.pop(session_id)
+
+        try:
+            output = run(
+                ["python3", "get_radio.py"],
+                capture_output=True,
+                input=data,
+                env={**environ, "METRICS_SLOT": "radio"},
+            )
+        except OSError as e:
+            print(e)
+            return
+
+        if output.returncode != 0:
+            print(output.stderr.decode(errors="replace"))
@@ -0,0 +1,302 @@
+from typing import Dict, List, NamedTuple, Optional, Sequence, Union
+
+from os import environ
+
+from msgspec import UNSET, Struct, UnsetType
+from troi import (
+    TARGET_NUMBER_OF_RECORDINGS,
+    Artist,
+    ArtistCredit,
+    Playlist,
+    Recording,
+    Release,
+)
+
+from .artist import find_recording_artists
+from .custom_connection import CustomConnection
+from .patched.blend import WeightAndBlendAllowExcessArtistsToHitTarget
+from .patched.playlist import PlaylistElement
+from .patched.timing import StageTiming, stage
+from .recording_ids import decode_recording_ids, find_recording_ids
+from .schema import CreateRadioWithCredentials, decode
+from .session import PoolRecording, Session, load_pool, prefetch_key, take_prefetch
+
+PROXY_IMAGES = environ.get("PROXY_IMAGES", "").lower() == "true"
+RADIO_SESSION_POOL = environ.get("RADIO_SESSION_POOL", "true").lower() == "true"
+
+__all__ = [
+    "MbzData",
+    "RADIO_SESSION_POOL",
+    "PoolBatch",
+    "RadioInfo",
+    "RecordingData",
+    "continue_session",
+    "format_radio",
+    "load_session",
+    "sample_pool",
+    "take_prefetched",
+    "update_session",
+]
+
+# The blend at the end of LBRadioPatch
+BLEND_MAX_RECORDINGS = 100
+BLEND_MAX_ARTIST_OCCURRENCE = 3
+
+
+class MbzData(Struct):
+    mbid: str
+    name: str
+
+
+class RecordingData(Struct):
+    durationMs: int
+    id: str
+    mbid: str
+    title: str
+    url: str
+    year: Optional[int]
+    artists: Union[List[MbzData], UnsetType] = UNSET
+    # The local id, for excluded_ids
+    recordingId: Union[int, UnsetType] = UNSET
+    release: Union[MbzData, UnsetType] = UNSET
+
+
+class RadioInfo(Struct):
+    name: str
+    recordings: List[RecordingData]
+    profile: Union[str, UnsetType] = UNSET
+    session: Union[Optional[int], UnsetType] = UNSET
+    stages: Union[List[StageTiming], UnsetType] = UNSET
+
+
+class PoolBatch(NamedTuple):
+    radio: RadioInfo
+    # Whether the next batch has to be generated (the pool ran low)
+    low: bool
+
+
+def format_radio(data, credentials: Dict[str, str]) -> Optional[RadioInfo]:
+    try:
+        _ = data.playlists[0].recordings[0]
+    except (KeyError, IndexError, AttributeError):
+        return None
+
+    playlist: "Playlist" = data.playlists[0]
+    recordings: List["Recording"] = playlist.recordings
+
+    output_json: "List[RecordingData]" = []
+
+    if PROXY_IMAGES:
+
+        def get_url(id: str):
+            return f"./api/proxy/{id}"
+
+    else:
+        conn = CustomConnection(credentials=credentials)
+
+        def get_url(id: str):
+            req = conn._getRequest("getCoverArt.view", {"id": id, "size": 100})
+            return f"{req.full_url}?{req.data.decode()}"
+
+    recording_ids = find_recording_ids(
+        recording.musicbrainz["subsonic_id"] for recording in recordings
+    )
+
+    for recording in recordings:
+        subsonic_id = recording.musicbrainz["subsonic_id"]
+
+        recording_json = RecordingData(
+            durationMs=recording.duration,
+            id=subsonic_id,
+            mbid=recording.mbid,
+            title=recording.name,
+            url=get_url(subsonic_id),
+            year=recording.year,
+        )
+
+        if subsonic_id in recording_ids:
+            recording_json.recordingId = recording_ids[subsonic_id]
+
+        if recording.artist_credit:
+            credits: "ArtistCredit" = recording.artist_credit
+            artists: "List[Artist]" = credits.artists
+
+            recording_json.artists = [
+                MbzData(mbid=artist.mbid, name=artist.name) for artist in artists
+            ]
+
+        if recording.release:
+            release: "Release" = recording.release
+            recording_json.release = MbzData(mbid=release.mbid, name=release.name)
+
+        output_json.append(recording_json)
+
+    return RadioInfo(name=playlist.name, recordings=output_json)
+
+
+def load_session(username: str, id: int) -> Optional[Session]:
+    return (
+        Session.select(Session.id, Session.mode, Session.prompt, Session.seen)
+        .where(Session.username == username, Session.id == id)
+        .get_or_none()
+    )
+
+
+def take_prefetched(
+    session: Session,
+    excluded_mbids: Optional[Sequence[Union[str, int]]],
+    excluded_ids: Optional[bytes] = None,
+) -> Optional[RadioInfo]:
+    """
+    The batch of a session generated in the background, if it is still valid
+    """
+    key = prefetch_key(session, excluded_mbids, excluded_ids)
+    prefetched = take_prefetch(session.id, key)
+    if prefetched is None:
+        return None
+
+    return decode(RadioInfo, prefetched)
+
+
+class _PoolCredit(NamedTuple):
+    artist_credit_id: Optional[str]
+
+
+class _PoolCandidate(NamedTuple):
+    """
+    A pool recording, as much as the blend looks at (the MBID and the credit)
+    """
+
+    mbid: str
+    artist_credit: _PoolCredit
+    recording: PoolRecording
+
+
+def _pool_recording(
+    candidate: PoolRecording, artists: List[tuple[str, str]]
+) -> "Recording":
+    credited = [
+        Artist(name=name, mbid=mbid)
+        for mbid, name in artists or [(candidate.artist_mbid, candidate.artist_name)]
+    ]
+
+    return Recording(
+        name=candidate.name,
+        mbid=candidate.mbid,
+        duration=candidate.duration,
+        artist_credit=ArtistCredit(
+            name=candidate.artist_name,
+            artists=credited,
+            artist_credit_id=candidate.artist_mbid,
+        ),
+        release=Release(name=candidate.release_name, mbid=candidate.release_mbid)
+        if candidate.release_mbid
+        else None,
+        musicbrainz={"subsonic_id": candidate.file_id},
+    )
+
+
+def sample_pool(
+    session: Session,
+    excluded_mbids: Optional[Sequence[Union[str, int]]],
+    credentials: Dict[str, str],
+    excluded_ids: Optional[Sequence[int]] = None,
+) -> Optional[PoolBatch]:
+    """
+    Make the next batch of a session from its pool, blending the remaining
+    candidates of each source like the radio did. Metadata comes from the
+    library rather than ListenBrainz. Returns None if the session has no
+    pool for this library version, or it ran low
+    """
+    with stage("SessionPool.load"):
+        pool = load_pool(session.id, excluded_mbids, excluded_ids)
+
+    if pool is None:
+        return None
+
+    name, weights, candidates = pool
+    if len(candidates) < TARGET_NUMBER_OF_RECORDINGS:
+        return None
+
+    with stage("SessionPool.sample"):
+        sources: List[List[_PoolCandidate]] = [[] for _ in weights]
+        for candidate in candidates:
+            sources[candidate.source].append(
+                _PoolCandidate(
+                    candidate.mbid, _PoolCredit(candidate.artist_mbid), candidate
+                )
+            )
+
+        blend = WeightAndBlendAllowExcessArtistsToHitTarget(
+            weights,
+            max_num_recordings=BLEND_MAX_RECORDINGS,
+            max_artist_occurrence=BLEND_MAX_ARTIST_OCCURRENCE,
+        )
+        chosen = blend.read(sources)[:TARGET_NUMBER_OF_RECORDINGS]
+
+    if len(chosen) < TARGET_NUMBER_OF_RECORDINGS:
+        return None
+
+    with stage("SessionPool.recordings"):
+        artists = find_recording_artists(item.recording.id for item in chosen)
+        recordings = [
+            _pool_recording(item.recording, artists.get(item.recording.id))
+            for item in chosen
+        ]
+
+    playlist = PlaylistElement()
+    playlist.playlists = [Playlist(name=name, recordings=recordings)]
+
+    with stage("output"):
+        radio = format_radio(playlist, credentials)
+
+    if radio is None:
+        return None
+
+    remaining = len(candidates) - len(chosen)
+    return PoolBatch(radio, remaining < TARGET_NUMBER_OF_RECORDINGS)
+
+
+def update_session(session: Session, results: RadioInfo) -> None:
+    """
+    Add a batch to the songs seen by its session, or delete the session if
+    it ran out of songs
+    """
+    if len(results.recordings) < TARGET_NUMBER_OF_RECORDINGS:
+        Session.delete_by_id(session.id)
+        results.session = None
+    else:
+        seen_ids = (session.seen or []) + [r.mbid for r in results.recordings]
+        Session.update(seen=Session.seen.set(seen_ids)).where(
+            Session.id == session.id
+        ).execute()
+        results.session = session.id
+
+
+def continue_session(json: "CreateRadioWithCredentials") -> Optional[PoolBatch]:
+    """
+    The next batch of a session radio, if it is ready without generating the
+    radio: prefetched, or sampled from the pool. This is cheap enough to run
+    in the web worker. The database must already be connected. Returns None
+    if the radio has to be generated (or there is no such session)
+    """
+    session = load_session(json.credentials["u"], json.prompt.id)
+    if session is None:
+        return None
+
+    # A prefetched batch comes with a new pool
+    prefetched = take_prefetched(session, json.excluded_mbids, json.excluded_ids)
+    if prefetched is not None:
+        batch = PoolBatch(prefetched, False)
+    else:
+        batch = sample_pool(
+            session,
+            json.excluded_mbids,
+            json.credentials,
+            decode_recording_ids(json.excluded_ids or b""),
+        )
+
+    if batch is not None:
+        update_session(session, batch.radio)
+
+    return batch
@@ -0,0 +1,295 @@
+from typing import List, Optional
+
+from datetime import datetime
+from fcntl import LOCK_EX, flock
+from os import (
+    O_RDONLY,
+    close,
+    environ,
+    fsync,
+    listdir,
+    makedirs,
+    open as os_open,
+    path,
+    remove,
+    replace,
+    stat,
+)
+from sqlite3 import Connection, Error
+from threading import Lock
+from urllib.parse import quote
+
+from msgspec import DecodeError, Struct, json
+from troi.content_resolver.model.database import db
+
+from .library import get_library_state
+
+READ_SNAPSHOT_PATH = environ.get("READ_SNAPSHOT_PATH")
+READ_SNAPSHOT_MMAP_SIZE_MB = int(environ.get("READ_SNAPSHOT_MMAP_SIZE_MB", 1024))
+READ_SNAPSHOT_MMAP_SIZE = READ_SNAPSHOT_MMAP_SIZE_MB * 1024 * 1024
+
+__all__ = [
+    "READ_SNAPSHOT",
+    "READ_SNAPSHOT_TABLES",
+    "ReadSnapshot",
+    "ReadSnapshotInfo",
+    "ensure_read_snapshot",
+    "publish_read_snapshot",
+]
+
+# The library tables, which only the sync (or a snapshot import) writes.
+# Readers see them as of the last published snapshot. Everything else
+# (sessions, ratings and the similar artists cache, which radios write too)
+# is read from the live database
+READ_SNAPSHOT_TABLES = (
+    "artist",
+    "artist_fts",
+    "artist_summary",
+    "artist_summary_fts",
+    "library_state",
+    "recording",
+    "recording_artist",
+    "recording_metadata",
+    "recording_tag",
+    "tag",
+    "tag_summary",
+    "tag_summary_fts",
+    "unresolved_recording",
+)
+
+CURRENT_FILE = "current.json"
+LOCK_FILE = "publish.lock"
+SNAPSHOT_PREFIX = "library-"
+# The previous snapshot is kept for readers that found it right before a switch
+KEEP_SNAPSHOTS = 2
+
+SCHEMA = "snapshot"
+
+SNAPSHOT_TABLES_QUERY = f"""
+SELECT name, sql FROM {SCHEMA}.sqlite_master WHERE type = 'table'
+"""
+
+
+class ReadSnapshotInfo(Struct):
+    file: str
+    library_version: int
+    # Of the live database, to publish again after a migration
+    schema_version: int
+    created: datetime
+
+
+def _sync_file(file_path: str) -> None:
+    fd = os_open(file_path, O_RDONLY)
+    try:
+        fsync(fd)
+    finally:
+        close(fd)
+
+
+def _read_current() -> Optional[ReadSnapshotInfo]:
+    try:
+        with open(path.join(READ_SNAPSHOT_PATH, CURRENT_FILE), "rb") as file:
+            return json.decode(file.read(), type=ReadSnapshotInfo)
+    except (OSError, DecodeError):
+        return None
+
+
+def _write_current(info: ReadSnapshotInfo) -> None:
+    current_path = path.join(READ_SNAPSHOT_PATH, CURRENT_FILE)
+    temp_path = f"{current_path}.tmp"
+
+    with open(temp_path, "wb") as file:
+        file.write(json.encode(info))
+        file.flush()
+        fsync(file.fileno())
+
+    # Readers either see the previous snapshot or this one
+    replace(temp_path, current_path)
+    _sync_file(READ_SNAPSHOT_PATH)
+
+
+def _remove_old_snapshots() -> None:
+    """
+    Remove all but the latest KEEP_SNAPSHOTS snapshots, and any snapshot
+    left half written. Readers still using a removed snapshot keep reading
+    it until they switch, as it is only unlinked
+    """
+    snapshots: List[tuple[int, str]] = []
+
+    for name in listdir(READ_SNAPSHOT_PATH):
+        if not name.startswith(SNAPSHOT_PREFIX):
+            continue
+
+        file_path = path.join(READ_SNAPSHOT_PATH, name)
+        if name.endswith(".tmp"):
+            remove(file_path)
+        else:
+            snapshots.append((stat(file_path).st_mtime_ns, file_path))
+
+    snapshots.sort(reverse=True)
+    for _, file_path in snapshots[KEEP_SNAPSHOTS:]:
+        remove(file_path)
+
+
+def publish_read_snapshot() -> Optional[ReadSnapshotInfo]:
+    """
+    Copy the database into a new read snapshot (VACUUM INTO), and make it the
+    current one. This must run on a connection to the live database, outside
+    of a transaction. Returns None if read snapshots are disabled
+    """
+    if not READ_SNAPSHOT_PATH:
+        return None
+
+    makedirs(READ_SNAPSHOT_PATH, exist_ok=True)
+
+    with open(path.join(READ_SNAPSHOT_PATH, LOCK_FILE), "a+b") as lock_file:
+        # Released when the file is closed. Also keeps the cleanup from
+        # removing a snapshot another process is writing
+        flock(lock_file, LOCK_EX)
+
+        state = get_library_state()
+        (schema_version,) = db.execute_sql("PRAGMA schema_version").fetchone()
+
+        created = datetime.now()
+        version = state.version if state is not None else 0
+        name = f"{SNAPSHOT_PREFIX}{version}-{created:%Y%m%d%H%M%S%f}.db"
+        file_path = path.join(READ_SNAPSHOT_PATH, name)
+        temp_path = f"{file_path}.tmp"
+
+        db.execute_sql("VACUUM INTO ?", params=(temp_path,))
+        _sync_file(temp_path)
+        replace(temp_path, file_path)
+
+        info = ReadSnapshotInfo(
+            file=name,
+            library_version=version,
+            schema_version=schema_version,
+            created=created,
+        )
+        _write_current(info)
+        _remove_old_snapshots()
+
+    return info
+
+
+def ensure_read_snapshot() -> Optional[ReadSnapshotInfo]:
+    """
+    Publish a read snapshot if there is none yet, or if the schema changed
+    since the current one was made (so that readers do not miss new tables
+    or columns until the next sync)
+    """
+    if not READ_SNAPSHOT_PATH:
+        return None
+
+    current = _read_current()
+    (schema_version,) = db.execute_sql("PRAGMA schema_version").fetchone()
+
+    if (
+        current is not None
+        and current.schema_version == schema_version
+        and path.exists(path.join(READ_SNAPSHOT_PATH, current.file))
+    ):
+        return current
+
+    return publish_read_snapshot()
+
+
+def _drop_views(conn: Connection) -> None:
+    for table in READ_SNAPSHOT_TABLES:
+        conn.execute(f"DROP VIEW IF EXISTS temp.{table}")
+
+
+def _create_views(conn: Connection) -> None:
+    """
+    Shadow the library tables with temporary views of the snapshot. Unqualified
+    names resolve to temporary objects first, so every query (ours and Troi's)
+    reads the snapshot without changes. The rowid (and the hidden column of
+    full text indexes, for MATCH) are included, as views do not have them
+    """
+    tables = dict(conn.execute(SNAPSHOT_TABLES_QUERY).fetchall())
+
+    for table in READ_SNAPSHOT_TABLES:
+        sql = tables.get(table)
+        if sql is None:
+            continue
+
+        if "USING fts5" in sql:
+            columns = f"rowid AS rowid, *, {table}"
+        elif "WITHOUT ROWID" in sql.upper():
+            columns = "*"
+        else:
+            columns = "rowid AS rowid, *"
+
+        conn.execute(
+            f"CREATE TEMP VIEW {table} AS SELECT {columns} FROM {SCHEMA}.{table}"
+        )
+
+
+class ReadSnapshot:
+    """
+    The current read snapshot, as seen by a reader (web workers and radios).
+    Each pooled connection attaches the snapshot when it is checked out, and
+    moves to a newer one only then, so a request reads a single snapshot
+    throughout. The snapshot is immutable, so reads take no locks at all and
+    never see a sync half applied
+    """
+
+    __slots__ = "current_path", "file_path", "lock", "mtime"
+
+    def __init__(self, directory: str) -> None:
+        self.current_path = path.join(directory, CURRENT_FILE)
+        self.file_path: Optional[str] = None
+        self.lock = Lock()
+        self.mtime = 0
+
+    def current(self) -> Optional[str]:
+        """
+        The path of the current snapshot, or None if none was published yet.
+        The pointer is only read again when it changed
+        """
+        try:
+            mtime = stat(self.current_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        if mtime != self.mtime:
+            with self.lock:
+                info = _read_current()
+                if info is not None:
+                    self.file_path = path.abspath(
+                        path.join(path.dirname(self.current_path), info.file)
+                    )
+                    self.mtime = mtime
+
+        return self.file_path
+
+    def attach(self, conn: Connection) -> None:
+        file_path = self.current()
+        if file_path is None:
+            return
+
+        attached = {
+            name: file for _, name, file in conn.execute("PRAGMA database_list")
+        }
+        if attached.get(SCHEMA) == file_path:
+            return
+
+        try:
+            if SCHEMA in attached:
+                conn.execute(f"DETACH DATABASE {SCHEMA}")
+
+            conn.execute(
+                f"ATTACH DATABASE ? AS {SCHEMA}",
+                (f"file:{quote(file_path)}?mode=ro&immutable=1",),
+            )
+            conn.execute(f"PRAGMA {SCHEMA}.mmap_size = {READ_SNAPSHOT_MMAP_SIZE}")
+
+            _drop_views(conn)
+            _create_views(conn)
+        except Error as e:
+            # Read the live database instead, until the next snapshot
+            print(f"Failed to attach read snapshot {file_path}: {e}")
+            _drop_views(conn)
+
+
+READ_SNAPSHOT = ReadSnapshot(READ_SNAPSHOT_PATH) if READ_SNAPSHOT_PATH else None
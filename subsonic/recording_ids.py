@@ -0,0 +1,75 @@
+from typing import Dict, Iterable, List
+
+from itertools import accumulate
+
+from troi.content_resolver.model.recording import Recording
+
+__all__ = ["decode_recording_ids", "encode_recording_ids", "find_recording_ids"]
+
+
+def encode_recording_ids(ids: Iterable[int]) -> bytes:
+    """
+    Encode a set of local recording ids (recording.id) compactly: in ascending
+    order, each as the difference to the previous one (the first one as is),
+    as unsigned LEB128 varints (7 bits per byte, least significant first, with
+    the high bit set on every byte but the last of a number). The ids of a
+    library are dense, so most take a single byte
+    """
+    data = bytearray()
+    previous = 0
+
+    for id in sorted(set(ids)):
+        if id < 0:
+            raise ValueError(f"Invalid recording id {id}")
+
+        delta = id - previous
+        previous = id
+
+        while delta >= 0x80:
+            data.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        data.append(delta)
+
+    return bytes(data)
+
+
+def decode_recording_ids(data: bytes) -> List[int]:
+    """
+    Decode recording ids encoded by encode_recording_ids. Raises ValueError if
+    the data is truncated
+    """
+    if not data:
+        return []
+
+    if data[-1] & 0x80:
+        raise ValueError("The recording ids are truncated")
+
+    # Every delta fits in one byte, so the ids are just the running sum
+    if max(data) < 0x80:
+        return list(accumulate(data))
+
+    ids: List[int] = []
+    current = value = shift = 0
+
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            current += value
+            ids.append(current)
+            value = shift = 0
+
+    return ids
+
+
+def find_recording_ids(file_ids: Iterable[str]) -> Dict[str, int]:
+    """
+    The local recording id of each Subsonic song id (file_id)
+    """
+    query = (
+        Recording.select(Recording.file_id, Recording.id)
+        .where(Recording.file_id.in_(list(file_ids)))
+        .tuples()
+    )
+    return dict(query)
@@ -1,24 +1,44 @@
-from typing import ClassVar, Dict, List, Literal, Optional, Type, Union
+from typing import Annotated, Dict, List, Literal, Optional, Type, TypeVar, Union
 
 from enum import Enum as PyEnum
+from re import compile
+
+from msgspec import DecodeError, Meta, Struct, ValidationError, convert, json
+
+__all__ = [
+    "CreatePlaylist",
+    "CreateRadio",
+    "CreateRadioWithCredentials",
+    "CreateSession",
+    "DecodeError",
+    "LibraryQuery",
+    "Login",
+    "Mode",
+    "PromptType",
+    "Scan",
+    "SessionRadio",
+    "SlowQueryQuery",
+    "TextRadio",
+    "ValidationError",
+    "base_schema",
+    "convert",
+    "decode",
+    "decode_radio_ids",
+    "encode",
+    "format_error",
+]
+
+T = TypeVar("T", bound=Struct)
+
+
+class base_schema(Struct, forbid_unknown_fields=True):
+    pass
 
-from dataclasses import field
-from marshmallow_dataclass import dataclass
-from marshmallow import Schema
-from marshmallow.validate import Length
 
-
-class base_schema:
-    Schema: ClassVar[Type["Schema"]] = Schema
-
-
-@dataclass
 class CreatePlaylist(base_schema):
-    id: Optional[Union[str, int]]
-    ids: List[Union[str, int]] = field(
-        metadata={"required": True, "validate": Length(1)},
-    )
-    name: Optional[str]
+    ids: Annotated[List[Union[str, int]], Meta(min_length=1)]
+    id: Optional[Union[str, int]] = None
+    name: Optional[str] = None
 
 
 class Mode(str, PyEnum):
@@ -32,50 +52,148 @@ class PromptType(str, PyEnum):
     SESSION = "session"
 
 
-@dataclass
-class TextRadio(base_schema):
-    type: Literal[PromptType.PROMPT]
+class TextRadio(base_schema, tag_field="type", tag=PromptType.PROMPT.value):
     prompt: str
-    mode: Mode = field(metadata={"by_value": True})
+    mode: Mode
 
+    type = PromptType.PROMPT
 
-@dataclass
-class SessionRadio(base_schema):
-    type: Literal[PromptType.SESSION]
+
+class SessionRadio(base_schema, tag_field="type", tag=PromptType.SESSION.value):
     id: int
 
+    type = PromptType.SESSION
+
+
+def _check_recording_ids(data: Optional[bytes]) -> None:
+    # The varints are only decoded when used, but a truncated set is an error
+    if data and data[-1] & 0x80:
+        raise ValueError("excluded_ids is truncated")
+
 
-@dataclass
 class CreateRadio(base_schema):
     prompt: Union[TextRadio, SessionRadio]
-    excluded_mbids: Optional[List[Union[str, int]]]
-    quiet: Optional[bool]
+    excluded_mbids: Optional[List[Union[str, int]]] = None
+    # Local recording ids to exclude, encoded by encode_recording_ids (and
+    # base64 in JSON). Much smaller than MBIDs, for long sessions
+    excluded_ids: Optional[bytes] = None
+    profile: Optional[bool] = None
+    quiet: Optional[bool] = None
+
+    def __post_init__(self):
+        _check_recording_ids(self.excluded_ids)
 
 
-@dataclass
 class CreateRadioWithCredentials(base_schema):
     credentials: Dict[str, str]
-    excluded_mbids: Optional[List[Union[str, int]]]
     prompt: Union[TextRadio, SessionRadio]
-    quiet: Optional[bool]
+    excluded_mbids: Optional[List[Union[str, int]]] = None
+    excluded_ids: Optional[bytes] = None
+    profile: Optional[bool] = None
+    quiet: Optional[bool] = None
+    # Generate the next batch of a session radio and store it, without
+    # updating the session
+    prefetch: Optional[bool] = None
 
 
-@dataclass
 class Login(base_schema):
     username: str
     password: str
 
 
-@dataclass
 class Scan(base_schema):
     full: bool
 
 
-@dataclass
 class CreateSession(base_schema):
-    mbids: List[Union[str, int]] = field(
-        metadata={"required": True, "validate": Length(1)},
-    )
-    mode: Mode = field(metadata={"by_value": True})
+    mbids: Annotated[List[Union[str, int]], Meta(min_length=1)]
+    mode: Mode
     name: str
     prompt: str
+
+
+class LibraryQuery(base_schema):
+    """
+    Query string of the paginated library endpoints. q is matched against
+    the start of the name (prefix) or anywhere in it (substring)
+    """
+
+    limit: Annotated[int, Meta(ge=1, le=500)] = 50
+    offset: Annotated[int, Meta(ge=0)] = 0
+    sort: Literal["name", "count"] = "count"
+    order: Literal["asc", "desc"] = "desc"
+    q: Optional[Annotated[str, Meta(max_length=200)]] = None
+    match: Literal["prefix", "substring"] = "prefix"
+
+
+class SlowQueryQuery(base_schema):
+    """
+    Query string of the slow query endpoint. Queries are grouped by their
+    normalized text, and sorted by total/max time, count or when last seen
+    """
+
+    limit: Annotated[int, Meta(ge=1, le=500)] = 50
+    sort: Literal["total", "max", "count", "recent"] = "total"
+
+
+class RecordingId(Struct):
+    id: str
+
+
+class RadioIds(Struct):
+    """
+    Just the recording ids of a radio, skipping everything else
+    """
+
+    recordings: List[RecordingId]
+
+
+# Decoders are reusable, and much faster than creating one per request
+_decoders: Dict[type, json.Decoder] = {}
+
+
+def decode(schema: Type[T], data: bytes) -> T:
+    """
+    Decode and validate a JSON document. Raises DecodeError (or its subclass
+    ValidationError) if the document is not valid
+    """
+    decoder = _decoders.get(schema)
+    if decoder is None:
+        decoder = _decoders[schema] = json.Decoder(schema)
+
+    return decoder.decode(data)
+
+
+def decode_radio_ids(data: bytes) -> RadioIds:
+    return decode(RadioIds, data)
+
+
+encode = json.Encoder().encode
+
+# msgspec errors look like "Expected `str`, got `int` - at `$.prompt.mode`"
+ERROR_PATH_REGEX = compile(r"^(.*?)(?: - at `\$\.?(.*)`)?$")
+MISSING_FIELD_REGEX = compile(r"^Object missing required field `(.*)`$")
+UNKNOWN_FIELD_REGEX = compile(r"^Object contains unknown field `(.*)`$")
+
+
+def format_error(error: "DecodeError") -> str:
+    """
+    Format a decode/validation error as "field: message", the same way as
+    errors have always been reported to clients
+    """
+    match = ERROR_PATH_REGEX.match(str(error))
+    message, path = match.group(1), match.group(2) or ""
+
+    if field := MISSING_FIELD_REGEX.match(message):
+        message = "Missing data for required field."
+        path = f"{path}.{field.group(1)}" if path else field.group(1)
+    elif field := UNKNOWN_FIELD_REGEX.match(message):
+        message = "Unknown field."
+        path = f"{path}.{field.group(1)}" if path else field.group(1)
+    elif not isinstance(error, ValidationError):
+        return f"Invalid JSON: {message}"
+
+    if path:
+        return f"{path}: {message}"
+
+    return message
@@ -1,8 +1,26 @@
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Union
+
+from datetime import datetime
+from hashlib import sha256
+from json import dumps, loads
+
 from peewee import *
 from playhouse.sqlite_ext import JSONField
 from troi.content_resolver.model.database import db
 
-__all__ = ["Session"]
+__all__ = [
+    "PoolRecording",
+    "Session",
+    "SessionPool",
+    "SessionPoolRecording",
+    "SessionPrefetch",
+    "library_version",
+    "load_pool",
+    "prefetch_key",
+    "store_pool",
+    "store_prefetch",
+    "take_prefetch",
+]
 
 
 class Session(Model):
@@ -25,3 +43,279 @@ class Session(Model):
 
     def __repr__(self) -> str:
         return f"<Session('{self.username}', '{self.prompt}', {self.seen.length()})"
+
+
+class SessionPrefetch(Model):
+    """
+    The next batch of a session, generated in the background after the last
+    one was served. It is only valid for the key it was made with (see
+    prefetch_key), and is removed once taken
+    """
+
+    class Meta:
+        database = db
+        table_name = "session_prefetch"
+
+    session = ForeignKeyField(Session, primary_key=True, on_delete="CASCADE")
+    key = TextField(null=False)
+    radio = BlobField(null=False)
+    created = DateTimeField(null=False)
+
+    def __repr__(self) -> str:
+        return f"<SessionPrefetch({self.session_id}, '{self.key}')>"
+
+
+class SessionPool(Model):
+    """
+    The candidates of a session: every recording its prompt found (after
+    lookup and filtering), by source, as of the library version it was
+    made with. Batches are sampled from the pool minus the songs seen, so
+    only the first batch (and any batch after a sync, or once the pool runs
+    low) goes through the whole pipeline
+    """
+
+    class Meta:
+        database = db
+        table_name = "session_pool"
+
+    session = ForeignKeyField(Session, primary_key=True, on_delete="CASCADE")
+    version = IntegerField(null=False)
+    name = TextField(null=False)
+    weights = JSONField(null=False)
+    created = DateTimeField(null=False)
+
+    def __repr__(self) -> str:
+        return f"<SessionPool({self.session_id}, {self.version}, {self.weights})>"
+
+
+class SessionPoolRecording(Model):
+    """
+    A recording of a session pool, in the order its source returned it.
+    There is deliberately no foreign key to recording: the pool is only used
+    with the library version it was made with, so syncs do not have to
+    cascade into it
+    """
+
+    class Meta:
+        database = db
+        table_name = "session_pool_recording"
+        primary_key = CompositeKey("session", "source", "position")
+
+    session = ForeignKeyField(SessionPool, on_delete="CASCADE")
+    source = IntegerField(null=False)
+    position = IntegerField(null=False)
+    recording_id = IntegerField(null=False)
+
+    def __repr__(self) -> str:
+        return (
+            f"<SessionPoolRecording({self.session_id}, {self.source}, "
+            f"{self.recording_id})>"
+        )
+
+
+class PoolRecording(NamedTuple):
+    source: int
+    id: int
+    file_id: str
+    mbid: str
+    name: Optional[str]
+    duration: Optional[int]
+    release_mbid: Optional[str]
+    release_name: Optional[str]
+    artist_mbid: Optional[str]
+    artist_name: Optional[str]
+
+
+# Hated recordings (of any user) are filtered out of every radio
+HATED_RATINGS_QUERY = """
+SELECT recording_id FROM rating WHERE rating = 1 ORDER BY recording_id
+"""
+
+LIBRARY_VERSION_QUERY = """
+SELECT version FROM library_state WHERE id = 1
+"""
+
+STORE_PREFETCH_QUERY = """
+INSERT OR REPLACE INTO session_prefetch (session_id, key, radio, created)
+SELECT id, ?, ?, ? FROM session WHERE id = ?
+"""
+
+TAKE_PREFETCH_QUERY = """
+DELETE FROM session_prefetch WHERE session_id = ? RETURNING key, radio
+"""
+
+DELETE_POOL_QUERY = """
+DELETE FROM session_pool WHERE session_id = ?
+"""
+
+STORE_POOL_QUERY = """
+INSERT INTO session_pool (session_id, version, name, weights, created)
+SELECT id, ?, ?, ?, ? FROM session WHERE id = ?
+"""
+
+# Recordings are matched by MBID, like the content resolver does for
+# candidates that did not come from the local database
+STORE_POOL_RECORDING_QUERY = """
+INSERT OR IGNORE INTO session_pool_recording
+    (session_id, source, position, recording_id)
+SELECT ?, ?, ?, id FROM recording WHERE recording_mbid = ? ORDER BY id LIMIT 1
+"""
+
+LOAD_POOL_QUERY = """
+SELECT session_pool.name, session_pool.weights
+FROM session_pool
+JOIN library_state ON library_state.id = 1
+WHERE session_pool.session_id = ?
+AND session_pool.version = library_state.version
+"""
+
+# The eligible recordings of a pool, by source: not seen by the session or
+# excluded by the request (JSON arrays of MBIDs and recording ids), and not
+# hated by anyone
+POOL_RECORDINGS_QUERY = """
+SELECT pool.source
+     , recording.id
+     , recording.file_id
+     , recording.recording_mbid
+     , recording.recording_name
+     , recording.duration
+     , recording.release_mbid
+     , recording.release_name
+     , recording.artist_mbid
+     , recording.artist_name
+FROM session_pool_recording pool
+JOIN recording ON recording.id = pool.recording_id
+WHERE pool.session_id = ?
+AND recording.recording_mbid NOT IN (
+    SELECT seen.value FROM session, json_each(session.seen) seen
+    WHERE session.id = ?
+)
+AND recording.recording_mbid NOT IN (SELECT value FROM json_each(?))
+AND recording.id NOT IN (SELECT value FROM json_each(?))
+AND recording.file_id NOT IN (SELECT recording_id FROM rating WHERE rating = 1)
+ORDER BY pool.source, pool.position
+"""
+
+
+def library_version() -> int:
+    (version,) = db.execute_sql(LIBRARY_VERSION_QUERY).fetchone() or (0,)
+    return version
+
+
+def prefetch_key(
+    session: Session,
+    excluded_mbids: Optional[Iterable[Union[str, int]]],
+    excluded_ids: Optional[bytes] = None,
+) -> str:
+    """
+    Everything a batch of a session depends on besides its prompt: the songs
+    seen so far, the excluded songs of the request, hated songs and the
+    library version (bumped by every sync)
+    """
+    digest = sha256()
+
+    version = library_version()
+    digest.update(f"{version}\0{len(session.seen or [])}\0".encode("utf-8"))
+
+    for mbid in sorted(str(mbid) for mbid in excluded_mbids or []):
+        digest.update(f"{mbid}\0".encode("utf-8"))
+    digest.update(b"\1")
+
+    # Encoded ids are sorted already
+    digest.update(excluded_ids or b"")
+    digest.update(b"\1")
+
+    for (recording_id,) in db.execute_sql(HATED_RATINGS_QUERY):
+        digest.update(f"{recording_id}\0".encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def store_prefetch(session_id: int, key: str, radio: bytes) -> None:
+    """
+    Store the next batch of a session, unless the session was deleted since
+    """
+    db.execute_sql(
+        STORE_PREFETCH_QUERY, params=(key, radio, datetime.now(), session_id)
+    )
+
+
+def take_prefetch(session_id: int, key: str) -> Optional[bytes]:
+    """
+    Remove the prefetched batch of a session, returning it if it is still
+    valid for key. Only one request can ever take a batch
+    """
+    with db.atomic():
+        row = db.execute_sql(TAKE_PREFETCH_QUERY, params=(session_id,)).fetchone()
+
+    if row is None or row[0] != key:
+        return None
+
+    return row[1]
+
+
+def store_pool(
+    session_id: int,
+    version: int,
+    name: str,
+    weights: List[int],
+    sources: Sequence[Sequence[str]],
+) -> int:
+    """
+    Replace the pool of a session with the recording MBIDs of each source
+    (in order), unless the session was deleted since. Recordings that are
+    not in the library are skipped. Returns the size of the pool
+    """
+    size = 0
+
+    with db.atomic():
+        db.execute_sql(DELETE_POOL_QUERY, params=(session_id,))
+        cursor = db.execute_sql(
+            STORE_POOL_QUERY,
+            params=(version, name, dumps(weights), datetime.now(), session_id),
+        )
+        if cursor.rowcount == 0:
+            return 0
+
+        for source, mbids in enumerate(sources):
+            cursor = db.cursor()
+            cursor.executemany(
+                STORE_POOL_RECORDING_QUERY,
+                [
+                    (session_id, source, position, mbid)
+                    for position, mbid in enumerate(mbids)
+                ],
+            )
+            size += cursor.rowcount
+
+    return size
+
+
+def load_pool(
+    session_id: int,
+    excluded_mbids: Optional[Iterable[Union[str, int]]],
+    excluded_ids: Optional[Sequence[int]] = None,
+) -> Optional[tuple[str, List[int], List[PoolRecording]]]:
+    """
+    Get the name, weights and eligible recordings (see POOL_RECORDINGS_QUERY)
+    of the pool of a session. Returns None if the session has no pool for
+    the current library version
+    """
+    with db.atomic():
+        row = db.execute_sql(LOAD_POOL_QUERY, params=(session_id,)).fetchone()
+        if row is None:
+            return None
+
+        cursor = db.execute_sql(
+            POOL_RECORDINGS_QUERY,
+            params=(
+                session_id,
+                session_id,
+                dumps(list(excluded_mbids or [])),
+                dumps(list(excluded_ids or [])),
+            ),
+        )
+        recordings = list(map(PoolRecording._make, cursor))
+
+    name, weights = row
+    return name, loads(weights), recordings
@@ -0,0 +1,218 @@
+from typing import Dict, Iterable, List, Optional
+
+from datetime import datetime, timedelta
+from os import environ
+
+from peewee import *
+from troi.content_resolver.model.database import db
+from troi.plist import plist
+
+__all__ = [
+    "ArtistSimilarity",
+    "SimilarityFetch",
+    "SimilarityGraph",
+    "artists_to_refresh",
+    "get_cached_similar_artists",
+    "store_similar_artists",
+]
+
+SIMILAR_ARTISTS_MAX_AGE = timedelta(
+    days=int(environ.get("SIMILAR_ARTISTS_MAX_AGE_DAYS", 30))
+)
+
+
+class ArtistSimilarity(Model):
+    """
+    Similar artists of an artist (from ListenBrainz), restricted to artists
+    in the library. Scores are relative to the most similar artist (1)
+    """
+
+    class Meta:
+        database = db
+        table_name = "artist_similarity"
+        primary_key = CompositeKey("artist_mbid", "similar_mbid")
+        without_rowid = True
+
+    artist_mbid = TextField(null=False)
+    similar_mbid = TextField(null=False)
+    score = FloatField(null=False)
+
+    def __repr__(self) -> str:
+        return f"<ArtistSimilarity('{self.artist_mbid}', '{self.similar_mbid}', {self.score})>"
+
+
+class SimilarityFetch(Model):
+    """
+    When the similar artists of an artist were last fetched. This is kept
+    separately, as an artist may have no similar artists in the library
+    """
+
+    class Meta:
+        database = db
+        table_name = "artist_similarity_fetch"
+
+    artist_mbid = TextField(primary_key=True)
+    last_updated = DateTimeField(null=False)
+
+    def __repr__(self) -> str:
+        return f"<SimilarityFetch('{self.artist_mbid}', {self.last_updated})>"
+
+
+INSERT_SIMILARITY_QUERY = """
+INSERT OR REPLACE INTO artist_similarity (artist_mbid, similar_mbid, score)
+SELECT ?, mbid, ? FROM artist WHERE mbid = ?
+"""
+
+INSERT_FETCH_QUERY = """
+INSERT OR REPLACE INTO artist_similarity_fetch (artist_mbid, last_updated)
+VALUES (?, ?)
+"""
+
+CACHED_SIMILAR_QUERY = """
+SELECT similar_mbid, score
+FROM artist_similarity
+JOIN artist_similarity_fetch
+ON artist_similarity_fetch.artist_mbid = artist_similarity.artist_mbid
+WHERE artist_similarity.artist_mbid = ? AND last_updated >= ?
+ORDER BY score DESC
+"""
+
+# Library artists with the most recordings first, which were never fetched
+# (or too long ago)
+ARTISTS_TO_REFRESH_QUERY = """
+SELECT artist_summary.mbid
+FROM artist_summary
+LEFT JOIN artist_similarity_fetch
+ON artist_similarity_fetch.artist_mbid = artist_summary.mbid
+WHERE last_updated IS NULL OR last_updated < ?
+ORDER BY count DESC
+LIMIT ?
+"""
+
+NEIGHBOURS_QUERY = """
+SELECT artist_mbid, similar_mbid, score
+FROM artist_similarity
+JOIN artist ON artist.mbid = artist_similarity.similar_mbid
+WHERE artist_mbid IN ({})
+"""
+
+
+def store_similar_artists(artist_mbid: str, artists: List[dict]) -> None:
+    """
+    Store the similar artists of an artist, as returned by ListenBrainz
+    (a list of {"artist_mbid", "score"}). Artists that are not in the library
+    are skipped
+    """
+    top = max((artist["score"] for artist in artists), default=0) or 1
+
+    with db.atomic():
+        ArtistSimilarity.delete().where(
+            ArtistSimilarity.artist_mbid == artist_mbid
+        ).execute()
+        db.cursor().executemany(
+            INSERT_SIMILARITY_QUERY,
+            [
+                (artist_mbid, artist["score"] / top, artist["artist_mbid"])
+                for artist in artists
+                if artist["artist_mbid"] != artist_mbid
+            ],
+        )
+        db.execute_sql(INSERT_FETCH_QUERY, params=(artist_mbid, datetime.now()))
+
+
+def get_cached_similar_artists(artist_mbid: str) -> Optional[plist]:
+    """
+    Get the stored similar artists (in the library) of an artist, in the
+    same shape as LocalRecordingSearchByArtistService.get_similar_artists.
+    Returns None if they were never fetched, or are out of date
+    """
+    fresh_after = datetime.now() - SIMILAR_ARTISTS_MAX_AGE
+
+    exists = (
+        SimilarityFetch.select(SimilarityFetch.artist_mbid)
+        .where(
+            SimilarityFetch.artist_mbid == artist_mbid,
+            SimilarityFetch.last_updated >= fresh_after,
+        )
+        .exists()
+    )
+    if not exists:
+        return None
+
+    rows = db.execute_sql(
+        CACHED_SIMILAR_QUERY, params=(artist_mbid, fresh_after)
+    ).fetchall()
+
+    return plist(
+        [{"artist_mbid": mbid, "score": score} for mbid, score in rows]
+    )
+
+
+def artists_to_refresh(limit: int) -> List[str]:
+    rows = db.execute_sql(
+        ARTISTS_TO_REFRESH_QUERY,
+        params=(datetime.now() - SIMILAR_ARTISTS_MAX_AGE, limit),
+    ).fetchall()
+
+    return [mbid for (mbid,) in rows]
+
+
+class SimilarityGraph:
+    """
+    The stored artist similarity, as an in-memory graph. Edges are loaded as
+    the graph is traversed, one query per hop, and kept for later traversals
+    """
+
+    # Every hop further from the seed counts for less
+    HOP_DECAY = 0.5
+    # The most artists expanded on each hop
+    FRONTIER_SIZE = 200
+
+    def __init__(self) -> None:
+        self.edges: Dict[str, List[tuple[str, float]]] = {}
+
+    def load(self, mbids: Iterable[str]) -> None:
+        missing = [mbid for mbid in mbids if mbid not in self.edges]
+
+        for start in range(0, len(missing), 500):
+            batch = missing[start : start + 500]
+            loaded: Dict[str, List[tuple[str, float]]] = {mbid: [] for mbid in batch}
+
+            rows = db.execute_sql(
+                NEIGHBOURS_QUERY.format(",".join("?" * len(batch))), params=batch
+            ).fetchall()
+            for artist_mbid, similar_mbid, score in rows:
+                loaded[artist_mbid].append((similar_mbid, score))
+
+            self.edges.update(loaded)
+
+    def expand(self, seed: str, hops: int, limit: int) -> List[tuple[str, float]]:
+        """
+        Find up to limit artists within hops of seed (excluding the seed),
+        most similar first. The similarity of an artist is that of its best
+        path, multiplying the scores (and HOP_DECAY) of every hop
+        """
+        best: Dict[str, float] = {seed: 1.0}
+        frontier: Dict[str, float] = {seed: 1.0}
+
+        for _ in range(hops):
+            self.load(frontier)
+
+            reached: Dict[str, float] = {}
+            for mbid, weight in frontier.items():
+                for similar_mbid, score in self.edges[mbid]:
+                    similarity = weight * score * self.HOP_DECAY
+                    if similarity > best.get(similar_mbid, 0):
+                        best[similar_mbid] = reached[similar_mbid] = similarity
+
+            if not reached:
+                break
+
+            frontier = dict(
+                sorted(reached.items(), key=lambda item: item[1], reverse=True)[
+                    : self.FRONTIER_SIZE
+                ]
+            )
+
+        del best[seed]
+        return sorted(best.items(), key=lambda item: item[1], reverse=True)[:limit]
@@ -0,0 +1,249 @@
+from typing import Dict, List, Literal, Optional
+
+from datetime import datetime
+from fcntl import LOCK_EX, flock
+from logging import INFO, getLogger
+from logging.handlers import WatchedFileHandler
+from os import environ, getpid, makedirs, path, remove, replace
+from re import compile
+from threading import Lock
+
+from msgspec import DecodeError, Struct, json
+
+SLOW_QUERY_LOG = environ.get("SLOW_QUERY_LOG")
+SLOW_QUERY_ENABLED = bool(SLOW_QUERY_LOG)
+SLOW_QUERY_THRESHOLD_SEC = int(environ.get("SLOW_QUERY_THRESHOLD_MS", 100)) / 1000
+SLOW_QUERY_LOG_SIZE_MB = int(environ.get("SLOW_QUERY_LOG_SIZE_MB", 10))
+SLOW_QUERY_LOG_BACKUPS = int(environ.get("SLOW_QUERY_LOG_BACKUPS", 3))
+
+__all__ = [
+    "SLOW_QUERY_ENABLED",
+    "SLOW_QUERY_THRESHOLD_SEC",
+    "SlowQuery",
+    "SlowQueryStats",
+    "normalize_query",
+    "record_slow_query",
+    "summarize_slow_queries",
+]
+
+# Statements that can be explained without side effects
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "REPLACE", "UPDATE", "DELETE")
+
+WHITESPACE_REGEX = compile(r"\s+")
+# Lists of placeholders (IN (?, ?, ...), VALUES (?, ?), (?, ?)) vary in
+# length with the input, so they are collapsed into one
+PLACEHOLDERS_REGEX = compile(r"\?(?:\s*,\s*\?)+")
+VALUES_REGEX = compile(r"\(\?\.\.\.\)(?:\s*,\s*\(\?\.\.\.\))+")
+
+
+class SlowQuery(Struct):
+    time: datetime
+    process: str
+    query: str
+    params: int
+    duration_ms: float
+    plan: List[str]
+
+
+class SlowQueryStats(Struct):
+    query: str
+    count: int
+    total_ms: float
+    max_ms: float
+    last_seen: datetime
+    params: int
+    plan: List[str]
+
+
+def normalize_query(sql: str) -> str:
+    sql = WHITESPACE_REGEX.sub(" ", sql).strip()
+    sql = PLACEHOLDERS_REGEX.sub("?...", sql)
+    return VALUES_REGEX.sub("(?...)", sql)
+
+
+_logger = getLogger("subsonic.slow_query")
+_lock = Lock()
+# Plans only change with the schema or statistics, so each query is only
+# explained once per process
+_plans: Dict[str, List[str]] = {}
+MAX_PLANS = 1000
+
+
+class SharedRotatingFileHandler(WatchedFileHandler):
+    """
+    A log file rotated by size, written by every process (web workers, radios
+    and the sync). Rotating and writing happen under a lock shared by all of
+    them, and each process reopens the file once another one rotated it, so
+    records are neither interleaved nor written to a rotated file
+    """
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int) -> None:
+        super().__init__(filename)
+        self.lock_path = f"{filename}.lock"
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+    def _rotate(self) -> None:
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.baseFilename}.{i}"
+            if path.exists(source):
+                replace(source, f"{self.baseFilename}.{i + 1}")
+
+        if self.backup_count > 0:
+            replace(self.baseFilename, f"{self.baseFilename}.1")
+        else:
+            remove(self.baseFilename)
+
+    def emit(self, record) -> None:
+        with open(self.lock_path, "a") as lock_file:
+            # Released when the file is closed
+            flock(lock_file, LOCK_EX)
+
+            try:
+                if path.getsize(self.baseFilename) >= self.max_bytes:
+                    self._rotate()
+            except FileNotFoundError:
+                pass
+
+            # Reopens the file if it was rotated (here or by another process)
+            super().emit(record)
+
+
+def _setup_logger() -> None:
+    if _logger.handlers:
+        return
+
+    makedirs(path.dirname(path.abspath(SLOW_QUERY_LOG)), exist_ok=True)
+    handler = SharedRotatingFileHandler(
+        SLOW_QUERY_LOG,
+        max_bytes=SLOW_QUERY_LOG_SIZE_MB * 1024 * 1024,
+        backup_count=SLOW_QUERY_LOG_BACKUPS,
+    )
+    _logger.addHandler(handler)
+    _logger.setLevel(INFO)
+    _logger.propagate = False
+
+
+def _explain(cursor, sql: str, params) -> List[str]:
+    """
+    EXPLAIN QUERY PLAN of a statement, as an indented tree (one line per node)
+    """
+    depths: Dict[int, int] = {}
+    lines: List[str] = []
+
+    for id, parent, _, detail in cursor.execute(
+        f"EXPLAIN QUERY PLAN {sql}", params or ()
+    ).fetchall():
+        depths[id] = depths.get(parent, -1) + 1
+        lines.append("  " * depths[id] + detail)
+
+    return lines
+
+
+def record_slow_query(connection, sql: str, params, duration: float) -> None:
+    """
+    Log a statement that took at least SLOW_QUERY_THRESHOLD_SEC, with its plan.
+    connection is the connection the statement ran on, so that temporary
+    tables resolve the same. Without one, only a plan explained before is
+    logged. This must never break the query itself
+    """
+    query = normalize_query(sql)
+
+    try:
+        with _lock:
+            _setup_logger()
+            plan = _plans.get(query)
+
+        if plan is None:
+            plan = []
+            statement = query.split(" ", 1)[0].upper()
+
+            # Without the connection, the plan is left for a later call to find
+            if connection is not None:
+                if statement in EXPLAINABLE:
+                    plan = _explain(connection.cursor(), sql, params)
+
+                with _lock:
+                    if len(_plans) >= MAX_PLANS:
+                        _plans.clear()
+                    _plans[query] = plan
+
+        entry = SlowQuery(
+            time=datetime.now(),
+            process=f"{environ.get('METRICS_SLOT', 'web')}:{getpid()}",
+            query=query,
+            params=len(params or ()),
+            duration_ms=round(duration * 1000, 3),
+            plan=plan,
+        )
+        _logger.info(json.encode(entry).decode("utf-8"))
+    except Exception as e:
+        print(f"Failed to record slow query: {e}")
+
+
+def _read_entries() -> List[SlowQuery]:
+    decoder = json.Decoder(SlowQuery)
+    entries: List[SlowQuery] = []
+
+    # Oldest first, so that the latest plan of a query wins
+    files = [f"{SLOW_QUERY_LOG}.{i}" for i in range(SLOW_QUERY_LOG_BACKUPS, 0, -1)]
+    files.append(SLOW_QUERY_LOG)
+
+    for file_path in files:
+        try:
+            with open(file_path, "rb") as file:
+                for line in file:
+                    try:
+                        entries.append(decoder.decode(line))
+                    except DecodeError:
+                        # A line cut short by a crash
+                        continue
+        except FileNotFoundError:
+            continue
+
+    return entries
+
+
+def summarize_slow_queries(
+    sort: Literal["total", "max", "count", "recent"], limit: int
+) -> Optional[List[SlowQueryStats]]:
+    """
+    Group the logged slow queries (of every process) by normalized query.
+    Returns None if the slow query log is not enabled
+    """
+    if not SLOW_QUERY_ENABLED:
+        return None
+
+    stats: Dict[str, SlowQueryStats] = {}
+
+    for entry in _read_entries():
+        existing = stats.get(entry.query)
+        if existing is None:
+            stats[entry.query] = SlowQueryStats(
+                query=entry.query,
+                count=1,
+                total_ms=entry.duration_ms,
+                max_ms=entry.duration_ms,
+                last_seen=entry.time,
+                params=entry.params,
+                plan=entry.plan,
+            )
+        else:
+            existing.count += 1
+            existing.total_ms += entry.duration_ms
+            existing.max_ms = max(existing.max_ms, entry.duration_ms)
+            existing.last_seen = max(existing.last_seen, entry.time)
+            existing.plan = entry.plan
+
+    keys = {
+        "total": lambda s: s.total_ms,
+        "max": lambda s: s.max_ms,
+        "count": lambda s: s.count,
+        "recent": lambda s: s.last_seen,
+    }
+
+    top = sorted(stats.values(), key=keys[sort], reverse=True)[:limit]
+    for entry in top:
+        entry.total_ms = round(entry.total_ms, 3)
+
+    return top
@@ -0,0 +1,222 @@
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from datetime import datetime
+from gzip import open as gzip_open
+from os import path, remove, replace
+
+from msgspec import DecodeError, Struct, msgpack
+from troi.content_resolver.model.database import db
+
+from .library import get_library_state, refresh_library_stats
+
+__all__ = [
+    "SNAPSHOT_TABLES",
+    "SnapshotError",
+    "SnapshotHeader",
+    "SnapshotTable",
+    "export_snapshot",
+    "import_snapshot",
+]
+
+SNAPSHOT_FORMAT = "troi-subsonic-snapshot"
+SNAPSHOT_VERSION = 1
+
+# The resolved library, parents before children so that foreign keys hold
+# while importing. Sessions and ratings belong to users, and the summaries
+# are derived (and rebuilt after an import)
+SNAPSHOT_TABLES = (
+    "artist",
+    "tag",
+    "recording",
+    "recording_artist",
+    "recording_metadata",
+    "recording_tag",
+    "unresolved_recording",
+    "artist_similarity",
+    "artist_similarity_fetch",
+)
+
+CHUNK_ROWS = 5000
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotTable(Struct, array_like=True):
+    name: str
+    columns: List[str]
+    rows: int
+
+
+class SnapshotHeader(Struct):
+    format: str
+    version: int
+    created: datetime
+    library_version: int
+    tables: List[SnapshotTable]
+
+
+class SnapshotChunk(Struct, array_like=True):
+    table: str
+    rows: List[List[Any]]
+
+
+_encoder = msgpack.Encoder()
+
+
+def _write_frame(file: BinaryIO, message: Struct) -> None:
+    data = _encoder.encode(message)
+    file.write(len(data).to_bytes(4, "big"))
+    file.write(data)
+
+
+def _read_frame(file: BinaryIO) -> Optional[bytes]:
+    """
+    Read the next length-prefixed message, or None at the end of the file
+    """
+    try:
+        prefix = file.read(4)
+        if not prefix:
+            return None
+
+        size = int.from_bytes(prefix, "big")
+        data = file.read(size)
+    except EOFError:
+        raise SnapshotError("The snapshot is truncated")
+
+    if len(prefix) != 4 or len(data) != size:
+        raise SnapshotError("The snapshot is truncated")
+
+    return data
+
+
+def _columns(table: str) -> List[str]:
+    return [row[1] for row in db.execute_sql(f"PRAGMA table_info('{table}')")]
+
+
+def export_snapshot(file_path: str) -> SnapshotHeader:
+    """
+    Write the resolved library to a snapshot file (gzipped, length-prefixed
+    msgpack messages: a header, then chunks of rows). Everything is read in
+    one transaction, so the snapshot is consistent even while a sync runs.
+    The file is only put in place once complete
+    """
+    tmp_path = path.join(
+        path.dirname(path.abspath(file_path)), f".{path.basename(file_path)}.tmp"
+    )
+
+    try:
+        with db.atomic(), gzip_open(tmp_path, "wb", compresslevel=6) as file:
+            state = get_library_state()
+            tables: List[SnapshotTable] = []
+
+            for table in SNAPSHOT_TABLES:
+                (count,) = db.execute_sql(f"SELECT COUNT(*) FROM {table}").fetchone()
+                tables.append(SnapshotTable(table, _columns(table), count))
+
+            header = SnapshotHeader(
+                format=SNAPSHOT_FORMAT,
+                version=SNAPSHOT_VERSION,
+                created=datetime.now(),
+                library_version=state.version if state else 0,
+                tables=tables,
+            )
+            _write_frame(file, header)
+
+            for table in tables:
+                cursor = db.execute_sql(
+                    f"SELECT {', '.join(table.columns)} FROM {table.name}"
+                )
+
+                while rows := cursor.fetchmany(CHUNK_ROWS):
+                    _write_frame(file, SnapshotChunk(table.name, rows))
+
+        replace(tmp_path, file_path)
+    except BaseException:
+        if path.exists(tmp_path):
+            remove(tmp_path)
+        raise
+
+    return header
+
+
+def import_snapshot(file_path: str, replace_existing: bool = False) -> SnapshotHeader:
+    """
+    Load a snapshot into the database, and rebuild the library summaries.
+    The library must be empty, unless replace_existing is set (which also
+    removes the ratings of the replaced recordings, until the next sync).
+    Columns missing from this version of the schema are skipped. Either the
+    whole snapshot is loaded, or nothing is
+    """
+    with gzip_open(file_path, "rb") as file:
+        try:
+            header = msgpack.decode(_read_frame(file) or b"", type=SnapshotHeader)
+        except (DecodeError, OSError) as e:
+            raise SnapshotError(f"Not a library snapshot: {e}")
+
+        if header.format != SNAPSHOT_FORMAT:
+            raise SnapshotError(f"Not a library snapshot: {header.format}")
+        if header.version > SNAPSHOT_VERSION:
+            raise SnapshotError(
+                f"Snapshot version {header.version} is newer than this version "
+                f"({SNAPSHOT_VERSION})"
+            )
+
+        chunk_decoder = msgpack.Decoder(SnapshotChunk)
+        inserts: Dict[str, Tuple[str, Optional[List[int]]]] = {}
+        imported = {table.name: 0 for table in header.tables}
+
+        for table in header.tables:
+            if table.name not in SNAPSHOT_TABLES:
+                continue
+
+            existing = set(_columns(table.name))
+            indexes = [i for i, name in enumerate(table.columns) if name in existing]
+            columns = [table.columns[i] for i in indexes]
+
+            inserts[table.name] = (
+                f"INSERT INTO {table.name} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                # Rows are only rebuilt if some columns have to be dropped
+                None if len(indexes) == len(table.columns) else indexes,
+            )
+
+        with db.atomic():
+            (count,) = db.execute_sql("SELECT COUNT(*) FROM recording").fetchone()
+            if count and not replace_existing:
+                raise SnapshotError(
+                    f"The library already has {count} recordings. "
+                    "Import with replace to overwrite them"
+                )
+
+            for table in reversed(SNAPSHOT_TABLES):
+                db.execute_sql(f"DELETE FROM {table}")
+
+            while (data := _read_frame(file)) is not None:
+                try:
+                    chunk = chunk_decoder.decode(data)
+                except DecodeError as e:
+                    raise SnapshotError(f"Invalid snapshot: {e}")
+
+                if chunk.table not in inserts:
+                    continue
+
+                query, indexes = inserts[chunk.table]
+                rows = chunk.rows
+                if indexes is not None:
+                    rows = [[row[i] for i in indexes] for row in rows]
+
+                db.cursor().executemany(query, rows)
+                imported[chunk.table] += len(chunk.rows)
+
+            for table in header.tables:
+                if table.name in inserts and imported[table.name] != table.rows:
+                    raise SnapshotError(
+                        f"Expected {table.rows} rows of {table.name}, "
+                        f"found {imported[table.name]}"
+                    )
+
+            refresh_library_stats()
+
+    return header
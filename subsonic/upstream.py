@@ -0,0 +1,305 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from contextlib import contextmanager
+from fcntl import LOCK_EX, flock
+from os import environ, makedirs, path
+from random import uniform
+from struct import Struct
+from threading import Condition, Lock
+from time import sleep, time
+from urllib.parse import urlsplit
+
+from .metrics import UPSTREAM_SERVICES
+
+UPSTREAM_STATE_PATH = environ.get("UPSTREAM_STATE_PATH", "./data/upstream")
+UPSTREAM_MAX_CONCURRENCY = int(environ.get("UPSTREAM_MAX_CONCURRENCY", 4))
+UPSTREAM_MAX_RETRIES = int(environ.get("UPSTREAM_MAX_RETRIES", 5))
+UPSTREAM_BACKOFF_SEC = float(environ.get("UPSTREAM_BACKOFF_SEC", 1))
+
+__all__ = ["AdaptiveConcurrency", "RateBudget", "install_upstream_client"]
+
+# Statuses worth trying again. MusicBrainz answers 503 when rate limited
+RETRY_STATUSES = {429, 502, 503, 504}
+
+# Services that do not send rate limit headers: (requests, per seconds)
+STATIC_LIMITS: Dict[str, Tuple[int, float]] = {"musicbrainz": (1, 1.0)}
+
+MAX_BACKOFF_SEC = 30
+
+
+class RateBudget:
+    """
+    The requests left in the current rate limit window of a service, shared by
+    every process (web workers, radios and the sync) through a small locked
+    file. It is kept up to date from the X-RateLimit-* headers of every
+    response, and requests wait for the next window once it is used up.
+
+    Until a service has answered, the budget is unknown. A single request is
+    let through to find it out, and the rest wait for its answer (for up to
+    PROBE_SEC). A new window is assumed to have the same limit and length as
+    the last one, until a response tells otherwise
+    """
+
+    __slots__ = "file_path", "static"
+
+    # limit, remaining (or UNKNOWN/PROBING), reset time, window length
+    STATE = Struct("<qqdd")
+    UNKNOWN = -1
+    PROBING = -2
+    PROBE_SEC = 5.0
+    POLL_SEC = 0.05
+
+    def __init__(self, name: str, static: Optional[Tuple[int, float]] = None) -> None:
+        makedirs(UPSTREAM_STATE_PATH, exist_ok=True)
+        self.file_path = path.join(UPSTREAM_STATE_PATH, f"{name}.state")
+        self.static = static
+
+    @contextmanager
+    def _state(self) -> Iterator[List]:
+        with open(self.file_path, "a+b") as file:
+            # Released when the file is closed
+            flock(file, LOCK_EX)
+
+            file.seek(0)
+            data = file.read(self.STATE.size)
+            if len(data) == self.STATE.size:
+                state = list(self.STATE.unpack(data))
+            else:
+                state = [0, self.UNKNOWN, 0.0, 0.0]
+
+            yield state
+
+            file.seek(0)
+            file.truncate()
+            file.write(self.STATE.pack(*state))
+
+    def acquire(self) -> None:
+        """
+        Take one request from the budget, waiting for the next window if
+        there is none left
+        """
+        while True:
+            with self._state() as state:
+                now = time()
+
+                if now >= state[2]:
+                    if self.static is not None:
+                        state[0], window = self.static
+                        state[1] = state[0]
+                        state[2] = now + window
+                    elif state[0] > 0 and state[3] > 0:
+                        # A new window, most likely like the last one. The
+                        # first response tells when it really ends
+                        state[1] = state[0]
+                        state[2] = now + state[3]
+                    else:
+                        state[1] = self.UNKNOWN
+
+                if state[1] == self.UNKNOWN:
+                    state[1] = self.PROBING
+                    state[2] = now + self.PROBE_SEC
+                    return
+                if state[1] > 0:
+                    state[1] -= 1
+                    return
+
+                probing = state[1] == self.PROBING
+                wait = state[2] - now
+
+            if probing:
+                sleep(self.POLL_SEC)
+            else:
+                # Spread out the requests all waiting for the same window
+                sleep(wait + uniform(0, min(1.0, wait / 4 + 0.05)))
+
+    def update(self, status: int, headers) -> Optional[int]:
+        """
+        Record the rate limit headers of a response. Returns the remaining
+        requests of the window, if known
+        """
+        limit = _header(headers, "X-RateLimit-Limit")
+        remaining = _header(headers, "X-RateLimit-Remaining")
+        reset_in = _header(headers, "X-RateLimit-Reset-In")
+        retry_after = _header(headers, "Retry-After")
+
+        if status != 429 and (remaining is None or reset_in is None):
+            self.end_probe()
+            return None
+
+        with self._state() as state:
+            now = time()
+
+            if status == 429:
+                wait = retry_after if retry_after is not None else reset_in
+                if wait is None:
+                    wait = state[3] or 1
+                state[1] = 0
+                state[2] = max(state[2], now + wait)
+                return 0
+
+            reset_at = now + reset_in
+            if limit is not None:
+                state[0] = limit
+
+            # Reset-In counts down through a window, so the longest one seen
+            # is the closest to its length
+            state[3] = max(state[3], float(reset_in))
+
+            # Within the current window, other requests may have taken from
+            # the budget since this one was answered, so never give back any.
+            # Windows only ever get longer, as responses arrive out of order
+            if state[1] >= 0 and state[2] > now:
+                state[1] = min(state[1], remaining)
+                state[2] = max(state[2], reset_at)
+            else:
+                state[1] = remaining
+                state[2] = reset_at
+
+            return state[1]
+
+    def end_probe(self) -> None:
+        """
+        Let the next request find out the budget, if this was a probe that
+        did not tell (such as a failed request)
+        """
+        if self.static is not None:
+            return
+
+        with self._state() as state:
+            if state[1] == self.PROBING:
+                state[1] = self.UNKNOWN
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the requests to a service in flight from this process. The limit
+    is halved whenever the service pushes back (or the budget is nearly
+    used up), and grows back by one for every limit successful requests
+    """
+
+    __slots__ = "active", "condition", "limit", "maximum"
+
+    def __init__(self, maximum: int) -> None:
+        self.active = 0
+        self.condition = Condition(Lock())
+        self.limit = float(maximum)
+        self.maximum = maximum
+
+    def __enter__(self) -> None:
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def __exit__(self, *_) -> None:
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def decrease(self) -> None:
+        with self.condition:
+            self.limit = max(1.0, self.limit / 2)
+
+    def increase(self) -> None:
+        with self.condition:
+            if self.limit < self.maximum:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+                self.condition.notify_all()
+
+
+def _header(headers, name: str) -> Optional[int]:
+    value = headers.get(name)
+    if value is None:
+        return None
+
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+class UpstreamClient:
+    __slots__ = "budget", "concurrency"
+
+    def __init__(self, service: str) -> None:
+        self.budget = RateBudget(service, STATIC_LIMITS.get(service))
+        self.concurrency = AdaptiveConcurrency(UPSTREAM_MAX_CONCURRENCY)
+
+
+def install_upstream_client() -> None:
+    """
+    Send every request to ListenBrainz/MusicBrainz made through requests
+    (Troi's lookups and our patched elements alike) through a shared client,
+    which keeps to the rate limit of each service across processes, adapts
+    its concurrency and retries with jittered backoff.
+
+    Callers still see a 429/5xx once the retries are used up
+    """
+    from requests import ConnectionError, Session
+
+    if getattr(Session.send, "_upstream_client", False):
+        return
+
+    send = Session.send
+    clients: Dict[str, UpstreamClient] = {}
+    clients_lock = Lock()
+
+    def get_client(service: str) -> UpstreamClient:
+        with clients_lock:
+            client = clients.get(service)
+            if client is None:
+                client = clients[service] = UpstreamClient(service)
+            return client
+
+    def client_send(self, request, **kwargs):
+        service = UPSTREAM_SERVICES.get(urlsplit(request.url).hostname)
+        if service is None:
+            return send(self, request, **kwargs)
+
+        client = get_client(service)
+
+        for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+            last_attempt = attempt == UPSTREAM_MAX_RETRIES
+
+            remaining = None
+
+            with client.concurrency:
+                client.budget.acquire()
+
+                try:
+                    response = send(self, request, **kwargs)
+                except ConnectionError:
+                    client.budget.end_probe()
+                    if last_attempt:
+                        raise
+                    response = None
+                else:
+                    remaining = client.budget.update(
+                        response.status_code, response.headers
+                    )
+
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                # Slow down before the budget runs out, rather than after
+                if remaining is not None and remaining < client.concurrency.limit:
+                    client.concurrency.decrease()
+                else:
+                    client.concurrency.increase()
+
+                return response
+
+            client.concurrency.decrease()
+            if last_attempt:
+                return response
+
+            if response is not None:
+                response.close()
+
+            # A 429 already makes the budget wait for the next window
+            if response is not None and response.status_code == 429:
+                sleep(uniform(0, UPSTREAM_BACKOFF_SEC / 4))
+            else:
+                backoff = min(MAX_BACKOFF_SEC, UPSTREAM_BACKOFF_SEC * 2**attempt)
+                sleep(uniform(0, backoff))
+
+    client_send._upstream_client = True
+    Session.send = client_send
@@ -18,11 +18,8 @@ import {
   ScanStatus,
   Session,
   SortInfo,
-  Tag,
-  Tags,
 } from "./types";
 import {
-  sortFunc,
   SCAN_INTERVAL_MS,
   getBool,
   isScanning,
@@ -52,10 +49,6 @@ const getPreferredTextMode = () => {
   return getBool("text") ?? false;
 };
 
-const pluralizeRecording = (tag: Tag): string => {
-  return `(${tag.count} ${tag.count === 1 ? "recording" : "recordings"})`;
-};
-
 const App = () => {
   const [notify, contextHolder] = notification.useNotification();
 
@@ -65,7 +58,7 @@ const App = () => {
   const [dark, setDark] = useState(getDarkPreferred());
   const [showText, setShowText] = useState(getPreferredTextMode());
   const [scanStatus, setScanStatus] = useState<ScanStatus | null>(null);
-  const [artistTags, setArtistTags] = useState<Tags | null>(null);
+  const [libraryVersion, setLibraryVersion] = useState(0);
   const [playlists, setPlaylists] = useState<ExistingPlaylist[]>([]);
   const [sessions, setSessions] = useState<Session[]>([]);
 
@@ -79,7 +72,6 @@ const App = () => {
   const clearState = useCallback(() => {
     setAuthenticated(false);
     setScanStatus(null);
-    setArtistTags(null);
   }, []);
 
   const makeRequest = useCallback(
@@ -143,12 +135,6 @@ const App = () => {
     return scanStatus;
   }, [makeRequest]);
 
-  const fetchTags = useCallback(async () => {
-    const tags = await makeRequest<Tags>("tags");
-    setArtistTags(tags);
-    return tags !== null;
-  }, [makeRequest]);
-
   const fetchSessions = useCallback(async () => {
     const sessions = await makeRequest<Session[]>("session");
     setSessions(sessions ?? []);
@@ -169,16 +155,16 @@ const App = () => {
       scanRef.current = undefined;
 
       if (status !== null) {
-        await fetchTags();
+        setLibraryVersion((version) => version + 1);
         notify.success({ message: "Scan completed", placement: "top" });
       }
     }
-  }, [notify, fetchTags, fetchScanStatus]);
+  }, [notify, fetchScanStatus]);
 
   const fetchMetadata = useCallback(async () => {
     const status = await fetchScanStatus();
     if (status) {
-      await Promise.all([fetchTags(), fetchSessions(), fetchPlaylists()]);
+      await Promise.all([fetchSessions(), fetchPlaylists()]);
 
       if (isScanning(status)) {
         if (scanRef.current) {
@@ -192,7 +178,6 @@ const App = () => {
     fetchPlaylists,
     fetchScanStatus,
     fetchSessions,
-    fetchTags,
     handlePeriodicScan,
   ]);
 
@@ -202,56 +187,19 @@ const App = () => {
     }
   }, [fetchMetadata]);
 
-  const artists = useMemo(() => {
-    if (artistTags?.artists) {
-      const func = sortFunc(artistSort);
-
-      return artistTags.artists
-        .map((item) => ({
-          count: item.count,
-          name:
-            item.subsonic_name && item.subsonic_name !== item.name
-              ? `${item.subsonic_name} ⋅ ${item.name}`
-              : item.name,
-          mbid: item.mbid,
-        }))
-        .sort(func)
-        .map((item) => ({
-          label: `${item.name} ${pluralizeRecording(item)}`,
-          value: item.mbid,
-        }));
-    }
-
-    return [];
-  }, [artistSort, artistTags?.artists]);
-
-  const tags = useMemo(() => {
-    if (artistTags?.tags) {
-      const func = sortFunc(tagSort);
-
-      return artistTags.tags.sort(func).map((item) => ({
-        label: `${item.name} ${pluralizeRecording(item)}`,
-        value: item.name,
-      }));
-    }
-
-    return [];
-  }, [artistTags?.tags, tagSort]);
-
   const tagInfo = useMemo(
     (): TagContextProps => ({
       artistSort,
-      artists,
+      libraryVersion,
       playlists,
       tagSort,
-      tags,
       sessions,
       setArtistSort,
       setPlaylists,
       setSessions,
       setTagSort,
     }),
-    [artistSort, artists, playlists, sessions, tagSort, tags]
+    [artistSort, libraryVersion, playlists, sessions, tagSort]
   );
 
   return (
@@ -1,6 +1,6 @@
 import { Col, Select, Form, InputNumber, Checkbox } from "antd";
 import { DefaultOptionType } from "antd/es/select";
-import { useTagContext } from "../contexts";
+import { LibrarySelect } from "./library-select";
 import {
   FormArtistData,
   FormGenreData,
@@ -34,7 +34,6 @@ const GENRE_MODES: DefaultOptionType[] = [
 
 export const FormItem = ({ advanced, name }: FormItemProps) => {
   const form = useFormInstance();
-  const tags = useTagContext();
   const type = useWatch(["rules", name, "type"], form);
 
   return (
@@ -57,12 +56,7 @@ export const FormItem = ({ advanced, name }: FormItemProps) => {
             name={[name, "artist"]}
             rules={[{ required: true }]}
           >
-            <Select
-              options={tags.artists}
-              optionFilterProp="label"
-              placeholder="Select an artist"
-              showSearch
-            />
+            <LibrarySelect kind="artists" placeholder="Select an artist" />
           </Item>
         )}
         {type === FormItemType.GENRE && (
@@ -70,12 +64,10 @@ export const FormItem = ({ advanced, name }: FormItemProps) => {
             name={[name, "genre"]}
             rules={[{ required: true }]}
           >
-            <Select
+            <LibrarySelect
+              kind="tags"
               mode="multiple"
-              options={tags.tags}
-              optionFilterProp="label"
               placeholder="Select one or more artists"
-              showSearch
             />
           </Item>
         )}
@@ -0,0 +1,143 @@
+import { Select, Spin } from "antd";
+import { DefaultOptionType } from "antd/es/select";
+import { useEffect, useMemo, useState } from "react";
+
+import { useAppContext, useTagContext } from "../contexts";
+import {
+  Artist,
+  ArtistPage,
+  SortDirection,
+  SortInfo,
+  SortType,
+  Tag,
+  TagPage,
+} from "../types";
+import { pluralizeRecording } from "../util";
+
+const PAGE_SIZE = 50;
+const SEARCH_DELAY_MS = 300;
+
+export type LibraryKind = "artists" | "tags";
+
+export interface LibrarySelectProps {
+  kind: LibraryKind;
+  mode?: "multiple";
+  placeholder: string;
+
+  // Set by Form.Item
+  value?: string | string[];
+  onChange?: (value: string | string[]) => void;
+}
+
+const libraryQuery = (sort: SortInfo, search: string): string => {
+  const params = new URLSearchParams({
+    limit: PAGE_SIZE.toString(),
+    sort: sort.type === SortType.FREQUENCY ? "count" : "name",
+    order: sort.direction === SortDirection.ASCENDING ? "asc" : "desc",
+  });
+
+  if (search) {
+    params.set("q", search);
+    params.set("match", "substring");
+  }
+
+  return params.toString();
+};
+
+const artistOption = (item: Artist): DefaultOptionType => {
+  const name =
+    item.subsonic_name && item.subsonic_name !== item.name
+      ? `${item.subsonic_name} ⋅ ${item.name}`
+      : item.name;
+
+  return { label: `${name} ${pluralizeRecording(item)}`, value: item.mbid };
+};
+
+const tagOption = (item: Tag): DefaultOptionType => {
+  return {
+    label: `${item.name} ${pluralizeRecording(item)}`,
+    value: item.name,
+  };
+};
+
+export const LibrarySelect = ({
+  kind,
+  mode,
+  placeholder,
+  value,
+  onChange,
+}: LibrarySelectProps) => {
+  const { makeRequest } = useAppContext();
+  const { artistSort, libraryVersion, tagSort } = useTagContext();
+  const sort = kind === "artists" ? artistSort : tagSort;
+
+  const [loading, setLoading] = useState(false);
+  const [options, setOptions] = useState<DefaultOptionType[]>([]);
+  const [search, setSearch] = useState("");
+  // Kept so that selected items keep their label once they are not on the page
+  const [selected, setSelected] = useState<DefaultOptionType[]>([]);
+
+  useEffect(() => {
+    let current = true;
+
+    const timeout = setTimeout(
+      async () => {
+        setLoading(true);
+        const page = await makeRequest<ArtistPage | TagPage>(
+          `library/${kind}?${libraryQuery(sort, search)}`
+        );
+
+        if (current) {
+          if (page) {
+            setOptions(
+              "artists" in page
+                ? page.artists.map(artistOption)
+                : page.tags.map(tagOption)
+            );
+          }
+          setLoading(false);
+        }
+      },
+      search ? SEARCH_DELAY_MS : 0
+    );
+
+    return () => {
+      current = false;
+      clearTimeout(timeout);
+    };
+  }, [kind, libraryVersion, makeRequest, search, sort]);
+
+  const allOptions = useMemo(() => {
+    const values = new Set(options.map((option) => option.value));
+    return [
+      ...options,
+      ...selected.filter((option) => !values.has(option.value)),
+    ];
+  }, [options, selected]);
+
+  return (
+    <Select
+      filterOption={false}
+      loading={loading}
+      mode={mode}
+      notFoundContent={loading ? <Spin size="small" /> : undefined}
+      onChange={(
+        newValue: string | string[],
+        option?: DefaultOptionType | DefaultOptionType[]
+      ) => {
+        setSelected(Array.isArray(option) ? option : option ? [option] : []);
+        onChange?.(newValue);
+      }}
+      onDropdownVisibleChange={(open) => {
+        if (!open) {
+          setSearch("");
+        }
+      }}
+      onSearch={setSearch}
+      options={allOptions}
+      placeholder={placeholder}
+      showSearch
+      value={value}
+    />
+  );
+};
@@ -96,11 +96,19 @@ export interface Recording {
   year: number;
 }
 
+export interface StageTiming {
+  calls: number;
+  name: string;
+  seconds: number;
+}
+
 export interface Playlist {
   id?: string;
   name: string;
+  profile?: string;
   recordings: Recording[];
   session?: number | null;
+  stages?: StageTiming[];
 }
 
 export type PlaylistResponse = {
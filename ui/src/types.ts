@@ -1,5 +1,3 @@
-import { DefaultOptionType } from "antd/es/select";
-
 declare global {
   interface Window {
     __authenticated__?: boolean;
@@ -34,9 +32,17 @@ export interface Artist {
   subsonic_id: string | null;
 }
 
-export interface Tags {
+export interface LibraryPage {
+  limit: number;
+  offset: number;
+  total: number;
+}
+
+export interface ArtistPage extends LibraryPage {
   artists: Artist[];
-  resolved_recordings: number;
+}
+
+export interface TagPage extends LibraryPage {
   tags: Tag[];
 }
 
@@ -61,9 +67,9 @@ export interface SortInfo {
 
 export interface TagInfo {
   artistSort: SortInfo;
-  artists: DefaultOptionType[];
+  // Bumped after every scan, so that library lists are fetched again
+  libraryVersion: number;
   tagSort: SortInfo;
-  tags: DefaultOptionType[];
 }
 
 export interface Session {
@@ -1,4 +1,4 @@
-import { ScanStatus, SortDirection, SortInfo, SortType, Tag } from "./types";
+import { ScanStatus, SortDirection, SortInfo, SortType } from "./types";
 
 
 export const isScanning = (status: ScanStatus | null) => {
@@ -25,30 +25,9 @@ export const setBool = (key: string, value: boolean): void => {
   localStorage.setItem(key, value.toString());
 };
 
-export const sortFunc = (info: SortInfo):  ((a: Tag, b: Tag) => number)  => {
-  switch (info.type) {
-    case SortType.FREQUENCY:
-      if (info.direction === SortDirection.ASCENDING) {
-        return (a, b) => { 
-          return a.count - b.count
-        }
-      } else {
-        return (b, a) => { 
-          return a.count - b.count
-        }
-      }
-    case SortType.NAME:
-      if (info.direction === SortDirection.ASCENDING) {
-        return (a, b) => { 
-          return a.name.localeCompare(b.name)
-        }
-      } else {
-        return (b, a) => { 
-          return a.name.localeCompare(b.name)
-        }
-      }
-  }
-}
+export const pluralizeRecording = (item: { count: number }): string => {
+  return `(${item.count} ${item.count === 1 ? "recording" : "recordings"})`;
+};
 
 export enum SortKey {
   ARTIST = "artist",